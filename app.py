@@ -1,11 +1,34 @@
 # dashboard_project/app.py
+import os
 import dash
 import dash_bootstrap_components as dbc
 from dash import Dash, html, dcc
+import plotly.io as pio
+from flask import Response, request
 from components.sidebar import create_sidebar
+from utils.metrics import Histogram, render_metrics
+from utils.acs_export import register_export_routes
+from utils.vector_tiles import register_tile_routes
 # from utils.db_connector import close_db_resources # Optional: if you want to close DB on exit
 # import atexit # Optional
 
+# --- JSON serialization ---
+# Dash 的回调响应经由 plotly.io.json 序列化；orjson (原生支持 NumPy 数组) 比标准库 json 快数倍。
+try:
+    pio.json.config.default_engine = "orjson"
+except ValueError:
+    pass # orjson 未安装，使用标准库 json
+
+# --- Background callbacks ---
+# 耗时的回调 (如大文件导出) 在独立进程中运行，不占用处理请求的 worker；
+# 任务状态和进度存放在本地 diskcache 中，所有 Gunicorn worker 共享同一目录。
+BACKGROUND_CACHE_DIR = os.getenv("BACKGROUND_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "background_callbacks"))
+try:
+    import diskcache
+    background_callback_manager = dash.DiskcacheManager(diskcache.Cache(BACKGROUND_CACHE_DIR))
+except ImportError:
+    background_callback_manager = None # 未安装 dash[diskcache]：导出页的后台任务不可用
+
 # --- Initialize the Dash App ---
 # use_pages=True enables Dash Pages (multi-page app capabilities)
 # external_stylesheets apply global styles; BOOTSTRAP theme provides a good starting point.
@@ -13,6 +36,7 @@ app = Dash(__name__,
            use_pages=True,
            external_stylesheets=[dbc.themes.LUX], # Using LUX theme for a modern look
            suppress_callback_exceptions=True, # Important for multi-page apps with dynamic content
+           background_callback_manager=background_callback_manager,
            meta_tags=[ # Responsive meta tag
                {"name": "viewport", "content": "width=device-width, initial-scale=1"}
            ]
@@ -89,6 +113,33 @@ app.layout = dbc.Container(
 # The 'server' variable is what WSGI servers like Gunicorn will look for.
 server = app.server
 
+# --- Metrics endpoint ---
+# Prometheus text format: query latency histograms, rows/bytes per callback, pool and cache stats.
+# Each Gunicorn worker reports its own numbers (see utils/metrics.py).
+@server.route("/metrics")
+def metrics():
+    return Response(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# --- Data export endpoints ---
+# 下载按钮直接链接到这些流式接口 (见 utils/acs_export.py)，文件不经过 Dash 回调
+register_export_routes(server)
+# ZCTA 矢量瓦片 (utils/vector_tiles.py)：全国范围的地图只传输各 ZCTA 的数值，形状由浏览器按瓦片加载
+register_tile_routes(server)
+
+# Size of every callback response, by output. Use sum/count for the average bytes per callback.
+CALLBACK_RESPONSE_BYTES = Histogram(
+    "dashboard_callback_response_bytes", "Size of Dash callback responses in bytes.", ("output",),
+    buckets=(1e3, 1e4, 1e5, 1e6, 1e7),
+)
+
+@server.after_request
+def record_callback_response_size(response):
+    if request.path.endswith("/_dash-update-component") and not response.direct_passthrough:
+        payload = request.get_json(silent=True) or {}
+        CALLBACK_RESPONSE_BYTES.observe(response.calculate_content_length() or 0,
+                                        output=payload.get("output", "unknown"))
+    return response
+
 # --- Optional: Register database cleanup function ---
 # def on_shutdown():
 #     print("Application is shutting down. Closing database resources.")
@@ -0,0 +1,189 @@
+/* assets/acs_map.js */
+
+/*
+ * ACS map: colors the ZCTA vector tile layer (/tiles/zcta/<signature>/{z}/{x}/{y}.pbf) from the
+ * ZCTA -> value arrays sent by render_map_and_stats (pages/acs_data.py).
+ * Plotly's mapbox layers cannot be styled from data, so the source and fill layer are
+ * added to the Plotly figure's underlying mapbox-gl map, and each ZCTA's value is set
+ * as feature state; the fill color is an interpolate expression over that state.
+ *
+ * Smaller selections embed their GeoJSON in a choropleth trace. The geometry arrives once
+ * per signature (acs-map-geometry) and is kept here; later renders of the same selection
+ * only send ZCTA -> value arrays (acs-map-values), which restyle the existing trace.
+ */
+(function () {
+    var GEOMETRY_CACHE_SIZE = 8; // 最多缓存的几何份数 (最近使用的优先保留)
+    var geometryCache = {};
+    var geometryOrder = [];
+
+    function cacheGeometry(geometry) {
+        if (!geometry || !geometry.signature || !geometry.geojson) {
+            return;
+        }
+        if (!(geometry.signature in geometryCache)) {
+            geometryOrder.push(geometry.signature);
+        }
+        geometryCache[geometry.signature] = geometry.geojson;
+        while (geometryOrder.length > GEOMETRY_CACHE_SIZE) {
+            delete geometryCache[geometryOrder.shift()];
+        }
+    }
+
+    function touchGeometry(signature) {
+        geometryOrder.splice(geometryOrder.indexOf(signature), 1);
+        geometryOrder.push(signature);
+        return geometryCache[signature];
+    }
+
+    window.acsMapGeometry = {
+        cache: cacheGeometry,
+        get: function (signature) {
+            return signature in geometryCache ? touchGeometry(signature) : null;
+        },
+        signatures: function () {
+            return geometryOrder.slice();
+        }
+    };
+})();
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    acsMap: {
+        applyGeoJsonValues: function (payload, geometry) {
+            var store = window.acsMapGeometry;
+            store.cache(geometry);
+            if (!payload || !payload.graphId) {
+                return store.signatures();
+            }
+            var geojson = store.get(payload.signature);
+            if (!geojson) {
+                // 几何已被淘汰：返回的签名列表中没有它，下次渲染时服务器会重新发送
+                return store.signatures();
+            }
+            var attempts = 0;
+
+            function run() {
+                var container = document.getElementById(payload.graphId);
+                var gd = container && container.querySelector(".js-plotly-plot");
+                // 等待 dcc.Graph 先绘制服务器发送的底图布局 (uirevision 即几何签名)，否则会覆盖这里的轨迹
+                if (!gd || !gd._fullLayout || !gd.layout || gd.layout.uirevision !== payload.signature || !window.Plotly) {
+                    if (attempts++ < 100) {
+                        setTimeout(run, 100);
+                    }
+                    return;
+                }
+                var trace = gd.data && gd.data[0];
+                if (trace && trace.meta === payload.signature) {
+                    // 同一份几何：只更新数值和颜色
+                    window.Plotly.restyle(gd, {
+                        locations: [payload.zctas],
+                        z: [payload.values],
+                        zmin: payload.range[0],
+                        zmax: payload.range[1],
+                        hovertemplate: payload.hovertemplate,
+                        "colorbar.title.text": payload.label
+                    }, [0]);
+                    return;
+                }
+                window.Plotly.react(gd, [{
+                    type: "choroplethmapbox",
+                    meta: payload.signature,
+                    geojson: geojson,
+                    featureidkey: payload.featureidkey,
+                    locations: payload.zctas,
+                    z: payload.values,
+                    zmin: payload.range[0],
+                    zmax: payload.range[1],
+                    colorscale: payload.colorscale,
+                    marker: {opacity: payload.opacity},
+                    colorbar: {title: {text: payload.label}},
+                    hovertemplate: payload.hovertemplate
+                }], gd.layout);
+            }
+
+            run();
+            return store.signatures();
+        },
+
+        applyTileValues: function (payload) {
+            if (!payload || !payload.graphId) {
+                return;
+            }
+            var SOURCE_ID = "acs-zcta-tiles";
+            var LAYER_ID = "acs-zcta-fill";
+            var attempts = 0;
+
+            function fillColor() {
+                var lo = payload.range[0], hi = payload.range[1];
+                var scale = payload.colorscale;
+                if (!(hi > lo)) {
+                    return scale[scale.length - 1][1];
+                }
+                var expr = ["interpolate", ["linear"], ["coalesce", ["feature-state", "value"], lo]];
+                scale.forEach(function (stop) {
+                    expr.push(lo + stop[0] * (hi - lo), stop[1]);
+                });
+                return expr;
+            }
+
+            function apply(map) {
+                var target = {source: SOURCE_ID, sourceLayer: payload.layer};
+                // mapbox-gl 需要绝对 URL；不能用 new URL()，它会转义 {z}/{x}/{y}
+                var tilesUrl = payload.tiles.charAt(0) === "/" ? window.location.origin + payload.tiles : payload.tiles;
+                if (map.getSource(SOURCE_ID) && map.acsTilesUrl !== tilesUrl) {
+                    // 几何已更新 (URL 中的签名变了)：换成新的瓦片源
+                    if (map.getLayer(LAYER_ID)) {
+                        map.removeLayer(LAYER_ID);
+                    }
+                    map.removeSource(SOURCE_ID);
+                }
+                if (!map.getSource(SOURCE_ID)) {
+                    map.acsTilesUrl = tilesUrl;
+                    map.addSource(SOURCE_ID, {
+                        type: "vector",
+                        tiles: [tilesUrl],
+                        maxzoom: payload.maxzoom,
+                        promoteId: payload.idProperty
+                    });
+                    map.addLayer({
+                        id: LAYER_ID,
+                        type: "fill",
+                        source: SOURCE_ID,
+                        "source-layer": payload.layer,
+                        paint: {"fill-outline-color": "rgba(255,255,255,0.4)"}
+                    });
+                } else {
+                    map.removeFeatureState(target);
+                }
+                map.setPaintProperty(LAYER_ID, "fill-color", fillColor());
+                // 没有数值的 ZCTA 完全透明
+                map.setPaintProperty(LAYER_ID, "fill-opacity",
+                    ["case", ["==", ["feature-state", "value"], null], 0, payload.opacity]);
+                for (var i = 0; i < payload.zctas.length; i++) {
+                    target.id = payload.zctas[i];
+                    map.setFeatureState(target, {value: payload.values[i]});
+                }
+            }
+
+            function run() {
+                var container = document.getElementById(payload.graphId);
+                var gd = container && container.querySelector(".js-plotly-plot");
+                var subplot = gd && gd._fullLayout && gd._fullLayout.mapbox && gd._fullLayout.mapbox._subplot;
+                var map = subplot && subplot.map;
+                if (!map) {
+                    // 图形尚未渲染完成，稍后重试
+                    if (attempts++ < 100) {
+                        setTimeout(run, 100);
+                    }
+                    return;
+                }
+                if (map.isStyleLoaded()) {
+                    apply(map);
+                } else {
+                    map.once("idle", function () { apply(map); });
+                }
+            }
+
+            run();
+        }
+    }
+});
@@ -0,0 +1,55 @@
+# dashboard_project/benchmarks/bench_bulk_fetch.py
+"""
+Compares the cursor path of fetch_data() with the COPY path of fetch_data_bulk().
+
+Run from the project root (uses the same DB_* environment variables as the app):
+    python -m benchmarks.bench_bulk_fetch
+    python -m benchmarks.bench_bulk_fetch --year 2022 --repeat 5
+"""
+import argparse
+import time
+
+from utils.db_utils import fetch_data, fetch_data_bulk, close_db_resources
+
+
+def time_call(func, repeat):
+    """Runs func() `repeat` times and returns (best seconds, last result)."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cursor fetch vs COPY bulk fetch.")
+    parser.add_argument("--year", type=int, default=None, help="Restrict to one year (default: all years)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per path; the best time is reported")
+    args = parser.parse_args()
+
+    query = "SELECT * FROM public.acs_data_all"
+    params = None
+    if args.year is not None:
+        query += " WHERE year = %s"
+        params = [args.year]
+    query += ' ORDER BY "year" DESC, "state" ASC, "zipcode" ASC'
+
+    paths = [
+        ("cursor (fetch_data)", lambda: fetch_data(query, params)),
+        ("COPY csv -> DataFrame", lambda: fetch_data_bulk(query, params)),
+        ("COPY csv -> Arrow", lambda: fetch_data_bulk(query, params, as_arrow=True)),
+    ]
+    print(f"Query: {query}  params={params}  repeat={args.repeat}")
+    baseline = None
+    for label, func in paths:
+        seconds, result = time_call(func, args.repeat)
+        baseline = baseline or seconds
+        print(f"{label:<24} {seconds * 1000:9.1f} ms  rows={result.shape[0] if hasattr(result, 'shape') else result.num_rows:>8}"
+              f"  speedup={baseline / seconds:5.2f}x")
+    close_db_resources()
+
+
+if __name__ == "__main__":
+    main()
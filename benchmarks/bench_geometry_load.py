@@ -0,0 +1,135 @@
+# dashboard_project/benchmarks/bench_geometry_load.py
+"""
+Compares loading the ZCTA geometry from the GeoJSON (plus levels of detail, if built), from
+the packed file of utils/packed_geometry.py, and through the memory-mapped store of
+utils/geometry_store.py: file size, startup time, memory held by the loaded index, and
+time to produce the features of a map selection.
+
+Each variant is loaded in a fresh interpreter. "memory" is the growth of the process's peak
+RSS over the loader; "private" (needs psutil) is the growth of its unshared memory (USS),
+i.e. what every additional worker costs: mapped store pages are shared between workers.
+Run from the project root after `python -m utils.convert_geometry`:
+    python -m benchmarks.bench_geometry_load
+    python -m benchmarks.bench_geometry_load --select 5000 --repeat 3
+Without the real ZCTA file, --synthetic N builds every format from a synthetic GeoJSON of N
+features (benchmarks/synthetic_zcta.py) in a temporary directory; nothing under data/ is touched:
+    python -m benchmarks.bench_geometry_load --synthetic 20000
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.synthetic_zcta import write_synthetic_geojson
+from utils.build_geometry_lod import build_levels
+from utils.convert_geometry import write_packed_geometry
+from utils.geometry_store import store_directory
+from utils.geometry import LOD_MANIFEST, ZCTA_GEOJSON_PATH, ZCTA_LOD_DIR, ZCTA_PACKED_PATH, ZCTA_STORE_DIR, content_sha1
+
+# 在子进程中运行：加载一次，报告耗时、峰值 RSS 增长和选取要素的耗时
+_CHILD = """
+import json, resource, sys, time
+import numpy as np
+from utils.geometry import load_zcta_index
+try:
+    import psutil
+except ImportError:
+    psutil = None
+def uss():
+    return psutil.Process().memory_full_info().uss if psutil else 0
+path, select, lod_dir = sys.argv[1], int(sys.argv[2]), sys.argv[3] or None
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+uss_before = uss()
+started = time.perf_counter()
+index = load_zcta_index(path, lod_dir=lod_dir)
+load_seconds = time.perf_counter() - started
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+positions = np.arange(min(select, len(index)))
+started = time.perf_counter()
+index.features_at(positions, len(index.levels) - 1 if len(index.levels) > 1 else 0)
+select_seconds = time.perf_counter() - started
+print(json.dumps({"load": load_seconds, "rss_mb": rss_kb / 1024, "select": select_seconds,
+                  "private_mb": (uss() - uss_before) / 2 ** 20,
+                  "features": len(index), "levels": len(index.levels) - 1, "signature": index.signature}))
+"""
+
+
+def file_size(path, lod_dir=None):
+    size = os.path.getsize(path)
+    manifest = os.path.join(lod_dir, LOD_MANIFEST) if lod_dir else None
+    if manifest and os.path.exists(manifest):
+        with open(manifest) as f:
+            size += sum(os.path.getsize(os.path.join(lod_dir, level["file"])) for level in json.load(f)["levels"])
+    return size
+
+
+def run_child(path, select, lod_dir, store_dir):
+    env = dict(os.environ, ZCTA_STORE_DIR=store_dir) # 空字符串 = 不使用共享存储
+    out = subprocess.run([sys.executable, "-c", _CHILD, path, str(select), lod_dir or ""],
+                         check=True, capture_output=True, text=True, env=env).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def build_synthetic(features, directory):
+    """Writes a synthetic GeoJSON, its levels of detail and its packed file to `directory`."""
+    geojson = write_synthetic_geojson(os.path.join(directory, "zcta_synthetic.json"), features)
+    lod_dir = os.path.join(directory, "lod")
+    build_levels(geojson, lod_dir)
+    with open(geojson, 'rb') as f:
+        data = f.read()
+    packed = os.path.join(directory, "zcta_synthetic.topo.npz")
+    write_packed_geometry(packed, json.loads(data)["features"], source_sha1=content_sha1(data))
+    return geojson, lod_dir, packed, os.path.join(directory, "store")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark GeoJSON vs packed vs memory-mapped ZCTA geometry loading.")
+    parser.add_argument("--geojson", default=ZCTA_GEOJSON_PATH, help="ZCTA GeoJSON (default: ZCTA_GEOJSON_PATH)")
+    parser.add_argument("--lod-dir", default=ZCTA_LOD_DIR, help="GeoJSON levels of detail (default: ZCTA_LOD_DIR)")
+    parser.add_argument("--packed", default=ZCTA_PACKED_PATH, help="Packed file (default: ZCTA_PACKED_PATH)")
+    parser.add_argument("--store-dir", default=ZCTA_STORE_DIR, help="Shared geometry store (default: ZCTA_STORE_DIR)")
+    parser.add_argument("--select", type=int, default=2000, help="Features decoded for the selection timing")
+    parser.add_argument("--repeat", type=int, default=3, help="Fresh processes per format; the best run is reported")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="Benchmark a synthetic geometry of this many features, built in a temporary directory")
+    args = parser.parse_args()
+    if args.synthetic:
+        directory = tempfile.mkdtemp(prefix="zcta_bench_")
+        try:
+            args.geojson, args.lod_dir, args.packed, args.store_dir = build_synthetic(args.synthetic, directory)
+            run(args)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    else:
+        run(args)
+
+
+def run(args):
+
+    formats = [("GeoJSON", args.geojson, args.lod_dir, ""), ("packed", args.packed, None, ""),
+               ("store", args.packed if os.path.exists(args.packed) else args.geojson, args.lod_dir, args.store_dir)]
+    run_child(formats[-1][1], 1, formats[-1][2], args.store_dir) # 先构建存储，计时的运行只映射它
+    baseline = None
+    for label, path, lod_dir, store_dir in formats:
+        if not os.path.exists(path):
+            print(f"{label:<8} missing: {path}")
+            continue
+        runs = [run_child(path, args.select, lod_dir, store_dir) for _ in range(args.repeat)]
+        best = {key: min(run[key] for run in runs) for key in ("load", "rss_mb", "private_mb", "select")}
+        if store_dir: # 存储目录 (未压缩，按需映射) 的大小
+            directory = store_directory(store_dir, runs[0]["signature"])
+            size_mb = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)) / 1e6
+        else:
+            size_mb = file_size(path, lod_dir) / 1e6
+        baseline = baseline or (size_mb, best)
+        print(f"{label:<8} {runs[0]['features']:>7} features {runs[0]['levels']} levels  "
+              f"size={size_mb:8.1f} MB  load={best['load'] * 1000:8.1f} ms  "
+              f"memory={best['rss_mb']:7.1f} MB  private={best['private_mb']:7.1f} MB  select {args.select}={best['select'] * 1000:7.1f} ms  "
+              f"(load {baseline[1]['load'] / best['load']:5.1f}x, size {baseline[0] / size_mb:5.1f}x smaller)")
+
+
+if __name__ == "__main__":
+    main()
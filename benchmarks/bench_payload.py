@@ -0,0 +1,77 @@
+# dashboard_project/benchmarks/bench_payload.py
+"""
+Measures callback payload size and serialization time for the ACS table and stats charts:
+full-precision vs rounded values (pages.acs_data.round_for_display), json vs orjson engine.
+
+Run from the project root (uses the same DB_* environment variables as the app):
+    python -m benchmarks.bench_payload
+    python -m benchmarks.bench_payload --year 2022 --page-size 100 --variable median_income
+"""
+import argparse
+import time
+
+import plotly.express as px
+from plotly.io.json import to_json_plotly
+
+import app # noqa: F401  创建 Dash 应用后才能导入页面模块 (dash.register_page)
+from utils.db_utils import fetch_data, close_db_resources
+from pages.acs_data import DEFAULT_SELECTED_COLUMNS, display_decimals, round_for_display
+
+try:
+    import orjson # noqa: F401
+    ENGINES = ("json", "orjson")
+except ImportError:
+    ENGINES = ("json",)
+
+
+def measure(payload, engine, repeat):
+    """Returns (bytes, best milliseconds) of serializing payload the way Dash does."""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        text = to_json_plotly(payload, engine=engine)
+        best = min(best, time.perf_counter() - started)
+    return len(text.encode("utf-8")), best * 1000
+
+
+def report(name, variants, repeat):
+    print(f"\n{name}")
+    baseline = None
+    for label, payload in variants:
+        for engine in ENGINES:
+            nbytes, ms = measure(payload, engine, repeat)
+            baseline = baseline or nbytes
+            print(f"  {label:<12} {engine:<7} {nbytes:>10,} bytes ({100 * (1 - nbytes / baseline):5.1f}% saved) {ms:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark callback payload encoding.")
+    parser.add_argument("--year", type=int, default=None, help="Year for the chart data (default: latest)")
+    parser.add_argument("--page-size", type=int, default=15, help="DataTable rows per page")
+    parser.add_argument("--variable", default="pct_below_poverty", help="Variable for the stats charts")
+    parser.add_argument("--columns", default=",".join(DEFAULT_SELECTED_COLUMNS),
+                        help="Comma-separated DataTable columns (default: the page's default selection)")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per variant; the best time is reported")
+    args = parser.parse_args()
+
+    columns_sql = ", ".join(f'"{col}"' for col in args.columns.split(","))
+    df_page = fetch_data(f'SELECT {columns_sql} FROM public.acs_data_all ORDER BY "year" DESC, "state", "zipcode" LIMIT %s',
+                         [args.page_size])
+    report(f"DataTable page ({len(df_page)} rows x {len(df_page.columns)} columns)", [
+        ("full", df_page.to_dict("records")),
+        ("rounded", round_for_display(df_page).to_dict("records")),
+    ], args.repeat)
+
+    year = args.year or int(fetch_data("SELECT MAX(year) FROM public.acs_data_all").iloc[0, 0])
+    df_values = fetch_data(f'SELECT "{args.variable}" AS value_to_map FROM public.acs_data_all '
+                           f'WHERE year = %s AND "{args.variable}" IS NOT NULL', [year])
+    rounded = df_values.assign(value_to_map=df_values["value_to_map"].round(display_decimals(args.variable)))
+    report(f"Stats histogram + box ({len(df_values)} values of {args.variable}, {year})", [
+        ("full", [px.histogram(df_values, x="value_to_map", nbins=30, marginal="rug"), px.box(df_values, y="value_to_map")]),
+        ("rounded", [px.histogram(rounded, x="value_to_map", nbins=30, marginal="rug"), px.box(rounded, y="value_to_map")]),
+    ], args.repeat)
+    close_db_resources()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# dashboard_project/benchmarks/synthetic_zcta.py
+"""
+Synthetic ZCTA-like GeoJSON for the geometry benchmarks, for machines without the real
+Census file: a grid of jagged cells whose neighbours share their boundary points exactly
+(as real ZCTAs do, so the shared-arc topology has something to find). The codes are fake
+(C0000, C0001, ...) and match no row of acs_data_all.
+
+Never write it to ZCTA_GEOJSON_PATH: the app would serve it as the real map. By default the
+file goes to a new temporary directory:
+    python -m benchmarks.synthetic_zcta
+    python -m benchmarks.synthetic_zcta --features 10000 --points 40 --out /tmp/zcta
+"""
+import argparse
+import json
+import math
+import os
+import tempfile
+
+from utils.geometry import ZCTA_PROPERTY
+
+CELL_DEGREES = 0.2
+JITTER_DEGREES = 0.006
+
+
+def _edge(x0, y0, x1, y1, points):
+    """Points of a cell edge, jittered across it; depends only on the endpoints, so neighbours agree."""
+    coords = []
+    for i in range(points):
+        t = i / points
+        x, y = x0 + (x1 - x0) * t, y0 + (y1 - y0) * t
+        if i: # 角点不偏移
+            offset = JITTER_DEGREES * math.sin(x * 7919.0 + y * 104729.0)
+            x, y = (x, y + offset) if y0 == y1 else (x + offset, y)
+        coords.append([round(x, 6), round(y, 6)])
+    return coords
+
+
+def synthetic_features(count=2400, points=32, origin=(-122.0, 36.0)):
+    """
+    Grid of `count` Polygon features, `points` boundary points per cell edge.
+
+    Returns:
+        list: GeoJSON features with ZCTA_PROPERTY set to C0000, C0001, ...
+    """
+    columns = math.ceil(math.sqrt(count))
+    features = []
+    for n in range(count):
+        column, row = n % columns, n // columns
+        # 角点都由网格下标算出，相邻单元的共享边界点完全相同
+        x0, x1 = origin[0] + column * CELL_DEGREES, origin[0] + (column + 1) * CELL_DEGREES
+        y0, y1 = origin[1] - row * CELL_DEGREES, origin[1] - (row + 1) * CELL_DEGREES
+        # 逆时针：下边、右边、上边、左边；上边和左边按相邻单元的方向生成后反转
+        ring = (_edge(x0, y1, x1, y1, points) + _edge(x1, y1, x1, y0, points) + [[round(x1, 6), round(y0, 6)]]
+                + _edge(x0, y0, x1, y0, points)[::-1] + _edge(x0, y1, x0, y0, points)[::-1])
+        code = f"C{n:04d}"
+        features.append({"type": "Feature", "properties": {ZCTA_PROPERTY: code, "GEOID20": code, "ALAND20": 1000 + n},
+                         "geometry": {"type": "Polygon", "coordinates": [ring]}})
+    return features
+
+
+def write_synthetic_geojson(path, count=2400, points=32):
+    """Writes synthetic_features() as a FeatureCollection to `path`; returns the path."""
+    with open(path, 'w') as f:
+        json.dump({"type": "FeatureCollection", "features": synthetic_features(count, points)}, f, separators=(",", ":"))
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic ZCTA-like GeoJSON for the geometry benchmarks.")
+    parser.add_argument("--features", type=int, default=2400, help="Number of grid cells")
+    parser.add_argument("--points", type=int, default=32, help="Boundary points per cell edge")
+    parser.add_argument("--out", default=None, help="Output directory (default: a new temporary directory)")
+    args = parser.parse_args()
+    out_dir = args.out or tempfile.mkdtemp(prefix="zcta_synthetic_")
+    os.makedirs(out_dir, exist_ok=True)
+    path = write_synthetic_geojson(os.path.join(out_dir, "zcta_synthetic.json"), args.features, args.points)
+    print(f"Wrote {path} ({args.features} features, {os.path.getsize(path) / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
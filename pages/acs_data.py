@@ -1,14 +1,35 @@
 # dashboard_project/pages/acs_data.py
 import dash
-from dash import html, dcc, callback, Input, Output, State, no_update
+from dash import html, dcc, callback, Input, Output, State, ClientsideFunction, no_update
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 import pandas as pd
-from utils.db_utils import fetch_data
+from utils.db_utils import (fetch_data, fetch_data_async, fetch_many, build_filter_clause,
+                            cancel_superseded, estimate_rows, get_dataset_version,
+                            DB_DATASET_VERSION_CHECK_INTERVAL)
+from utils.metrics import Counter
+from utils.table_filters import FilterQueryError
+from utils.acs_export import build_export_url, build_export_artifact
+from utils.geometry import ZCTA_GEOJSON_PATH, load_zcta_index
+from utils.vector_tiles import MAX_TILE_ZOOM, ZCTA_LAYER, tile_url_template
+from utils.acs_queries import (FIXED_DISPLAY_COLUMNS, POSSIBLE_SELECTABLE_COLUMNS, DEFAULT_SELECTED_COLUMNS,
+                               TEXT_COLUMNS, build_datatable_where_clause,
+                               datatable_order_keys, order_by_sql, seek_clause)
 import math
+import numpy as np
+import contextvars
+import functools
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
 from dash import dash_table
 import json
 import os
 import plotly.express as px # <--- 新增 Plotly Express
+import plotly.graph_objects as go
 import copy # For deepcopying GeoJSON
 
 # --- Register Page ---
@@ -24,39 +45,28 @@ dash.register_page(
 # --- Page Specific Layout ---
 # dashboard_project/pages/acs_data.py
 
-# --- 列定义 ---
-ALL_COLUMNS_FROM_SCHEMA = [
-    "id", "state", "county", "city","zipcode", "year", "pct_less_than_9th_grade", "pct_high_school",
-    "pct_bachelor", "pct_master", "pct_high_school_or_higher", "pct_english_speaker",
-    "pct_spanish_speaker", "pct_asian_speaker", "pct_lep", "pct_white", "pct_black",
-    "pct_asian", "pct_non_white", "pct_hispanic", "pct_non_hispanic_white",
-    "pct_non_hispanic_black", "pct_non_hispanic_asian", "pct_minority_population",
-    "pct_infant_toddler", "pct_school_age_children", "pct_young_adults",
-    "pct_working_age_adults", "pct_middle_aged_adults", "pct_senior", "pct_adults",
-    "pct_children", "pct_male", "pct_female", "pct_below_poverty", "pct_unemployed",
-    "pct_employed", "pct_unisured", "pct_isured", "pct_disability", "per_capita_income",
-    "median_income", "population", "pct_receive_public_assistance", "pct_house_with_children",
-    "pct_single_parent_households", "pct_female_headed_households", "pct_foreign_born",
-    "pct_multi_unit_structures", "pct_without_plumbing", "pct_overcrowded_housing",
-    "pct_renter_occupied", "pct_households_without_a_vehicle",
-    "pct_with_access_to_a_vehicle", "commute_time", "pct_work_at_home",
-    "pct_professinal", "pct_service", "lat", "lng", "geom"
-] # 从您的建表语句中获取
-
-FIXED_DISPLAY_COLUMNS = ['id', 'state', 'county', 'city', 'zipcode', 'year'] # 这些列总是显示且不可选
-EXCLUDED_COLUMNS = ['geom', "lat", "lng"] # 这些列不参与选择和显示
-
-# 计算可选列 (从所有列中排除固定列和特定排除列)
-POSSIBLE_SELECTABLE_COLUMNS = sorted([
-    col for col in ALL_COLUMNS_FROM_SCHEMA
-    if col not in FIXED_DISPLAY_COLUMNS and col not in EXCLUDED_COLUMNS
-])
-
-# 初始状态下，“All”被选中，所以默认选中的列是固定列+所有可选列
-DEFAULT_SELECTED_COLUMNS = FIXED_DISPLAY_COLUMNS + POSSIBLE_SELECTABLE_COLUMNS
-
 PAGE_SIZE_DT = 15 # 为DataTable定义页面大小
 
+# --- 显示精度 ---
+# 数据库中的浮点数是全精度的 (例如 0.8277297233056702)，原样放进回调响应会让 JSON 变长却没有显示意义，
+# 因此按列名约定四舍五入后再返回给浏览器。下载的 CSV 仍保留全精度。
+PCT_DECIMALS = 2 # pct_ 开头的百分比列
+INCOME_DECIMALS = 0 # 收入列 (美元)
+DEFAULT_FLOAT_DECIMALS = 3 # 其他浮点列
+
+def display_decimals(column):
+    """按列名约定返回显示时保留的小数位数。"""
+    if column.startswith('pct_'):
+        return PCT_DECIMALS
+    if 'income' in column:
+        return INCOME_DECIMALS
+    return DEFAULT_FLOAT_DECIMALS
+
+def round_for_display(df):
+    """对 DataFrame 的浮点列按 display_decimals() 四舍五入，整数和文本列保持不变。"""
+    decimals = {col: display_decimals(col) for col in df.columns if pd.api.types.is_float_dtype(df[col])}
+    return df.round(decimals) if decimals else df
+
 # --- 地图tab的布局和准备 ---
 # --- 为地图变量下拉菜单准备选项 ---
 MAP_VARIABLE_OPTIONS = []
@@ -82,16 +92,47 @@ else: # Fallback if POSSIBLE_SELECTABLE_COLUMNS is not defined or empty
 
 # Assuming the script is run from the project root (where app.py is)
 # --- 加载 全国 ZCTA GeoJSON 数据 ---
-GEOJSON_US_FILE_PATH = os.path.join("data", "zcta_us_simplify.json") # 新的GeoJSON文件路径
-geojson_us_data = None # 重命名变量以区分
-try:
-    with open(GEOJSON_US_FILE_PATH, 'r') as f:
-        geojson_us_data = json.load(f)
-    print("US ZCTA GeoJSON loaded successfully.")
-except FileNotFoundError:
-    print(f"ERROR: US ZCTA GeoJSON file not found at '{os.path.abspath(GEOJSON_US_FILE_PATH)}'.")
-except json.JSONDecodeError:
-    print(f"ERROR: Could not decode US ZCTA GeoJSON file from '{GEOJSON_US_FILE_PATH}'.")
+GEOJSON_US_FILE_PATH = ZCTA_GEOJSON_PATH # 新的GeoJSON文件路径 (环境变量 ZCTA_GEOJSON_PATH 可覆盖)
+# ZCTA -> feature 的索引，加载时建立一次 (州/县列表随数据集版本更新，见 _ensure_zcta_regions)；
+# 地图渲染只访问所选区域的 feature，不再遍历全国。
+# 与矢量瓦片接口 (utils/vector_tiles.py) 共用同一个索引。存在打包的几何文件
+# (python -m utils.convert_geometry) 时从它加载，否则读取 GEOJSON_US_FILE_PATH。
+zcta_index = load_zcta_index()
+# 选中的 ZCTA 不少于此数量时 (如全国视图)，地图改用矢量瓦片，回调只返回 ZCTA -> 数值；0 表示不使用瓦片
+ACS_MAP_TILES_MIN_FEATURES = int(os.getenv("ACS_MAP_TILES_MIN_FEATURES", "5000"))
+# 细节层级 (python -m utils.build_geometry_lod)：嵌入地图的几何按缩放级别选择化简层级，
+# 并在所选区域的顶点数超过预算时逐级改用更粗的层级
+ACS_MAP_VERTEX_BUDGET = int(os.getenv("ACS_MAP_VERTEX_BUDGET", "300000"))
+# 按 "初始缩放级别 + 该值" 选择层级，放大几级后边界仍不出现明显折角
+ACS_MAP_LOD_ZOOM_HEADROOM = float(os.getenv("ACS_MAP_LOD_ZOOM_HEADROOM", "2"))
+MAP_COLOR_SCALE = "YlOrRd"
+MAP_OPACITY = 0.7
+_zcta_regions_lock = threading.Lock()
+
+def _zcta_regions_current(version):
+    # 版本读取失败 (None) 时继续使用已有的列表
+    return zcta_index.has_regions and (version is None or version == zcta_index.regions_version)
+
+def _ensure_zcta_regions():
+    """
+    从 acs_data_all 读取 zipcode -> 州/县 对应关系，建立每个州/县的 ZCTA 列表。
+    列表按数据集版本记录：ETL 加载新数据 (bump_dataset_version) 后，下一次地图渲染时重新建立。
+    """
+    if zcta_index is None:
+        return
+    # 版本取自进程内按间隔刷新的令牌：数据未变时地图渲染不访问数据库
+    version = get_dataset_version("acs_data_all", max_age=DB_DATASET_VERSION_CHECK_INTERVAL)
+    if _zcta_regions_current(version):
+        return
+    with _zcta_regions_lock:
+        if _zcta_regions_current(version):
+            return
+        # 每个版本只查询一次；不使用查询缓存，避免在本进程发现版本变化之前读到旧结果
+        df_regions = fetch_data(
+            "SELECT DISTINCT zipcode, state, county FROM public.acs_data_all WHERE zipcode IS NOT NULL;",
+            bulk=None, cache=False)
+        if df_regions is not None and not df_regions.empty:
+            zcta_index.set_regions(df_regions, version=version)
 
 
 
@@ -234,11 +275,32 @@ def layout():
                         #     "Download Selected Data (CSV)", id="acs-download-button",
                         #     color="success", className="mt-2 mb-3"
                         # ),
-                        dbc.Button(
-                            "Download Selected Data (CSV)", id="acs-download-button",
-                             className="custom-gradient-button mt-2 mb-3"
-                        ),
-                        dcc.Download(id="acs-download-dataframe"),
+                        # 导出文件由后台任务生成并缓存，完成后显示下载链接 (/download/acs_data.<格式>)
+                        html.Div([
+                            dbc.Button(
+                                "Prepare Download", id="acs-download-button",
+                                className="custom-gradient-button mt-2 mb-3 me-3"
+                            ),
+                            dbc.Button(
+                                "Cancel", id="acs-download-cancel", color="link",
+                                className="mt-2 mb-3 me-3", style={"display": "none"}
+                            ),
+                            # Parquet / Arrow 保留列类型，pandas 读取比 CSV 快得多
+                            dbc.RadioItems(
+                                id="acs-download-format",
+                                options=[
+                                    {"label": "CSV", "value": "csv"},
+                                    {"label": "CSV (gzip)", "value": "csv.gz"},
+                                    {"label": "Parquet", "value": "parquet"},
+                                    {"label": "Arrow IPC", "value": "arrow"},
+                                ],
+                                value="csv", inline=True,
+                            ),
+                        ], className="d-flex align-items-center"),
+                        dbc.Progress(id="acs-download-progress", value=0, striped=True, animated=True,
+                                     className="mb-2", style={"display": "none"}),
+                        html.Div(id="acs-download-ready", className="mb-3"),
+                        html.Div(id="acs-datatable-filter-error", className="text-danger small mb-2"), # 无法解析的列筛选
                         dbc.Spinner(
                             html.Div( # DataTable 的包裹 Div
                                 dash_table.DataTable(
@@ -246,6 +308,8 @@ def layout():
                                     # columns, data 等将由回调填充
                                     page_action='custom', page_current=0, page_size=PAGE_SIZE_DT,
                                     sort_action='custom', sort_mode='multi', sort_by=[],
+                                    # 列筛选在数据库中执行 (例如 pct_below_poverty 列输入 "> 30")
+                                    filter_action='custom', filter_query='',
                                     style_table={'overflowX': 'auto'},
                                     style_cell={
                                         'minWidth': '100px', 'width': '150px', 'maxWidth': '180px',
@@ -288,9 +352,18 @@ def layout():
 
     return dbc.Container(
         [
+            # 每个浏览器标签页一个会话ID（sessionStorage 中已有值时沿用），用于取消同一会话中被新请求取代的查询
+            dcc.Store(id='acs-session-id', storage_type='session', data=str(uuid.uuid4())),
             dcc.Store(id='acs-selected-columns-store', data=DEFAULT_SELECTED_COLUMNS),
+            # DataTable 当前页的首/尾排序键，用于 keyset 翻页 (每个会话各自保存)
+            dcc.Store(id='acs-datatable-cursor', storage_type='session'),
             # applied-filters-store 的初始值需要更新，将 'cities' 键改为 'counties'
             dcc.Store(id='applied-filters-store', data={'years': [], 'states': [], 'counties': []}),
+            # 地图：ZCTA -> 数值 (每次渲染)、几何 (浏览器没有缓存时才发送)、浏览器已缓存的几何签名、当前显示的地图
+            dcc.Store(id='acs-map-values'),
+            dcc.Store(id='acs-map-geometry'),
+            dcc.Store(id='acs-map-geometry-cached', data=[]),
+            dcc.Store(id='acs-map-view'),
             dcc.Store(id='map-applied-filters-store', data={
                 'year': None, # Or latest year by default
                 'states': [],
@@ -319,7 +392,7 @@ def populate_state_dropdown_options(active_tab):
     if active_tab == 'acs-tab-data-table':
         try:
             # 改用新的表名 acs_data_all
-            df_states = fetch_data("SELECT DISTINCT state FROM public.acs_data_all WHERE state IS NOT NULL ORDER BY state;")
+            df_states = fetch_data("SELECT DISTINCT state FROM public.acs_data_all WHERE state IS NOT NULL ORDER BY state;", cache=True)
             if df_states is not None and not df_states.empty:
                 return [{'label': str(s), 'value': str(s)} for s in df_states['state']]
         except Exception as e:
@@ -336,16 +409,14 @@ def populate_county_dropdown_options(active_tab, selected_states): # 函数名
         try:
             # 查询 county 列，表名为 acs_data_all
             query = "SELECT DISTINCT county FROM public.acs_data_all WHERE county IS NOT NULL"
+            params = []
             if selected_states:
-                safe_states_tuple = tuple(str(s).replace("'", "''") for s in selected_states)
-                if len(safe_states_tuple) == 1:
-                    query += f" AND state = '{safe_states_tuple[0]}'"
-                else:
-                    query += f" AND state IN {str(safe_states_tuple)}"
+                query += " AND state = ANY(%s)"
+                params.append([str(s) for s in selected_states])
 
             query += " ORDER BY county LIMIT 1000;" # 限制数量，或者您可以移除LIMIT
 
-            df_counties = fetch_data(query) # 修改变量名
+            df_counties = fetch_data(query, params, cache=True) # 修改变量名
             if df_counties is not None and not df_counties.empty:
                 return [{'label': str(c), 'value': str(c)} for c in df_counties['county']]
         except Exception as e:
@@ -429,134 +500,322 @@ def update_stores_on_apply(n_clicks,
 
     return final_columns_for_store, filters_data
 
-# --- 辅助函数：构建WHERE子句 ---
-def build_where_clause(filters_dict):
-    conditions = ["1=1"] # 始终为真，方便后续AND连接
-    # params = {} # 如果使用参数化查询
-
-    if filters_dict.get('years'):
-        year_list = filters_dict['years']
-        if year_list:
-            year_tuple = tuple(map(int, year_list)) # 年份是整数
-            if len(year_tuple) == 1:
-                conditions.append(f"\"year\" = {year_tuple[0]}")
-            else:
-                conditions.append(f"\"year\" IN {year_tuple}")
-    
-    if filters_dict.get('states'):
-        state_list = filters_dict['states']
-        if state_list:
-            # 对字符串列表进行处理以适配SQL IN子句，并做基本SQL注入防范
-            safe_state_list = [str(s).replace("'", "''") for s in state_list]
-            state_tuple_sql = "('" + "', '".join(safe_state_list) + "')"
-            conditions.append(f"\"state\" IN {state_tuple_sql}")
-
-    # --- 将 City 筛选逻辑修改为 County ---
-    if filters_dict.get('counties'): # 键名修改
-        county_list = filters_dict['counties'] # 变量名修改
-        if county_list:
-            safe_county_list = [str(c).replace("'", "''") for c in county_list] # 变量名修改
-            county_tuple_sql = "('" + "', '".join(safe_county_list) + "')" # 变量名修改
-            conditions.append(f"\"county\" IN {county_tuple_sql}") # SQL列名修改
-            
-    return " AND ".join(conditions)
+# --- 辅助装饰器：取消同一会话中被新调用取代的查询 ---
+# 当前回调所属的会话ID (由 supersedes_previous_queries 设置)
+_callback_session_id = contextvars.ContextVar('acs_callback_session_id', default=None)
+
+def supersedes_previous_queries(func):
+    """
+    用于回调函数：回调的最后一个参数必须是 State('acs-session-id', 'data')。
+    同一会话再次触发该回调时（例如连续点击 "Update Map" 或快速翻页），
+    旧调用仍在数据库中执行的查询会被取消，旧调用的结果也不再更新页面 (PreventUpdate)。
+    回调内可通过 _callback_session_id.get() 取得会话ID。
+    """
+    @functools.wraps(func)
+    def wrapper(*args):
+        *callback_args, session_id = args
+        if not session_id:
+            return func(*callback_args)
+        token = _callback_session_id.set(session_id)
+        try:
+            with cancel_superseded((session_id, func.__name__)) as invocation:
+                result = func(*callback_args)
+        finally:
+            _callback_session_id.reset(token)
+        if invocation.superseded:
+            raise PreventUpdate
+        return result
+    return wrapper
+
+# --- 辅助函数：DataTable 的 keyset 翻页 (排序表达式和 keyset 条件见 utils/acs_queries.py) ---
+def _datatable_page_query(select_sql, where_clause, where_params, keys, limit, offset=0, seek_from=None, reverse=False):
+    """构建一页数据的查询：seek_from 为排序键时按 keyset 定位，否则用 OFFSET。"""
+    conditions, params = [where_clause], list(where_params)
+    if seek_from is not None:
+        seek_sql, seek_params = seek_clause(keys, seek_from, reverse)
+        conditions.append(seek_sql)
+        params += seek_params
+    query = f"""
+        SELECT {select_sql}
+        FROM public.acs_data_all
+        WHERE {" AND ".join(conditions)}
+        {order_by_sql(keys, reverse)}
+        LIMIT %s OFFSET %s;
+    """
+    return query, params + [int(limit), int(offset)]
+
+def _row_key(row, keys):
+    """DataFrame 一行的排序键，转换为可 JSON 序列化的 Python 值 (NaN -> None)。"""
+    values = []
+    for col, _ in keys:
+        value = row[col]
+        value = None if pd.isna(value) else value
+        values.append(value.item() if hasattr(value, 'item') else value)
+    return values
+
+# --- 辅助函数：DataTable 总行数 ---
+# 总行数只随筛选条件变化：所有计数查询都走查询缓存 (按 SQL + 参数，即筛选签名)，翻页/排序不会重新计数。
+# ETL 维护的 (year, state, county) 预聚合表可直接汇总出任意年份/州/县筛选的精确行数。
+ACS_ROW_COUNTS_TABLE = "public.acs_data_all_row_counts"
+# >0 时：没有预聚合表且规划器估算超过该行数，直接用估算值作为总行数，不再 COUNT(*) 全表
+ACS_EXACT_COUNT_MAX_ROWS = int(os.getenv("ACS_EXACT_COUNT_MAX_ROWS", "0"))
+
+def _row_counts_table_available():
+    df = fetch_data("SELECT to_regclass(%s) IS NOT NULL AS available;", [ACS_ROW_COUNTS_TABLE], cache=True)
+    return bool(df.iloc[0, 0]) if not df.empty else False
+
+def _datatable_count_request(where_clause, where_params, has_column_filter=False):
+    """
+    选择总行数的来源，返回 (fetch_data 参数 dict 或 None, 估算行数或 None)：
+    优先汇总预聚合计数表 (仅当只按年份/州/县筛选时)；否则大结果集用规划器估算 (不执行查询)；
+    其余情况精确 COUNT(*)。
+    """
+    if not has_column_filter and _row_counts_table_available():
+        query = f"SELECT COALESCE(SUM(row_count), 0) FROM {ACS_ROW_COUNTS_TABLE} WHERE {where_clause};"
+        return {'query': query, 'params': where_params, 'cache': True}, None
+    if ACS_EXACT_COUNT_MAX_ROWS > 0:
+        estimate = estimate_rows(f"SELECT 1 FROM public.acs_data_all WHERE {where_clause}", where_params)
+        if estimate is not None and estimate > ACS_EXACT_COUNT_MAX_ROWS:
+            return None, int(estimate)
+    query = f"SELECT COUNT(*) FROM public.acs_data_all WHERE {where_clause};"
+    return {'query': query, 'params': where_params, 'cache': True}, None
+
+# --- 辅助函数：DataTable 相邻页预取 ---
+# 返回第 N 页后，在后台按 keyset 预先查询第 N+1 / N-1 页，放入每个会话的小缓存；
+# 顺序翻页时下一次点击直接从内存返回。缓存条目是 Future，预取尚未完成时等待它而不是重复查询。
+PREFETCH_MAX_SESSIONS = 256 # 最多为多少个会话保留预取页 (LRU)
+PREFETCH_PAGES_PER_SESSION = 4 # 每个会话保留的页数 (当前页及其前后页)
+PREFETCH_TTL = 120 # 预取页的有效秒数，之后重新查询以反映新数据
+PREFETCH_REQUESTS = Counter("dashboard_datatable_prefetch_total", "DataTable page requests by prefetch cache result.", ("result",))
+_prefetched_pages = OrderedDict() # 会话ID -> OrderedDict(页键 -> (Future, 是否反向, 创建时间))；页键含数据集版本
+_prefetch_lock = threading.Lock()
+
+def _store_page(session_id, page_key, future, reverse=False):
+    """把一页 (或正在查询的一页) 放入会话的预取缓存，并按 LRU 控制会话数和每个会话的页数。"""
+    with _prefetch_lock:
+        pages = _prefetched_pages.get(session_id)
+        if pages is None:
+            pages = _prefetched_pages[session_id] = OrderedDict()
+        _prefetched_pages.move_to_end(session_id)
+        pages[page_key] = (future, reverse, time.monotonic())
+        pages.move_to_end(page_key)
+        while len(pages) > PREFETCH_PAGES_PER_SESSION:
+            pages.popitem(last=False)
+        while len(_prefetched_pages) > PREFETCH_MAX_SESSIONS:
+            _prefetched_pages.popitem(last=False)
+
+def _prefetch_page(session_id, page_key, query, params, reverse):
+    """后台查询一页，已缓存 (或正在预取) 的页不会重复查询。"""
+    with _prefetch_lock:
+        entry = _prefetched_pages.get(session_id, {}).get(page_key)
+    if entry is not None and time.monotonic() - entry[2] <= PREFETCH_TTL:
+        return
+    _store_page(session_id, page_key, fetch_data_async(query, params, label="datatable_prefetch"), reverse)
+
+def _get_prefetched_page(session_id, page_key):
+    """返回缓存中的一页 (按显示顺序)，没有或已过期时返回 None。"""
+    with _prefetch_lock:
+        pages = _prefetched_pages.get(session_id)
+        entry = pages.get(page_key) if pages is not None else None
+        if entry is not None:
+            pages.move_to_end(page_key)
+    if entry is None or time.monotonic() - entry[2] > PREFETCH_TTL:
+        PREFETCH_REQUESTS.inc(result="miss")
+        return None
+    future, reverse, _ = entry
+    df = future.result()
+    if df is None or df.empty:
+        PREFETCH_REQUESTS.inc(result="miss")
+        return None
+    PREFETCH_REQUESTS.inc(result="hit")
+    return df.iloc[::-1] if reverse else df
+
+DATATABLE_FILTER_ERRORS = Counter("dashboard_datatable_filter_errors_total", "DataTable column filters that could not be compiled to SQL.")
 
 # 回调3: 更新 DataTable (监听列选择、分页、排序、标签页激活)
 # --- 更新 DataTable 的回调 ---
 @callback(
     [Output('acs-datatable', 'data'),
      Output('acs-datatable', 'page_count'),
-     Output('acs-datatable', 'columns')],
+     Output('acs-datatable', 'columns'),
+     Output('acs-datatable-cursor', 'data'),
+     Output('acs-datatable-filter-error', 'children')],
     [Input('acs-page-tabs', 'active_tab'),
      Input('acs-datatable', 'page_current'),
      Input('acs-datatable', 'page_size'),
      Input('acs-datatable', 'sort_by'),
      Input('acs-selected-columns-store', 'data'), # 列选择
-     Input('applied-filters-store', 'data')]      # 新增：筛选条件
+     Input('applied-filters-store', 'data'),      # 新增：筛选条件
+     Input('acs-datatable', 'filter_query')],     # 列筛选
+    [State('acs-datatable-cursor', 'data'),
+     State('acs-session-id', 'data')]
 )
+@supersedes_previous_queries
 def update_datatable_data(active_tab_id, page_current, page_size, sort_by, 
-                          selected_columns_from_store, applied_filters):
+                          selected_columns_from_store, applied_filters, filter_query, cursor):
     # ... (selected_columns 和 datatable_columns 的处理与之前类似) ...
     selected_columns = selected_columns_from_store if selected_columns_from_store else DEFAULT_SELECTED_COLUMNS
-    datatable_columns = [{"name": col.replace("pct_", "% ").replace("_", " ").title(), "id": col} for col in selected_columns]
+    datatable_columns = [{"name": col.replace("pct_", "% ").replace("_", " ").title(), "id": col,
+                          "type": "text" if col in TEXT_COLUMNS else "numeric"} for col in selected_columns]
 
     if active_tab_id != "acs-tab-data-table":
-        return [], 1, datatable_columns
+        return [], 1, datatable_columns, no_update, no_update
 
     current_filters = applied_filters if applied_filters else {}
     # print(f"DEBUG: Applied filters received by DataTable callback: {current_filters}") # 打印应用的筛选器
-    # 构建 WHERE 子句
-    where_clause = build_where_clause(applied_filters if applied_filters else {})
-
-    # 1. 获取总行数 (基于筛选条件)
-    count_query = f"SELECT COUNT(*) FROM public.acs_data_all WHERE {where_clause};"
-
-    # print(f"DEBUG: DataTable COUNT Query SQL: {count_query}") # <--- 打印COUNT查询
-
-    df_count = fetch_data(count_query)
+    # 构建 WHERE 子句 (年份/州/县 + 列筛选)；无法解析的列筛选不能忽略，否则会显示全部行
+    try:
+        where_clause, where_params, has_column_filter = build_datatable_where_clause(current_filters, filter_query)
+    except FilterQueryError as e:
+        DATATABLE_FILTER_ERRORS.inc()
+        return [], 1, datatable_columns, None, f"Filter not applied, no rows shown: {e}"
+
+    # 1. 总行数的来源 (预聚合表 / 估算 / COUNT)，结果按筛选条件缓存
+    count_request, estimated_rows = _datatable_count_request(where_clause, where_params, has_column_filter)
+
+    # 2. 排序键 (排序列 + id)；不在所选列中的键列也要查出来，用于记录翻页位置
+    keys = datatable_order_keys(sort_by, selected_columns)
+    display_columns = selected_columns if selected_columns else FIXED_DISPLAY_COLUMNS
+    query_columns = display_columns + [col for col, _ in keys if col not in display_columns]
+    select_sql = ", ".join([f'"{col}"' for col in query_columns])
+    page_size = int(page_size) if page_size else PAGE_SIZE_DT
+    # 筛选、排序、页大小或数据集版本变化后，旧的翻页位置失效；签名也是预取页键的一部分，
+    # ETL 重新加载后不会再返回加载前预取的页。版本取自进程内按间隔刷新的令牌，翻页不为此访问数据库
+    dataset_version = get_dataset_version("acs_data_all", max_age=DB_DATASET_VERSION_CHECK_INTERVAL)
+    signature = hashlib.md5(json.dumps([where_clause, where_params, keys, page_size, dataset_version],
+                                       default=str).encode()).hexdigest()
+
+    page_current = max(0, page_current or 0)
+    seek_from, reverse = None, False
+    if cursor and cursor.get('signature') == signature:
+        if page_current == cursor['page'] + 1:
+            seek_from = cursor['last'] # 下一页：从上一页最后一行之后开始
+        elif page_current == cursor['page'] - 1:
+            seek_from, reverse = cursor['first'], True # 上一页：反向取当前页第一行之前的行
+
+    count_requests = [count_request] if count_request else []
+    session_id = _callback_session_id.get()
+    df_page_data = None
+    if session_id:
+        df_page_data = _get_prefetched_page(session_id, (signature, select_sql, page_current))
+    if df_page_data is not None:
+        # 预取命中：只剩总行数 (通常来自查询缓存)
+        reverse = False
+        df_counts = [fetch_data(**request) for request in count_requests]
+    elif page_current == 0 or seek_from is not None:
+        # 不依赖总行数，COUNT 和当前页数据并发执行
+        df_page_data, *df_counts = fetch_many([
+            _datatable_page_query(select_sql, where_clause, where_params, keys, page_size,
+                                  seek_from=seek_from, reverse=reverse),
+        ] + count_requests)
+    else:
+        df_page_data, df_counts = None, [fetch_data(**request) for request in count_requests]
     # ... (处理 df_count 为空或 total_rows 为0的情况，与之前类似) ...
-    total_rows = df_count.iloc[0,0] if df_count is not None and not df_count.empty else 0
+    if estimated_rows is not None:
+        total_rows = estimated_rows
+    else:
+        total_rows = int(df_counts[0].iloc[0,0]) if df_counts and not df_counts[0].empty else 0
     if total_rows == 0:
-        return [], 1, datatable_columns
+        return [], 1, datatable_columns, None, None
 
     page_count = math.ceil(total_rows / page_size) if page_size > 0 else 1
-    page_current = max(0, min(page_current, page_count - 1 if page_count > 0 else 0))
-    offset = page_current * page_size
-
-    # 2. 构建数据查询SQL (包括排序、分页和筛选)
-    order_by_clause = "ORDER BY \"year\" DESC, \"state\" ASC, \"zipcode\" ASC" # 默认
-    if sort_by: # 处理排序
-        orders = [f'"{s_col["column_id"]}" {"DESC" if s_col["direction"] == "desc" else "ASC"}' 
-                  for s_col in sort_by if s_col["column_id"] in selected_columns]
-        if orders: order_by_clause = "ORDER BY " + ", ".join(orders)
-    
-    safe_selected_columns_sql = ", ".join([f'"{col}"' for col in selected_columns])
-    if not safe_selected_columns_sql: safe_selected_columns_sql = ", ".join([f'"{col}"' for col in FIXED_DISPLAY_COLUMNS])
-
-    data_query = f"""
-        SELECT {safe_selected_columns_sql}
-        FROM public.acs_data_all
-        WHERE {where_clause}
-        {order_by_clause}
-        LIMIT {page_size} OFFSET {offset};
-    """
-    # print(f"DEBUG: DataTable DATA Query SQL: {data_query}") # <--- 打印数据获取查询
-    df_page_data = fetch_data(data_query)
+    if page_current > page_count - 1: # 筛选后页数变少，当前页越界时回退到最后一页
+        page_current, df_page_data = page_count - 1, None
+    if df_page_data is None or (df_page_data.empty and page_current > 0):
+        if page_current == page_count - 1 and estimated_rows is None:
+            # 末页：反向排序取最后几行，同样不需要 OFFSET (需要精确总行数)
+            query, params = _datatable_page_query(select_sql, where_clause, where_params, keys,
+                                                  total_rows - page_current * page_size, reverse=True)
+            reverse = True
+        else:
+            # 任意跳页：回退到 OFFSET
+            query, params = _datatable_page_query(select_sql, where_clause, where_params, keys,
+                                                  page_size, offset=page_current * page_size)
+            reverse = False
+        df_page_data = fetch_data(query, params)
+    if df_page_data is None or df_page_data.empty:
+        return [], page_count, datatable_columns, None, None
+    if reverse:
+        df_page_data = df_page_data.iloc[::-1]
+
+    new_cursor = {
+        'signature': signature, 'page': page_current,
+        'first': _row_key(df_page_data.iloc[0], keys), 'last': _row_key(df_page_data.iloc[-1], keys),
+    }
+    if session_id:
+        # 当前页留在缓存里 (返回上一页时直接命中)，并在后台预取前后两页
+        served = Future()
+        served.set_result(df_page_data)
+        _store_page(session_id, (signature, select_sql, page_current), served)
+        if page_current + 1 < page_count:
+            _prefetch_page(session_id, (signature, select_sql, page_current + 1),
+                           *_datatable_page_query(select_sql, where_clause, where_params, keys, page_size,
+                                                  seek_from=new_cursor['last']), reverse=False)
+        if page_current > 0:
+            _prefetch_page(session_id, (signature, select_sql, page_current - 1),
+                           *_datatable_page_query(select_sql, where_clause, where_params, keys, page_size,
+                                                  seek_from=new_cursor['first'], reverse=True), reverse=True)
     # ... (处理 df_page_data 和返回 data_for_datatable, page_count, datatable_columns) ...
-    data_for_datatable = df_page_data.to_dict('records') if df_page_data is not None and not df_page_data.empty else []
-    return data_for_datatable, page_count, datatable_columns
+    data_for_datatable = round_for_display(df_page_data[display_columns]).to_dict('records')
+    return data_for_datatable, page_count, datatable_columns, new_cursor, None
 
-# 回调4: 下载数据 (监听下载按钮和选择的列)
-# --- 下载数据的回调 ---
+# 回调4: 导出任务 (点击按钮后在后台进程中生成文件，显示进度，完成后给出下载链接)
+# --- 结果按 (格式, 列, 筛选, 数据集版本) 缓存在磁盘上，相同的导出再次请求时立即完成 ---
 @callback(
-    Output("acs-download-dataframe", "data"),
+    Output("acs-download-ready", "children"),
     [Input("acs-download-button", "n_clicks")],
     [State("acs-selected-columns-store", "data"),
-     State("applied-filters-store", "data")], # 新增 State
+     State("applied-filters-store", "data"),
+     State("acs-datatable", "filter_query"), # 只导出符合列筛选的行
+     State("acs-download-format", "value")],
+    background=True,
+    running=[
+        (Output("acs-download-button", "disabled"), True, False),
+        (Output("acs-download-cancel", "style"), {}, {"display": "none"}),
+        (Output("acs-download-progress", "style"), {}, {"display": "none"}),
+    ],
+    progress=[Output("acs-download-progress", "value"), Output("acs-download-progress", "label")],
+    cancel=[Input("acs-download-cancel", "n_clicks")],
     prevent_initial_call=True,
 )
-def download_acs_dataset(n_clicks, selected_columns_for_download, applied_filters_for_download):
-    if not n_clicks: return dash.no_update
-
+def prepare_acs_download(set_progress, n_clicks, selected_columns_for_download, applied_filters_for_download,
+                         filter_query, download_format):
+    if not n_clicks: raise PreventUpdate
     columns_to_download = selected_columns_for_download if selected_columns_for_download else DEFAULT_SELECTED_COLUMNS
-    safe_columns_sql = ", ".join([f'"{col}"' for col in columns_to_download])
-    if not safe_columns_sql: return dash.no_update
+    download_format = download_format or "csv"
+    export_format, compress = download_format.split(".")[0], download_format.endswith(".gz")
+    filters_dict = applied_filters_for_download or {}
 
-    where_clause_download = build_where_clause(applied_filters_for_download if applied_filters_for_download else {})
+    def report(rows_written, total_rows):
+        percent = min(100, int(100 * rows_written / total_rows)) if total_rows else 100
+        set_progress((percent, f"{rows_written:,} / {total_rows:,} rows"))
 
-    query_all_data = f"""
-        SELECT {safe_columns_sql}
-        FROM public.acs_data_all
-        WHERE {where_clause_download}
-        ORDER BY "year" DESC, "state" ASC, "zipcode" ASC;
-    """
-    df_all_data = fetch_data(query_all_data)
-    # ... (处理 df_all_data 为空的情况) ...
-    if df_all_data is None or df_all_data.empty:
-        print("Download: No data to download.")
-        return dash.no_update # 或者可以下载一个空文件或提示信息
-
-    return dcc.send_data_frame(df_all_data.to_csv, f"acs_filtered_data.csv", index=False)
+    set_progress((0, ""))
+    try:
+        artifact = build_export_artifact(columns_to_download, filters_dict, filter_query,
+                                         export_format=export_format, compress=compress, progress=report)
+    except FilterQueryError as e:
+        return html.Span(f"Cannot export with this column filter: {e}", className="text-danger")
+    if artifact is None:
+        return html.Span("Export failed, please try again.", className="text-danger")
+    href = build_export_url(filters_dict, filter_query, columns_to_download,
+                            export_format=export_format, compress=compress)
+    size_kb = artifact['bytes'] / 1024
+    size_text = f"{size_kb / 1024:.1f} MB" if size_kb >= 1024 else f"{size_kb:.0f} KB"
+    return dbc.Button(f"Download {download_format.upper()} ({size_text})", href=href, external_link=True,
+                      color="success", size="sm")
+
+# 筛选条件、所选列或格式变化后，已生成的下载链接不再对应当前选择
+@callback(
+    Output("acs-download-ready", "children", allow_duplicate=True),
+    [Input("acs-selected-columns-store", "data"),
+     Input("applied-filters-store", "data"),
+     Input("acs-datatable", "filter_query"),
+     Input("acs-download-format", "value")],
+    prevent_initial_call=True,
+)
+def clear_download_link(*_):
+    return None
 
 # Populate Year dropdown for Map
 @callback(
@@ -568,7 +827,7 @@ def populate_map_year_dropdown(active_tab):
     if active_tab == "acs-tab-map-viz": # Only populate if relevant tab is active or about to be
         try:
             # Fetch distinct years from the new table
-            df_years = fetch_data("SELECT DISTINCT year FROM public.acs_data_all ORDER BY year DESC;")
+            df_years = fetch_data("SELECT DISTINCT year FROM public.acs_data_all ORDER BY year DESC;", cache=True)
             if df_years is not None and not df_years.empty:
                 years = df_years['year'].tolist()
                 options = [{'label': str(y), 'value': y} for y in years]
@@ -586,7 +845,7 @@ def populate_map_year_dropdown(active_tab):
 def populate_map_state_dropdown(active_tab):
     if active_tab == "acs-tab-map-viz":
         try:
-            df_states = fetch_data("SELECT DISTINCT state FROM public.acs_data_all WHERE state IS NOT NULL ORDER BY state;")
+            df_states = fetch_data("SELECT DISTINCT state FROM public.acs_data_all WHERE state IS NOT NULL ORDER BY state;", cache=True)
             if df_states is not None and not df_states.empty:
                 return [{'label': str(s), 'value': str(s)} for s in df_states['state']]
         except Exception as e:
@@ -605,11 +864,10 @@ def populate_map_county_dropdown(selected_states, active_tab):
         return [], [] # No states selected, or tab not active, so no county options / clear selection
 
     try:
-        # Ensure selected_states is a list of strings, suitable for SQL IN clause
-        safe_states_sql_tuple = "('" + "', '".join([str(s).replace("'", "''") for s in selected_states]) + "')"
-        query = f"SELECT DISTINCT county FROM public.acs_data_all WHERE county IS NOT NULL AND state IN {safe_states_sql_tuple} ORDER BY county LIMIT 1000;"
+        # selected_states 作为数组参数绑定到 ANY(%s)
+        query = "SELECT DISTINCT county FROM public.acs_data_all WHERE county IS NOT NULL AND state = ANY(%s) ORDER BY county LIMIT 1000;"
         
-        df_counties = fetch_data(query)
+        df_counties = fetch_data(query, [[str(s) for s in selected_states]], cache=True)
         if df_counties is not None and not df_counties.empty:
             options = [{'label': str(c), 'value': str(c)} for c in df_counties['county']]
             return options, [] # Return options and reset selected counties
@@ -641,42 +899,16 @@ def store_map_filters_on_apply(n_clicks, year, variable, states, counties):
 
 
 # 计算 center zoom level
-def calculate_map_view_from_geojson(geojson_features):
+DEFAULT_MAP_VIEW = ({"lat": 39.8283, "lon": -98.5795}, 3) # 美国大陆
+
+def calculate_map_view_from_extent(extent):
     """
-    根据 GeoJSON feature 列表计算地图的中心点和合适的缩放级别。
+    根据外接矩形 (min_lon, min_lat, max_lon, max_lat) 计算地图的中心点和合适的缩放级别。
+    extent 为 None 时返回美国大陆的默认视图。
     """
-    if not geojson_features: # 如果没有地理特征，返回美国大陆的默认视图
-        return {"lat": 39.8283, "lon": -98.5795}, 3
-
-    all_lons = []
-    all_lats = []
-
-    def extract_coords_from_geometry(geometry):
-        geom_type = geometry['type']
-        coords = geometry['coordinates']
-        if geom_type == 'Polygon':
-            # coords 是环的列表，第一个环是外环
-            for lon, lat in coords[0]:
-                all_lons.append(lon)
-                all_lats.append(lat)
-        elif geom_type == 'MultiPolygon':
-            # coords 是多边形列表，每个多边形又包含环的列表
-            for polygon in coords:
-                if polygon and polygon[0]: # 确保多边形和外环存在
-                    for lon, lat in polygon[0]:
-                        all_lons.append(lon)
-                        all_lats.append(lat)
-        # 可以根据需要添加对 Point, LineString 等其他几何类型的处理
-
-    for feature in geojson_features:
-        if 'geometry' in feature and feature['geometry']:
-            extract_coords_from_geometry(feature['geometry'])
-    
-    if not all_lons or not all_lats: # 如果无法提取任何坐标
-        return {"lat": 39.8283, "lon": -98.5795}, 3
-
-    min_lon, max_lon = min(all_lons), max(all_lons)
-    min_lat, max_lat = min(all_lats), max(all_lats)
+    if extent is None:
+        return DEFAULT_MAP_VIEW
+    min_lon, min_lat, max_lon, max_lat = (float(v) for v in extent)
 
     center_lon = (min_lon + max_lon) / 2
     center_lat = (min_lat + max_lat) / 2
@@ -706,20 +938,119 @@ def calculate_map_view_from_geojson(geojson_features):
     # print(f"Calculated View: Center={map_center}, Zoom={map_zoom}, SpanLon={delta_lon}, SpanLat={delta_lat}")
     return map_center, map_zoom
 
+def build_tile_choropleth(df_map_data, variable_label, map_center, map_zoom, mapbox_access_token):
+    """
+    矢量瓦片版本的 Choropleth：图形中只有底图和颜色条，ZCTA 形状由浏览器从 /tiles/zcta 加载，
+    再由 assets/acs_map.js 按 acs-map-tile-values 中的 ZCTA -> 数值着色。
+    """
+    value_min, value_max = float(df_map_data['value_to_map'].min()), float(df_map_data['value_to_map'].max())
+    colors = px.colors.get_colorscale(MAP_COLOR_SCALE)
+    # 不可见的标记只用于显示与 px.choropleth_mapbox 相同的颜色条
+    fig_map = go.Figure(go.Scattermapbox(
+        lat=[None, None], lon=[None, None], mode='markers', hoverinfo='skip', showlegend=False,
+        marker={'color': [value_min, value_max], 'colorscale': colors, 'showscale': True,
+                'colorbar': {'title': {'text': variable_label}}},
+    ))
+    fig_map.update_layout(
+        margin={"r":5,"t":5,"l":5,"b":5},
+        mapbox_accesstoken=mapbox_access_token,
+        mapbox={'style': 'light', 'center': map_center, 'zoom': map_zoom},
+    )
+    tile_values = {
+        'graphId': 'acs-map-graph',
+        'tiles': dash.get_relative_path(tile_url_template(zcta_index.signature)),
+        'layer': ZCTA_LAYER, 'idProperty': zcta_index.id_property, 'maxzoom': MAX_TILE_ZOOM,
+        'zctas': df_map_data['zipcode'].tolist(),
+        'values': df_map_data['value_to_map'].tolist(),
+        'colorscale': colors, 'range': [value_min, value_max], 'opacity': MAP_OPACITY,
+    }
+    return html.Div([
+        dcc.Graph(id='acs-map-graph', figure=fig_map, style={'width': '100%', 'height': '65vh'}),
+        dcc.Store(id='acs-map-tile-values', data=tile_values),
+    ])
+
+# 矢量瓦片着色在浏览器中完成 (assets/acs_map.js)
+dash.clientside_callback(
+    ClientsideFunction(namespace='acsMap', function_name='applyTileValues'),
+    Input('acs-map-tile-values', 'data'),
+)
+
+# 嵌入 GeoJSON 的地图：几何按签名缓存在浏览器中 (assets/acs_map.js)，只换变量或年份时回调只发送 ZCTA -> 数值。
+# (container, values, geometry, view)：不是地图的结果 (提示信息等) 不更新数值和几何，并清空当前视图
+NO_MAP_DATA = (dash.no_update, dash.no_update, None)
+
+def geometry_signature(positions, lod_level):
+    """所选 ZCTA 几何的标识：几何文件的版本 + 细节层级 + 所选要素的位置。"""
+    digest = hashlib.sha1(f"{zcta_index.signature}:{lod_level}:".encode())
+    digest.update(np.ascontiguousarray(positions, dtype=np.int64).tobytes())
+    return digest.hexdigest()[:16]
+
+def map_hover_template(selected_variable, variable_label):
+    """与原 px.choropleth_mapbox 的 hover_data 格式一致的 hovertemplate。"""
+    value_format = '%{z:.1f}'
+    if "pct_" in selected_variable: value_format = '%{z:.1f}%'
+    elif "income" in selected_variable: value_format = '$%{z:,.0f}'
+    elif selected_variable in ["population", "year"]: value_format = '%{z:,.0f}'
+    return f"<b>%{{location}}</b><br>{variable_label}={value_format}<extra></extra>"
+
+def build_map_values(df_map_data, signature, selected_variable, variable_label):
+    """Value-only payload that recolors the embedded map: ZCTA -> value arrays for the geometry `signature`."""
+    return {
+        'graphId': 'acs-map-graph',
+        'signature': signature,
+        'featureidkey': f'properties.{zcta_index.id_property}',
+        'zctas': df_map_data['zipcode'].tolist(),
+        'values': df_map_data['value_to_map'].tolist(),
+        'colorscale': px.colors.get_colorscale(MAP_COLOR_SCALE),
+        'range': [float(df_map_data['value_to_map'].min()), float(df_map_data['value_to_map'].max())],
+        'opacity': MAP_OPACITY,
+        'label': variable_label,
+        'hovertemplate': map_hover_template(selected_variable, variable_label),
+    }
+
+def build_geojson_map_graph(map_center, map_zoom, signature, mapbox_access_token):
+    """
+    嵌入 GeoJSON 的 Choropleth 的图形组件：服务器只发送底图布局，
+    choropleth 轨迹由 assets/acs_map.js 用缓存的几何和 acs-map-values 中的数值绘制。
+    """
+    fig_map = go.Figure()
+    fig_map.update_layout(
+        margin={"r":5,"t":5,"l":5,"b":5},
+        mapbox_accesstoken=mapbox_access_token,
+        mapbox={'style': 'light', 'center': map_center, 'zoom': map_zoom},
+        uirevision=signature, # 重新着色时保留用户的平移和缩放
+    )
+    return dcc.Graph(id='acs-map-graph', figure=fig_map, style={'width': '100%', 'height': '65vh'})
+
+dash.clientside_callback(
+    ClientsideFunction(namespace='acsMap', function_name='applyGeoJsonValues'),
+    Output('acs-map-geometry-cached', 'data'),
+    Input('acs-map-values', 'data'),
+    Input('acs-map-geometry', 'data'),
+    prevent_initial_call=True,
+)
+
 # 回调5: 更新地图 (监听标签页激活)
 @callback(
     [Output('acs-map-container', 'children'),
      Output('map-stats-plots-container', 'children'),
-     Output('map-stats-header', 'children')],
+     Output('map-stats-header', 'children'),
+     Output('acs-map-values', 'data'),
+     Output('acs-map-geometry', 'data'),
+     Output('acs-map-view', 'data')],
     [Input('acs-page-tabs', 'active_tab'),
-     Input('map-applied-filters-store', 'data')] # 监听存储的筛选条件
+     Input('map-applied-filters-store', 'data')], # 监听存储的筛选条件
+    [State('acs-map-geometry-cached', 'data'),
+     State('acs-map-view', 'data'),
+     State('acs-session-id', 'data')]
 )
-def render_map_and_stats(active_tab_id, applied_filters):
+@supersedes_previous_queries
+def render_map_and_stats(active_tab_id, applied_filters, cached_geometry_signatures, current_map_view):
     ctx = dash.callback_context
     triggered_input_id = ctx.triggered[0]['prop_id'].split('.')[0] if ctx.triggered else None
 
     if active_tab_id != "acs-tab-map-viz":
-        return dash.no_update, dash.no_update, dash.no_update
+        return (dash.no_update,) * 6
 
     # 初始提示信息
     map_placeholder = html.Div([
@@ -734,11 +1065,11 @@ def render_map_and_stats(active_tab_id, applied_filters):
     if not applied_filters or not applied_filters.get('year') or not applied_filters.get('variable'):
         # 如果触发的不是 store 的更新（例如，是标签页切换），并且基本筛选不全
         if triggered_input_id != 'map-applied-filters-store':
-            return map_placeholder, stats_placeholder, default_stats_header
+            return map_placeholder, stats_placeholder, default_stats_header, *NO_MAP_DATA
         # 如果是 store 更新了，但年份或变量仍然缺失（理论上按钮回调会保证它们有值）
         elif not applied_filters.get('year') or not applied_filters.get('variable'):
              return (dbc.Alert("Year and Variable selections are required. Please make your selections and click 'Update Map & Stats'.", color="warning", className="m-4"),
-                    stats_placeholder, default_stats_header)
+                    stats_placeholder, default_stats_header, *NO_MAP_DATA)
 
 
     selected_year = applied_filters.get('year')
@@ -749,7 +1080,7 @@ def render_map_and_stats(active_tab_id, applied_filters):
     # 再次确认核心筛选条件是否存在
     if not selected_year or not selected_variable:
         # 这个情况理论上会被上面的逻辑捕获，但作为双重保险
-        return map_placeholder, stats_placeholder, default_stats_header
+        return map_placeholder, stats_placeholder, default_stats_header, *NO_MAP_DATA
 
 
     # --- Mapbox Token 和 GeoJSON 检查 (保持不变) ---
@@ -757,28 +1088,24 @@ def render_map_and_stats(active_tab_id, applied_filters):
     # mapbox_access_token = "pk.YOURTOKEN" # for local testing
     if not mapbox_access_token or mapbox_access_token == "pk.YOURTOKEN": # 请替换占位符
         alert_msg = dbc.Alert([html.H5("Mapbox Access Token缺失", className="alert-heading"), html.P(["无法加载地图..."])], color="danger", className="m-4")
-        return alert_msg, stats_placeholder, default_stats_header
-    if geojson_us_data is None:
+        return alert_msg, stats_placeholder, default_stats_header, *NO_MAP_DATA
+    if zcta_index is None:
         alert_msg = dbc.Alert("US GeoJSON data failed to load.", color="danger", className="m-4")
-        return alert_msg, stats_placeholder, default_stats_header
+        return alert_msg, stats_placeholder, default_stats_header, *NO_MAP_DATA
 
     # --- 构建动态SQL的WHERE子句 ---
     # 确保 selected_variable 是有效的，并且在SQL中安全使用
     if selected_variable not in POSSIBLE_SELECTABLE_COLUMNS: # (确保POSSIBLE_SELECTABLE_COLUMNS已正确定义)
-        return dbc.Alert(f"Invalid variable selected: {selected_variable}", color="danger"), stats_placeholder, default_stats_header
+        return dbc.Alert(f"Invalid variable selected: {selected_variable}", color="danger"), stats_placeholder, default_stats_header, *NO_MAP_DATA
     
     safe_sql_variable_name = f'"{selected_variable}"'
-    where_conditions = [f"\"year\" = {int(selected_year)}", f"{safe_sql_variable_name} IS NOT NULL"]
-
-    if selected_states: # 只有当用户选择了州时，才添加州筛选
-        safe_states_sql = "('" + "', '".join([str(s).replace("'", "''") for s in selected_states]) + "')"
-        where_conditions.append(f"\"state\" IN {safe_states_sql}")
-        
-        if selected_counties: # 只有当用户选择了州 *并且* 选择了县时，才添加县筛选
-            safe_counties_sql = "('" + "', '".join([str(c).replace("'", "''") for c in selected_counties]) + "')"
-            where_conditions.append(f"\"county\" IN {safe_counties_sql}")
-    
-    where_clause_sql = " AND ".join(where_conditions)
+    # 只有当用户选择了州时，才添加州筛选；只有当用户选择了州 *并且* 选择了县时，才添加县筛选
+    filter_sql, filter_params = build_filter_clause({
+        'state': [str(s) for s in selected_states],
+        'county': [str(c) for c in selected_counties] if selected_states else [],
+    })
+    where_clause_sql = f"\"year\" = %s AND {safe_sql_variable_name} IS NOT NULL AND {filter_sql}"
+    where_params = [int(selected_year)] + filter_params
 
     # 获取数据
     query = f"""
@@ -786,7 +1113,7 @@ def render_map_and_stats(active_tab_id, applied_filters):
         FROM public.acs_data_all  -- 确保表名是 acs_data_all
         WHERE {where_clause_sql};
     """
-    df_map_data = fetch_data(query)
+    df_map_data = fetch_data(query, where_params, bulk=None, cache=True) # 全国范围的地图查询自动走 COPY
 
     selected_variable_label = next((opt['label'] for opt in MAP_VARIABLE_OPTIONS if opt['value'] == selected_variable), selected_variable.replace('_',' ').title())
     current_stats_header = f"Statistics for: {selected_variable_label} ({selected_year})"
@@ -801,72 +1128,60 @@ def render_map_and_stats(active_tab_id, applied_filters):
         if selected_states: msg += f", States: {', '.join(selected_states)}"
         if selected_counties: msg += f", Counties: {', '.join(selected_counties)}"
         msg += ")."
-        return dbc.Alert(msg, color="warning"), html.P(msg, className="text-center text-muted p-3"), current_stats_header
+        return dbc.Alert(msg, color="warning"), html.P(msg, className="text-center text-muted p-3"), current_stats_header, *NO_MAP_DATA
     
     # --- 数据准备和GeoJSON过滤 (与之前类似) ---
     df_map_data['zipcode'] = df_map_data['zipcode'].astype(str)
-    df_map_data['value_to_map'] = pd.to_numeric(df_map_data['value_to_map'], errors='coerce')
+    df_map_data['value_to_map'] = pd.to_numeric(df_map_data['value_to_map'], errors='coerce').round(display_decimals(selected_variable))
     df_map_data.dropna(subset=['value_to_map'], inplace=True)
 
     if df_map_data.empty: # 清理后再次检查
         msg = f"No valid (numeric) data for '{selected_variable_label}' after cleaning for year {selected_year} and other filters."
-        return dbc.Alert(msg, color="warning"), html.P(msg, className="text-center text-muted p-3"), current_stats_header
+        return dbc.Alert(msg, color="warning"), html.P(msg, className="text-center text-muted p-3"), current_stats_header, *NO_MAP_DATA
         
-    filtered_geojson_features = []
-    zctas_in_data = set(df_map_data['zipcode'])
-    if geojson_us_data and 'features' in geojson_us_data:
-        for feature in geojson_us_data['features']:
-            if str(feature['properties'].get('ZCTA5CE20')) in zctas_in_data:
-                filtered_geojson_features.append(feature)
-    
-    current_display_geojson = {"type": "FeatureCollection", "features": filtered_geojson_features}
+    # 通过索引取所选区域中有数据的 ZCTA，开销与所选区域的大小成正比
+    _ensure_zcta_regions()
+    selected_positions = zcta_index.select(df_map_data['zipcode'], selected_states,
+                                           selected_counties if selected_states else None)
 
-    if not filtered_geojson_features:
+    if not len(selected_positions):
         return dbc.Alert("No geographical ZCTA shapes match the filtered data. Ensure GeoJSON 'ZCTA5CE20' property aligns with 'zipcode' data.", color="info"), \
-               html.P("No shapes to display.", className="text-center text-muted p-3"), current_stats_header
+               html.P("No shapes to display.", className="text-center text-muted p-3"), current_stats_header, *NO_MAP_DATA
 
-    # --- 创建Choropleth Mapbox图形 ---
-    # ... (与您之前创建 fig_map 的代码一致, 使用 current_display_geojson, df_map_data)
-    # ... (hover_data_format_str 逻辑)
-    hover_data_format_str = ':.1f'
-    if "pct_" in selected_variable: hover_data_format_str = ':.1f}%'
-    elif "income" in selected_variable or "median_income" in selected_variable: hover_data_format_str = '$,.0f'
-    elif selected_variable in ["population", "year"]: hover_data_format_str = ',.0f'
+    # 地图几何取整个所选区域的 ZCTA (与变量和年份无关，浏览器缓存的几何可以复用)；没有值的 ZCTA 不会被绘制
+    area_positions = zcta_index.area_positions(selected_states, selected_counties if selected_states else None)
+    if area_positions is None:
+        area_positions = selected_positions
 
     # --- 计算地图的中心点和缩放级别 ---
-    map_center_calc, map_zoom_calc = calculate_map_view_from_geojson(current_display_geojson.get("features", []))
-
+    map_center_calc, map_zoom_calc = calculate_map_view_from_extent(zcta_index.extent(area_positions))
 
     map_graph_component = html.Div("Error creating map.")
+    map_values, map_geometry, map_view = NO_MAP_DATA
+    use_tiles = ACS_MAP_TILES_MIN_FEATURES > 0 and len(area_positions) >= ACS_MAP_TILES_MIN_FEATURES
     try:
-        fig_map = px.choropleth_mapbox(
-            df_map_data, geojson=current_display_geojson, locations='zipcode',
-            featureidkey='properties.ZCTA5CE20', color='value_to_map',
-            color_continuous_scale="YlOrRd",
-            mapbox_style="light",
-            # 当显示全国数据时，移除固定的 center 和 zoom，让 mapbox_autofitbounds 工作
-            # center 和 zoom 可以在没有州选择时设为美国中心，或完全依赖 autofit
-            # zoom= (3.5 if not selected_states else 5.5), 
-            # center= ({"lat": 39.8283, "lon": -98.5795} if not selected_states else None), # None 会让autofit生效
-            opacity=0.7,
-            labels={'value_to_map': selected_variable_label},
-            hover_name='zipcode',
-            hover_data={'value_to_map': hover_data_format_str, 'zipcode': False}
-        )
-        fig_map.update_layout(
-            margin={"r":5,"t":5,"l":5,"b":5},
-            mapbox_accesstoken=mapbox_access_token,
-            mapbox={
-                'center': map_center_calc, # 美国中心点
-                'zoom': map_zoom_calc # 概览缩放级别
-            },
-            # mapbox_autofitbounds="locations", # 关键：让地图自动适应有数据的位置
-            coloraxis_colorbar_title_text=selected_variable_label
-        )
-        map_graph_component = dcc.Graph(figure=fig_map, style={'width': '100%', 'height': '65vh'})
+        if use_tiles:
+            map_graph_component = build_tile_choropleth(df_map_data, selected_variable_label,
+                                                        map_center_calc, map_zoom_calc, mapbox_access_token)
+            map_view = {'mode': 'tiles'}
+        else:
+            # 按缩放级别和顶点预算选择几何的细节层级 (没有构建层级时始终为原始几何)
+            lod_level = zcta_index.choose_level(area_positions, map_zoom_calc + ACS_MAP_LOD_ZOOM_HEADROOM,
+                                                vertex_budget=ACS_MAP_VERTEX_BUDGET)
+            signature = geometry_signature(area_positions, lod_level)
+            map_view = {'mode': 'geojson', 'signature': signature}
+            # 浏览器已缓存这份几何时不再发送；只换变量或年份时地图组件本身也保持不变
+            if signature not in (cached_geometry_signatures or []):
+                map_geometry = {'signature': signature, 'geojson': {
+                    "type": "FeatureCollection", "features": zcta_index.features_at(area_positions, lod_level)}}
+            map_values = build_map_values(df_map_data, signature, selected_variable, selected_variable_label)
+            if current_map_view == map_view:
+                map_graph_component = dash.no_update
+            else:
+                map_graph_component = build_geojson_map_graph(map_center_calc, map_zoom_calc, signature, mapbox_access_token)
     except Exception as e:
         map_graph_component = dbc.Alert(f"Error creating map: {str(e)}", color="danger")
-        return map_graph_component, stats_placeholder, current_stats_header
+        return map_graph_component, stats_placeholder, current_stats_header, *NO_MAP_DATA
         
     # --- 创建统计图 (与之前一致, 使用筛选后的 df_map_data) ---
     stats_plots_component = html.Div("Error generating stats or no data for stats.")
@@ -885,7 +1200,8 @@ def render_map_and_stats(active_tab_id, applied_filters):
         except Exception as e:
             stats_plots_component = dbc.Alert(f"Error generating statistics plots: {str(e)}", color="warning")
 
-    return map_graph_component, stats_plots_component, current_stats_header
+    return (map_graph_component, stats_plots_component, current_stats_header,
+            map_values, map_geometry, map_view)
 
 
 # -------------  Trend Analysis Tab的回调 --------------
@@ -898,7 +1214,7 @@ def populate_trend_state_dropdown(active_tab):
     if active_tab == "acs-tab-trend-analysis": # 仅当趋势分析标签页激活时
         try:
             # SQL查询与地图部分相同
-            df_states = fetch_data("SELECT DISTINCT state FROM public.acs_data_all WHERE state IS NOT NULL ORDER BY state;")
+            df_states = fetch_data("SELECT DISTINCT state FROM public.acs_data_all WHERE state IS NOT NULL ORDER BY state;", cache=True)
             if df_states is not None and not df_states.empty:
                 return [{'label': str(s), 'value': str(s)} for s in df_states['state']]
         except Exception as e:
@@ -917,9 +1233,8 @@ def populate_trend_county_dropdown(selected_states, active_tab):
         return [], []
 
     try:
-        safe_states_sql = "('" + "', '".join([str(s).replace("'", "''") for s in selected_states]) + "')"
-        query = f"SELECT DISTINCT county FROM public.acs_data_all WHERE county IS NOT NULL AND state IN {safe_states_sql} ORDER BY county LIMIT 1000;"
-        df_counties = fetch_data(query)
+        query = "SELECT DISTINCT county FROM public.acs_data_all WHERE county IS NOT NULL AND state = ANY(%s) ORDER BY county LIMIT 1000;"
+        df_counties = fetch_data(query, [[str(s) for s in selected_states]], cache=True)
         if df_counties is not None and not df_counties.empty:
             options = [{'label': str(c), 'value': str(c)} for c in df_counties['county']]
             return options, []
@@ -956,8 +1271,10 @@ def store_trend_filters_on_apply(n_clicks, selected_variables, selected_states,
 @callback(
     Output('trend-charts-container', 'children'),
     [Input('acs-page-tabs', 'active_tab'),
-     Input('trend-applied-filters-store', 'data')]
+     Input('trend-applied-filters-store', 'data')],
+    [State('acs-session-id', 'data')]
 )
+@supersedes_previous_queries
 def render_trend_analysis_charts(active_tab_id, applied_filters):
     ctx = dash.callback_context
     triggered_input_id = ctx.triggered[0]['prop_id'].split('.')[0] if ctx.triggered else None
@@ -984,20 +1301,16 @@ def render_trend_analysis_charts(active_tab_id, applied_filters):
         return dbc.Alert("No variables selected for trend analysis.", color="warning", className="m-3")
 
     # --- 构建基础WHERE子句 (不包含年份，因为我们要看所有年份的趋势) ---
-    base_where_conditions = ["1=1"] # 开始
-    if selected_states:
-        safe_states_sql = "('" + "', '".join([str(s).replace("'", "''") for s in selected_states]) + "')"
-        base_where_conditions.append(f"\"state\" IN {safe_states_sql}")
-        if selected_counties: # 仅当州被选择时，县的筛选才有意义
-            safe_counties_sql = "('" + "', '".join([str(c).replace("'", "''") for c in selected_counties]) + "')"
-            base_where_conditions.append(f"\"county\" IN {safe_counties_sql}")
-
-    base_where_clause_sql = " AND ".join(base_where_conditions)
-
-    charts_layout = []
+    # 仅当州被选择时，县的筛选才有意义
+    base_where_clause_sql, base_where_params = build_filter_clause({
+        'state': [str(s) for s in selected_states],
+        'county': [str(c) for c in selected_counties] if selected_states else [],
+    })
+
+    # 每个变量一条 GROUP BY year 查询，彼此独立，先全部构建好再并发执行
+    trend_queries = {}
     for variable_to_plot in selected_variables:
         if variable_to_plot not in POSSIBLE_SELECTABLE_COLUMNS: # 安全检查
-            charts_layout.append(dbc.Col(dbc.Alert(f"Invalid variable: {variable_to_plot}", color="danger"), md=12 if len(selected_variables) == 1 else (6 if len(selected_variables) == 2 else 4)))
             continue
 
         safe_sql_variable = f'"{variable_to_plot}"'
@@ -1023,7 +1336,17 @@ def render_trend_analysis_charts(active_tab_id, applied_filters):
             GROUP BY year
             ORDER BY year ASC;
         """
-        df_trend_data = fetch_data(query)
+        trend_queries[variable_to_plot] = {'query': query, 'params': base_where_params, 'cache': True}
+
+    trend_results = dict(zip(trend_queries, fetch_many(trend_queries.values())))
+
+    charts_layout = []
+    for variable_to_plot in selected_variables:
+        if variable_to_plot not in trend_queries:
+            charts_layout.append(dbc.Col(dbc.Alert(f"Invalid variable: {variable_to_plot}", color="danger"), md=12 if len(selected_variables) == 1 else (6 if len(selected_variables) == 2 else 4)))
+            continue
+
+        df_trend_data = trend_results[variable_to_plot]
 
         variable_label = next((opt['label'] for opt in MAP_VARIABLE_OPTIONS if opt['value'] == variable_to_plot),
                               variable_to_plot.replace('_',' ').title())
@@ -1036,6 +1359,8 @@ def render_trend_analysis_charts(active_tab_id, applied_filters):
 
 
         if df_trend_data is not None and not df_trend_data.empty:
+            df_trend_data = df_trend_data.assign(
+                trend_value=pd.to_numeric(df_trend_data['trend_value'], errors='coerce').round(display_decimals(variable_to_plot)))
             fig_trend = px.line(
                 df_trend_data,
                 x="year",
@@ -0,0 +1,6 @@
+# dashboard_project/tests/conftest.py
+# 测试从项目根目录导入 utils/ 和 pages/，与 `python -m utils.xxx` 的运行方式一致
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,94 @@
+# dashboard_project/tests/test_acs_data.py
+"""ACS page callbacks (pages/acs_data.py): DataTable paging against fake query functions."""
+import contextlib
+from concurrent.futures import Future
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("dash")
+import app # noqa: F401  创建 Dash 应用后才能导入页面模块 (dash.register_page)
+from pages import acs_data
+from utils import db_utils
+from utils.acs_queries import DEFAULT_SELECTED_COLUMNS, TEXT_COLUMNS
+
+COLUMNS = list(dict.fromkeys(DEFAULT_SELECTED_COLUMNS + ["year", "state", "zipcode", "id"]))
+
+
+def page_frame(first_id, rows=10):
+    return pd.DataFrame({col: [f"{col}{first_id + i}" if col in TEXT_COLUMNS else first_id + i for i in range(rows)]
+                         for col in COLUMNS})
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """
+    Replaces every query function the callback uses. `queries` lists the queries the callback
+    waited for, `prefetches` the background page queries.
+    """
+    queries, prefetches, cached = [], [], {}
+    version_reads = []
+
+    def fetch_data(query, params=None, cache=False, **kwargs):
+        key = (query, str(params))
+        if cache and key in cached:
+            return cached[key]
+        queries.append(query)
+        df = pd.DataFrame({"available": [True]}) if "to_regclass" in query else pd.DataFrame({"count": [100]})
+        if cache:
+            cached[key] = df
+        return df
+
+    def fetch_many(requests):
+        results = []
+        for request in requests:
+            if isinstance(request, tuple):
+                queries.append(request[0])
+                results.append(page_frame(0))
+            else:
+                results.append(fetch_data(**request))
+        return results
+
+    def fetch_data_async(query, params=None, **kwargs):
+        prefetches.append(query)
+        future = Future()
+        future.set_result(page_frame(len(prefetches) * 100))
+        return future
+
+    @contextlib.contextmanager
+    def db_connection(*args, **kwargs): # 其他直接借用连接的查询 (如未缓存的版本号读取)
+        queries.append("connection")
+        yield None
+
+    def read_dataset_version():
+        version_reads.append(1)
+        return (("acs_data_all", 3),)
+
+    monkeypatch.setattr(acs_data, "fetch_data", fetch_data)
+    monkeypatch.setattr(acs_data, "fetch_many", fetch_many)
+    monkeypatch.setattr(acs_data, "fetch_data_async", fetch_data_async)
+    monkeypatch.setattr(db_utils, "db_connection", db_connection)
+    monkeypatch.setattr(db_utils, "_read_dataset_version", read_dataset_version)
+    monkeypatch.setattr(db_utils, "_dataset_version", None)
+    monkeypatch.setattr(db_utils, "_dataset_version_checked_at", float("-inf"))
+    monkeypatch.setattr(acs_data, "_prefetched_pages", type(acs_data._prefetched_pages)())
+    return queries, prefetches, version_reads
+
+
+def test_prefetched_page_is_served_without_a_query(database):
+    queries, prefetches, version_reads = database
+    filters = {"years": [2022], "states": [], "counties": []}
+    data, page_count, _, cursor, error = acs_data.update_datatable_data(
+        "acs-tab-data-table", 0, 10, [], None, filters, "", None, "session-1")
+    assert page_count == 10 and error is None and len(data) == 10
+    assert len(prefetches) == 1 # 第 2 页在后台预取
+    prefetched = page_frame(100)
+
+    del queries[:]
+    data, _, _, cursor, _ = acs_data.update_datatable_data(
+        "acs-tab-data-table", 1, 10, [], None, filters, "", cursor, "session-1")
+    assert queries == [] # 页数据来自预取，总行数来自查询缓存，版本来自进程内的令牌
+    assert [row["id"] for row in data] == prefetched["id"].tolist()
+    assert cursor["page"] == 1
+    assert len(prefetches) == 2 # 接着预取第 3 页 (第 1 页已在缓存中)
+    assert version_reads == [1]
@@ -0,0 +1,75 @@
+# dashboard_project/tests/test_acs_export.py
+"""Streaming exports (utils/acs_export.py) must fail visibly when the database fails."""
+import flask
+import pandas as pd
+import psycopg2
+import pytest
+
+from utils import acs_export
+from utils.export_cache import ExportCache
+
+
+def failing_fetch_iter(rows_before_error):
+    def fetch_iter(query, params=None, chunk_size=None, label=None):
+        if rows_before_error:
+            yield pd.DataFrame({"year": [2022] * rows_before_error, "state": ["Texas"] * rows_before_error})
+        raise psycopg2.OperationalError("server closed the connection unexpectedly")
+    return fetch_iter
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(acs_export, "get_dataset_version", lambda table_name: None) # 不使用导出缓存
+    server = flask.Flask(__name__)
+    acs_export.register_export_routes(server)
+    return server.test_client()
+
+
+@pytest.mark.parametrize("export_format", ["csv", "parquet", "arrow"])
+def test_query_failing_at_start_returns_503(client, monkeypatch, export_format):
+    if export_format != "csv":
+        pytest.importorskip("pyarrow")
+    monkeypatch.setattr(acs_export, "fetch_iter", failing_fetch_iter(0))
+    response = client.get(f"/download/acs_data.{export_format}?column=year&column=state")
+    assert response.status_code == 503
+
+
+@pytest.mark.parametrize("export_format", ["csv", "parquet", "arrow"])
+def test_query_failing_mid_stream_aborts_the_response(client, monkeypatch, export_format):
+    if export_format != "csv":
+        pytest.importorskip("pyarrow")
+    monkeypatch.setattr(acs_export, "fetch_iter", failing_fetch_iter(3))
+    response = client.get(f"/download/acs_data.{export_format}?column=year&column=state", buffered=False)
+    assert response.status_code == 200
+    with pytest.raises(psycopg2.OperationalError): # 不会以一个截断的文件正常结束
+        response.get_data()
+
+
+def test_failed_artifact_is_not_cached(monkeypatch, tmp_path):
+    cache = ExportCache(str(tmp_path), 1 << 30)
+    monkeypatch.setattr(acs_export, "export_cache", cache)
+    monkeypatch.setattr(acs_export, "get_dataset_version", lambda table_name: 7)
+    monkeypatch.setattr(acs_export, "fetch_data", lambda *args, **kwargs: pd.DataFrame({"count": [10]}))
+    monkeypatch.setattr(acs_export, "fetch_iter", failing_fetch_iter(3))
+    assert acs_export.build_export_artifact(["year", "state"], {}, export_format="csv") is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_artifact_row_check_uses_a_live_count(monkeypatch, tmp_path):
+    cache = ExportCache(str(tmp_path), 1 << 30)
+    counts = []
+
+    def fetch_data(query, params=None, cache=False, **kwargs):
+        counts.append(cache)
+        return pd.DataFrame({"count": [3]})
+
+    def fetch_iter(query, params=None, chunk_size=None, label=None):
+        yield pd.DataFrame({"year": [2022] * 3, "state": ["Texas"] * 3})
+
+    monkeypatch.setattr(acs_export, "export_cache", cache)
+    monkeypatch.setattr(acs_export, "get_dataset_version", lambda table_name: 8)
+    monkeypatch.setattr(acs_export, "fetch_data", fetch_data)
+    monkeypatch.setattr(acs_export, "fetch_iter", fetch_iter)
+    result = acs_export.build_export_artifact(["year", "state"], {}, export_format="csv")
+    assert result["rows"] == 3 and not result["cached"]
+    assert counts == [False] # 查询缓存中可能还是 ETL 加载前的行数
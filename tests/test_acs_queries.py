@@ -0,0 +1,70 @@
+# dashboard_project/tests/test_acs_queries.py
+"""DataTable keyset pagination SQL (utils/acs_queries.py), checked against OFFSET paging in DuckDB."""
+import re
+
+import pytest
+
+from utils.acs_queries import datatable_order_index_sql, datatable_order_keys, order_by_sql, seek_clause
+
+duckdb = pytest.importorskip("duckdb")
+
+COLUMNS = ["id", "state", "county", "zipcode", "year", "median_income"]
+
+
+@pytest.fixture(scope="module")
+def con():
+    con = duckdb.connect()
+    con.execute("""
+        CREATE TABLE acs_data_all AS SELECT
+            i AS id,
+            CASE WHEN i % 11 = 0 THEN NULL ELSE 'S' || (i % 4) END AS state,
+            'C' || (i % 6) AS county,
+            CASE WHEN i % 13 = 0 THEN NULL ELSE lpad((i % 37)::VARCHAR, 5, '0') END AS zipcode,
+            CASE WHEN i % 7 = 0 THEN NULL ELSE 2012 + i % 5 END AS year,
+            CASE WHEN i % 3 = 0 THEN NULL ELSE (i * 7919) % 1000 * 1.5 END AS median_income
+        FROM range(1, 600) t(i)""")
+    return con
+
+
+def _page(con, keys, limit, seek=None, reverse=False, offset=0):
+    condition, params = "1=1", []
+    if seek is not None:
+        condition, params = seek_clause(keys, seek, reverse)
+        counter = iter(range(1, len(params) + 1))
+        condition = re.sub("%s", lambda m: f"${next(counter)}", condition) # DuckDB 的占位符
+    rows = con.execute(f"SELECT {', '.join(COLUMNS)} FROM acs_data_all WHERE {condition} "
+                       f"{order_by_sql(keys, reverse)} LIMIT {limit} OFFSET {offset}", params).fetchall()
+    rows = [dict(zip(COLUMNS, row)) for row in rows]
+    return rows[::-1] if reverse else rows
+
+
+@pytest.mark.parametrize("sort_by", [
+    None, # 默认排序：year 降序 + state/zipcode 升序 (数值列取负)
+    [{"column_id": "median_income", "direction": "desc"}],
+    [{"column_id": "state", "direction": "desc"}, {"column_id": "year", "direction": "asc"}],
+    [{"column_id": "state", "direction": "asc"}, {"column_id": "county", "direction": "desc"}], # 退回 OR 展开
+])
+def test_keyset_pages_match_offset_pages(con, sort_by):
+    keys = datatable_order_keys(sort_by, COLUMNS)
+    for page in range(0, 12):
+        rows = _page(con, keys, 50, offset=page * 50)
+        following = _page(con, keys, 50, seek=[rows[-1][col] for col, _ in keys])
+        assert [r["id"] for r in following] == [r["id"] for r in _page(con, keys, 50, offset=(page + 1) * 50)]
+        if page:
+            previous = _page(con, keys, 50, seek=[rows[0][col] for col, _ in keys], reverse=True)
+            assert [r["id"] for r in previous] == [r["id"] for r in _page(con, keys, 50, offset=(page - 1) * 50)]
+
+
+def test_default_order_is_a_single_row_comparison():
+    keys = datatable_order_keys(None, ())
+    sql, params = seek_clause(keys, [2022, "CA", None, 5])
+    assert " OR " not in sql and sql.count(">") == 1
+    assert params == [False, -2022, False, "CA", True, "", 5]
+    index_sql = datatable_order_index_sql()
+    for term in ['(-COALESCE("year", 0))', 'COALESCE("state", \'\')', '"id"']:
+        assert term in index_sql and term in order_by_sql(keys)
+
+
+def test_mixed_text_directions_cannot_share_an_index():
+    with pytest.raises(ValueError):
+        datatable_order_index_sql([("state", False), ("county", True), ("id", False)])
@@ -0,0 +1,287 @@
+# dashboard_project/tests/test_db_utils.py
+"""Connection bookkeeping and query cancellation in utils/db_utils.py, without a database."""
+import threading
+
+import pandas as pd
+import pytest
+
+from utils import db_utils
+
+
+class FakePool:
+    def __init__(self):
+        self.returned = []
+
+    def putconn(self, conn, close=False):
+        self.returned.append((conn, close))
+
+
+class FakeConn:
+    pass
+
+
+def test_release_returns_connection_to_its_own_pool():
+    primary, replica = FakePool(), FakePool()
+    conn = FakeConn()
+    db_utils._conn_pools[conn] = replica
+    db_utils.release_db_connection(conn)
+    assert replica.returned == [(conn, False)]
+    assert primary.returned == []
+
+
+def test_release_rejects_unknown_or_already_released_connection():
+    pool, conn = FakePool(), FakeConn()
+    db_utils._conn_pools[conn] = pool
+    db_utils.release_db_connection(conn)
+    with pytest.raises(ValueError):
+        db_utils.release_db_connection(conn)
+    with pytest.raises(ValueError):
+        db_utils.release_db_connection(FakeConn())
+    assert pool.returned == [(conn, False)]
+
+
+class FailingCursor:
+    """Named cursor that returns one chunk and then loses the connection."""
+
+    description = [type("Column", (), {"name": "zipcode"})()]
+
+    def __init__(self):
+        self.itersize = None
+        self.calls = 0
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchmany(self, size):
+        self.calls += 1
+        if self.calls > 1:
+            raise db_utils.psycopg2.OperationalError("server closed the connection unexpectedly")
+        return [("00601",)]
+
+    def close(self):
+        pass
+
+
+class StreamingConn:
+    def cursor(self, name=None):
+        return FailingCursor()
+
+    def rollback(self):
+        pass
+
+
+def test_fetch_iter_raises_instead_of_ending_early(monkeypatch):
+    @db_utils.contextmanager
+    def fake_connection(timeout=None, role="primary"):
+        yield StreamingConn()
+
+    monkeypatch.setattr(db_utils, "db_connection", fake_connection)
+    chunks = db_utils.fetch_iter("SELECT zipcode FROM t", chunk_size=1)
+    assert list(next(chunks)["zipcode"]) == ["00601"]
+    with pytest.raises(db_utils.psycopg2.OperationalError):
+        next(chunks)
+
+
+def test_fetch_iter_raises_without_connection(monkeypatch):
+    @db_utils.contextmanager
+    def no_connection(timeout=None, role="primary"):
+        yield None
+
+    monkeypatch.setattr(db_utils, "db_connection", no_connection)
+    with pytest.raises(db_utils.psycopg2.OperationalError):
+        list(db_utils.fetch_iter("SELECT 1"))
+
+
+# --- cancel_superseded ---
+def test_older_invocation_stays_superseded_after_newer_one_exits():
+    key = ("session", "older_stays_stale")
+    a_entered, b_done, release_a = threading.Event(), threading.Event(), threading.Event()
+    seen = {}
+
+    def run_a():
+        with db_utils.cancel_superseded(key) as invocation:
+            a_entered.set()
+            release_a.wait(5)
+            seen["superseded"] = invocation.superseded
+            seen["registered"] = db_utils._register_inflight(invocation, FakeConn())
+
+    def run_b():
+        with db_utils.cancel_superseded(key) as invocation:
+            seen["b_superseded"] = invocation.superseded
+        b_done.set()
+
+    a = threading.Thread(target=run_a)
+    a.start()
+    a_entered.wait(5)
+    b = threading.Thread(target=run_b)
+    b.start()
+    b_done.wait(5)
+    release_a.set()
+    a.join(5)
+    b.join(5)
+    assert seen == {"superseded": True, "registered": False, "b_superseded": False}
+    assert key not in db_utils._latest_invocation
+    assert key not in db_utils._active_invocations
+
+
+class CancellableConn:
+    def __init__(self):
+        self.cancelled = 0
+
+    def cancel(self):
+        self.cancelled += 1
+
+
+def test_newer_invocation_cancels_registered_query_and_retires_its_connection():
+    key = ("session", "cancel_registered")
+    conn, pool = CancellableConn(), FakePool()
+    with db_utils.cancel_superseded(key) as older:
+        assert db_utils._register_inflight(older, conn)
+        with db_utils.cancel_superseded(key) as newer:
+            assert conn.cancelled == 1
+            assert older.superseded and not newer.superseded
+            db_utils._unregister_inflight(older, conn)
+            db_utils._conn_pools[conn] = pool
+            db_utils.release_db_connection(conn)
+    assert pool.returned == [(conn, True)] # 被取消过的连接不再回收
+    assert key not in db_utils._inflight_queries
+
+
+def test_released_connection_is_not_cancelled():
+    key = ("session", "cancel_released")
+    conn = CancellableConn()
+    with db_utils.cancel_superseded(key) as older:
+        assert db_utils._register_inflight(older, conn)
+        db_utils._unregister_inflight(older, conn) # 查询已结束，连接可能已被别的请求借走
+        with db_utils.cancel_superseded(key):
+            pass
+    assert conn.cancelled == 0
+
+
+# --- replica lag ---
+class LagCursor:
+    def __init__(self, lag):
+        self.lag = lag
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchone(self):
+        return (self.lag,)
+
+
+class LagPool(FakePool):
+    def __init__(self, lag):
+        super().__init__()
+        self.conn = type("Conn", (), {"cursor": lambda _: LagCursor(lag), "rollback": lambda _: None})()
+
+    def getconn(self, timeout=None):
+        return self.conn
+
+
+@pytest.mark.parametrize("lag, healthy", [(0, True), (12.5, True), (None, False), (3600, False)])
+def test_replica_without_wal_receiver_counts_as_lagging(monkeypatch, lag, healthy):
+    monkeypatch.setattr(db_utils, "get_db_pool", lambda role="primary": LagPool(lag))
+    monkeypatch.setattr(db_utils, "_replica_healthy", not healthy)
+    monkeypatch.setattr(db_utils, "_replica_lag", None)
+    measured = db_utils._measure_replica_lag()
+    assert measured == (float("inf") if lag is None else lag)
+    db_utils._set_replica_health(measured)
+    assert db_utils.get_replica_status()["serving_reads"] is healthy
+
+
+def test_cache_key_includes_named_parameter_values():
+    query = "SELECT * FROM public.acs_data_all WHERE year = %(year)s AND state = ANY(%(states)s)"
+    key = db_utils._cache_key(query, {"year": 2021, "states": ["Texas"]})
+    assert key != db_utils._cache_key(query, {"year": 2022, "states": ["Texas"]})
+    assert key != db_utils._cache_key(query, {"year": 2021, "states": ["Ohio"]})
+    assert key == db_utils._cache_key(query + ";", {"states": ["Texas"], "year": 2021}) # 与参数顺序无关
+    hash(key)
+    assert db_utils._cache_key("SELECT %s", [[1, [2, 3]]]) != db_utils._cache_key("SELECT %s", [[1, [2, 4]]])
+
+
+def test_prefetches_do_not_queue_ahead_of_interactive_queries(monkeypatch):
+    release = threading.Event()
+    started = []
+
+    def fetch_data(query, params=None, label=None, **kwargs):
+        started.append(query)
+        if query.startswith("prefetch"):
+            release.wait(5)
+        return query
+
+    monkeypatch.setattr(db_utils, "fetch_data", fetch_data)
+    monkeypatch.setattr(db_utils, "_query_executors", {})
+    try:
+        prefetches = [db_utils.fetch_data_async(f"prefetch {i}") for i in range(db_utils.DB_PREFETCH_WORKERS + 5)]
+        results = db_utils.fetch_many(["SELECT 1", "SELECT 2"]) # 预取全部阻塞时仍立即完成
+        assert results == ["SELECT 1", "SELECT 2"]
+        assert not any(f.done() for f in prefetches)
+    finally:
+        release.set()
+        for executor, _ in db_utils._query_executors.values():
+            executor.shutdown(wait=True)
+    assert [f.result() for f in prefetches][-1] == f"prefetch {db_utils.DB_PREFETCH_WORKERS + 4}"
+
+
+# --- 查询结果缓存 (QueryCache) ---
+def frame(value):
+    return pd.DataFrame({"value": [value] * 100})
+
+
+def test_query_cache_evicts_least_recently_used():
+    nbytes = int(frame(0).memory_usage(index=True, deep=True).sum())
+    cache = db_utils.QueryCache(max_bytes=int(nbytes * 2.5), ttl=60)
+    cache.put("a", frame(1), cache.generation)
+    cache.put("b", frame(2), cache.generation)
+    assert cache.get("a")["value"].iloc[0] == 1 # a 变为最近使用
+    cache.put("c", frame(3), cache.generation)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["evictions"] == 1 and cache.stats()["bytes"] == 2 * nbytes
+
+
+def test_query_cache_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(db_utils.time, "monotonic", lambda: now[0])
+    cache = db_utils.QueryCache(max_bytes=1 << 20, ttl=30)
+    cache.put("a", frame(1), cache.generation)
+    now[0] += 29
+    assert cache.get("a") is not None
+    now[0] += 2
+    assert cache.get("a") is None and cache.stats()["entries"] == 0
+
+
+def test_query_cache_returns_copies():
+    cache = db_utils.QueryCache(max_bytes=1 << 20, ttl=60)
+    cache.put("a", frame(1), cache.generation)
+    df = cache.get("a")
+    df["value"] = 99 # 回调就地修改返回的 DataFrame
+    assert cache.get("a")["value"].iloc[0] == 1
+
+
+def test_dataset_version_bump_invalidates_cached_results(monkeypatch):
+    cache = db_utils.QueryCache(max_bytes=1 << 20, ttl=60)
+    token = [(("acs_data_all", 1),)]
+    monkeypatch.setattr(db_utils, "_query_cache", cache)
+    monkeypatch.setattr(db_utils, "_read_dataset_version", lambda: token[0])
+    monkeypatch.setattr(db_utils, "_dataset_version", None)
+    monkeypatch.setattr(db_utils, "_dataset_version_checked_at", float("-inf"))
+
+    db_utils._refresh_dataset_version(0)
+    generation = cache.generation
+    cache.put("a", frame(1), generation)
+    db_utils._refresh_dataset_version(0) # 版本未变
+    assert cache.get("a") is not None
+
+    token[0] = (("acs_data_all", 2),) # ETL 加载了新数据
+    db_utils._refresh_dataset_version(0)
+    assert cache.get("a") is None
+    cache.put("b", frame(2), generation) # 失效之前开始的查询，结果不能再存入
+    assert cache.get("b") is None
@@ -0,0 +1,203 @@
+# dashboard_project/tests/test_geometry.py
+"""ZCTA geometry: the index's state/county lists, the packed file, the memory-mapped store and the topology."""
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.convert_geometry import write_packed_geometry
+from utils import geometry_store
+from utils.geometry import ZctaGeometryIndex, count_vertices, feature_bbox
+from utils.packed_geometry import FORMAT_VERSION, PackedGeometry
+from utils.topology import build_topology, simplify_topology, topology_to_features
+
+
+def square(code, x, y, size=1.0):
+    ring = [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+    return {"type": "Feature", "properties": {"ZCTA5CE20": code}, "geometry": {"type": "Polygon", "coordinates": [ring]}}
+
+
+@pytest.fixture
+def index():
+    return ZctaGeometryIndex({"type": "FeatureCollection",
+                              "features": [square("90001", 0, 0), square("90002", 1, 0), square("73301", 5, 5)]})
+
+
+def regions(*rows):
+    return pd.DataFrame(rows, columns=["zipcode", "state", "county"])
+
+
+def test_regions_are_rebuilt_when_the_dataset_version_changes(index, monkeypatch):
+    pytest.importorskip("dash")
+    import app # noqa: F401  创建 Dash 应用后才能导入页面模块 (dash.register_page)
+    from pages import acs_data
+    from utils import db_utils
+
+    loads = {1: regions(("90001", "California", "Los Angeles County")),
+             2: regions(("90001", "California", "Los Angeles County"), ("90002", "California", "Los Angeles County"),
+                        ("73301", "Texas", "Travis County"))}
+    version = [1]
+    queries, version_reads = [], []
+
+    def read_dataset_version():
+        version_reads.append(version[0])
+        return None if version[0] is None else (("acs_data_all", version[0]),)
+
+    def etl_load(new_version): # 新版本在下一次检查时被发现
+        version[0] = new_version
+        monkeypatch.setattr(db_utils, "_dataset_version_checked_at", float("-inf"))
+
+    monkeypatch.setattr(acs_data, "zcta_index", index)
+    monkeypatch.setattr(acs_data, "fetch_data", lambda *args, **kwargs: queries.append(version[0]) or loads[version[0]])
+    monkeypatch.setattr(db_utils, "_read_dataset_version", read_dataset_version)
+    monkeypatch.setattr(db_utils, "_dataset_version", None)
+    etl_load(1)
+
+    acs_data._ensure_zcta_regions()
+    acs_data._ensure_zcta_regions()
+    assert queries == [1] and version_reads == [1] # 数据未变：不查询列表，也不重新读取版本
+    assert index.area_positions(["California"]).tolist() == [0]
+    assert index.area_positions(["Texas"]).tolist() == []
+
+    etl_load(2)
+    acs_data._ensure_zcta_regions()
+    assert queries == [1, 2] and index.regions_version == 2
+    assert index.area_positions(["California"]).tolist() == [0, 1]
+    assert index.area_positions(["Texas"]).tolist() == [2]
+    assert index.area_positions().tolist() == [0, 1, 2]
+
+    etl_load(None) # 读取版本失败时继续使用已有列表
+    acs_data._ensure_zcta_regions()
+    assert queries == [1, 2]
+
+
+# --- 打包几何文件 (utils/convert_geometry.py -> utils/packed_geometry.py) ---
+def multipolygon(code):
+    outer = [[10.0, 10.0], [12.0, 10.0], [12.0, 12.0], [10.0, 12.0], [10.0, 10.0]]
+    hole = [[10.5, 10.5], [10.5, 11.5], [11.5, 11.5], [11.5, 10.5], [10.5, 10.5]]
+    island = [[13.0, 10.0], [13.25, 10.0], [13.25, 10.25], [13.0, 10.0]]
+    return {"type": "Feature", "properties": {"ZCTA5CE20": code},
+            "geometry": {"type": "MultiPolygon", "coordinates": [[outer, hole], [island]]}}
+
+
+def jagged(code, x, y):
+    ring = [[x, y], [x + 0.5, y - 0.123457], [x + 1, y], [x + 1.000001, y + 1], [x, y + 1], [x, y]]
+    return {"type": "Feature", "properties": {"ZCTA5CE20": code}, "geometry": {"type": "Polygon", "coordinates": [ring]}}
+
+
+SOURCE_FEATURES = [square("90001", 0, 0), square("90002", 1, 0), jagged("00601", 3, 3),
+                   multipolygon("73301"), {"type": "Feature", "properties": {"ZCTA5CE20": "99999"}, "geometry": None}]
+
+
+def normalized(geometry):
+    """Rings as sorted points: the topology may start a ring at a different vertex."""
+    if geometry is None:
+        return None
+    polygons = [geometry["coordinates"]] if geometry["type"] == "Polygon" else geometry["coordinates"]
+    return sorted(sorted(tuple(sorted(map(tuple, ring[:-1]))) for ring in rings) for rings in polygons)
+
+
+@pytest.fixture
+def packed_path(tmp_path):
+    path = str(tmp_path / "zcta.topo.npz")
+    write_packed_geometry(path, SOURCE_FEATURES, tolerances=[0.01, 0.5], source_sha1="abc")
+    return path
+
+
+def test_packed_geometry_round_trip(packed_path):
+    packed = PackedGeometry(packed_path)
+    assert packed.source_sha1 == "abc" and packed.tolerances == [0.01, 0.5]
+    assert list(packed.ids) == [f["properties"]["ZCTA5CE20"] for f in SOURCE_FEATURES]
+    assert packed.bboxes[:4].tolist() == [list(feature_bbox(f)) for f in SOURCE_FEATURES[:4]]
+    features = packed.features(0)
+    for position, source in enumerate(SOURCE_FEATURES): # 1e-6 的量化对 6 位小数的输入无损
+        assert features[position]["properties"] == {"ZCTA5CE20": source["properties"]["ZCTA5CE20"]}
+        assert normalized(features[position]["geometry"]) == normalized(source["geometry"])
+    assert packed.vertex_counts(0).tolist() == [count_vertices(f["geometry"]) for f in SOURCE_FEATURES]
+
+
+def test_packed_levels_simplify_without_losing_features(packed_path):
+    packed = PackedGeometry(packed_path)
+    coarse = packed.features(2)
+    assert normalized(coarse[0]["geometry"]) == normalized(SOURCE_FEATURES[0]["geometry"]) # 正方形已经最简
+    assert packed.vertex_counts(2)[2] < packed.vertex_counts(0)[2] # 锯齿边被化简
+    assert all(coarse[position]["geometry"] is not None for position in range(4))
+
+
+def test_packed_file_of_another_format_version_is_rejected(packed_path, tmp_path):
+    with np.load(packed_path) as data:
+        arrays = dict(data)
+    arrays["format_version"] = np.int32(FORMAT_VERSION + 1)
+    path = str(tmp_path / "future.topo.npz")
+    np.savez_compressed(path, **arrays)
+    with pytest.raises(ValueError):
+        PackedGeometry(path)
+
+
+# --- 内存映射的几何存储 (utils/geometry_store.py) ---
+def source_index(signature="sig"):
+    return ZctaGeometryIndex({"type": "FeatureCollection", "features": SOURCE_FEATURES}, signature=signature)
+
+
+@pytest.mark.parametrize("source", ["geojson", "packed"])
+def test_geometry_store_round_trip(tmp_path, packed_path, source):
+    index = source_index() if source == "geojson" else ZctaGeometryIndex.from_packed(PackedGeometry(packed_path), "sig")
+    expected = [index.features[position] for position in range(len(index))]
+    store = geometry_store.open_geometry_store(str(tmp_path / "store"), index)
+    assert store.tolerances == [tolerance for tolerance, _, _ in index.levels]
+
+    reopened = ZctaGeometryIndex.from_store(geometry_store.find_geometry_store(str(tmp_path / "store"), "sig"), "sig")
+    assert list(reopened.ids) == list(index.ids)
+    np.testing.assert_array_equal(reopened.bboxes, index.bboxes)
+    for position, feature in enumerate(expected):
+        assert reopened.features[position] == feature
+    assert reopened.levels[0][2].tolist() == [count_vertices(f["geometry"]) for f in expected]
+
+
+def test_store_of_an_older_format_is_rebuilt_not_reused(tmp_path, monkeypatch):
+    root = str(tmp_path / "store")
+    old_store = geometry_store.open_geometry_store(root, source_index())
+    monkeypatch.setattr(geometry_store, "STORE_FORMAT_VERSION", geometry_store.STORE_FORMAT_VERSION + 1)
+
+    assert geometry_store.find_geometry_store(root, "sig") is None # 旧格式的目录不会被当作当前格式打开
+    store = geometry_store.open_geometry_store(root, source_index())
+    assert store.directory != old_store.directory
+    assert [store.features(0)[position] for position in range(len(SOURCE_FEATURES))] == SOURCE_FEATURES
+    with pytest.raises(ValueError): # 旧目录的 meta.json 记录的是旧版本
+        geometry_store.GeometryStore(old_store.directory)
+
+
+# --- 保持拓扑的化简 (utils/topology.py) ---
+def neighbours():
+    """Two unit cells side by side; the border between them zigzags around x = 1."""
+    border = [[1.0 + round(0.05 * math.sin(7.0 * i), 6) if 0 < i < 20 else 1.0, i / 20] for i in range(21)]
+    west = [[0.0, 0.0]] + border + [[0.0, 1.0], [0.0, 0.0]]
+    east = [[2.0, 0.0], [2.0, 1.0]] + border[::-1] + [[2.0, 0.0]]
+    return [{"type": "Feature", "properties": {"ZCTA5CE20": code}, "geometry": {"type": "Polygon", "coordinates": [ring]}}
+            for code, ring in (("90001", west), ("90002", east))]
+
+
+def border_segments(geometry):
+    """Undirected edges of the exterior ring that lie on the zigzag border (0.9 <= x <= 1.1)."""
+    ring = [tuple(p) for p in geometry["coordinates"][0]]
+    return {frozenset((a, b)) for a, b in zip(ring, ring[1:]) if all(0.9 <= p[0] <= 1.1 for p in (a, b))}
+
+
+@pytest.mark.parametrize("tolerance", [0.0, 0.005, 0.02, 0.1])
+def test_neighbours_keep_an_identical_shared_border_at_every_level(tolerance):
+    topology = build_topology(neighbours())
+    west, east = topology_to_features(topology, simplify_topology(topology, tolerance))
+    shared = border_segments(west["geometry"])
+    assert shared and shared == border_segments(east["geometry"])
+    full = len(border_segments(neighbours()[0]["geometry"]))
+    assert len(shared) == full if tolerance == 0 else len(shared) < full
+
+
+def test_packed_levels_keep_the_shared_border(tmp_path):
+    path = str(tmp_path / "neighbours.topo.npz")
+    write_packed_geometry(path, neighbours(), tolerances=[0.005, 0.02, 0.1], source_sha1="abc")
+    packed = PackedGeometry(path)
+    for level in range(len(packed.tolerances) + 1):
+        west, east = packed.features(level)
+        assert border_segments(west["geometry"]) == border_segments(east["geometry"])
@@ -0,0 +1,111 @@
+# dashboard_project/tests/test_table_filters.py
+"""DataTable filter_query -> SQL (utils/table_filters.py): grammar, errors, and results in DuckDB."""
+import re
+
+import pytest
+
+from utils.acs_queries import build_datatable_where_clause
+from utils.table_filters import FilterQueryError, compile_filter_query
+
+COLUMNS = {"state": "text", "zipcode": "text", "year": "numeric", "population": "numeric"}
+ROWS = [ # (id, state, zipcode, year, population)
+    (1, "California", "90001", 2020, 7),
+    (2, "california", "90002", 2021, 12),
+    (3, "Texas", "73301", 2019, 2.5),
+    (4, "", None, None, None),
+    (5, None, "00601", 2020, -3),
+    (6, "100%_sure", "10001", 2022, 1),
+]
+
+
+@pytest.fixture(scope="module")
+def con():
+    duckdb = pytest.importorskip("duckdb")
+    con = duckdb.connect()
+    con.execute("CREATE TABLE t (id INTEGER, state VARCHAR, zipcode VARCHAR, year INTEGER, population DOUBLE)")
+    con.executemany("INSERT INTO t VALUES (?, ?, ?, ?, ?)", ROWS)
+    return con
+
+
+def matching_ids(con, filter_query):
+    sql, params = compile_filter_query(filter_query, COLUMNS)
+    counter = iter(range(1, len(params) + 1))
+    sql = re.sub("%s", lambda m: f"${next(counter)}", sql) # DuckDB 的占位符
+    return sorted(row[0] for row in con.execute(f"SELECT id FROM t WHERE {sql}", params).fetchall())
+
+
+@pytest.mark.parametrize("filter_query, expected", [
+    ("{year} = 2020", [1, 5]),
+    ("{year} eq 2020", [1, 5]),
+    ("{year} ne 2020", [2, 3, 6]),
+    ("{year} != 2020", [2, 3, 6]),
+    ("{population} >= 7", [1, 2]),
+    ("{population} lt 2", [5, 6]),
+    ("{population} le 2.5", [3, 5, 6]),
+    ("{population} gt -3", [1, 2, 3, 6]),
+    ("{state} = California", [1]),
+    ("{state} ieq california", [1, 2]),
+    ("{state} i= CALIFORNIA", [1, 2]),
+    ("{state} seq california", [2]),
+    ("{state} ine california", [3, 4, 6]),
+    ("{state} igt t", [3]),
+    ("{state} contains Cal", [1]),
+    ("{state} icontains cal", [1, 2]),
+    ("{state} scontains cal", [2]),
+    ("{state} contains %_", [6]), # LIKE 通配符按字面匹配
+    ("{population} contains .5", [3]),
+    ("{zipcode} datestartswith 900", [1, 2]),
+    ("{year} datestartswith 202", [1, 2, 5, 6]),
+    ("{state} is blank", [4, 5]),
+    ("{state} is not blank", [1, 2, 3, 6]),
+    ("{zipcode} is nil", [4]),
+    ("{zipcode} is not nil", [1, 2, 3, 5, 6]),
+    ("{population} is num", [1, 2, 3, 5, 6]),
+    ("{state} is num", []),
+    ("{state} is str", [1, 2, 3, 4, 6]),
+    ("{population} is not str", [1, 2, 3, 4, 5, 6]),
+    ("{population} is bool", []),
+    ("{population} is object", []),
+    ("{population} is even", [2]),
+    ("{population} is odd", [1, 6]),
+    ("{population} is not even", [1, 3, 4, 5, 6]),
+    ("{population} is prime", [1]),
+    ("{year} is prime", []),
+    ("!({year} = 2020)", [2, 3, 4, 6]), # 与前端一致：取反时 NULL 行也匹配
+    ("{year} = 2020 && {population} > 0", [1]),
+    ("{year} = 2020 and {population} > 0", [1]),
+    ("{year} = 2019 || {state} ieq CALIFORNIA", [1, 2, 3]),
+    ("({year} = 2019 or {year} = 2022) && !({state} is blank)", [3, 6]),
+    ('{state} = "Texas"', [3]),
+    ("{state} = 'Texas'", [3]),
+    ("{state} = `Texas`", [3]),
+    ('{state} contains "100%"', [6]),
+])
+def test_operators_match_datatable_semantics(con, filter_query, expected):
+    assert matching_ids(con, filter_query) == expected
+
+
+def test_values_are_bound_not_spliced():
+    sql, params = compile_filter_query("{state} = \"x'; DROP TABLE t; --\"", COLUMNS)
+    assert sql == '"state" = %s' and params == ["x'; DROP TABLE t; --"]
+
+
+@pytest.mark.parametrize("filter_query", [
+    "{geom} = 1",               # 不在白名单中的列
+    "{year} = abc",             # 数值列的非数值
+    "{state} matches x",        # 未知运算符
+    "{state} is purple",        # 未知的一元运算符
+    "({year} = 1",              # 括号不匹配
+    "{year} = 1 {state}",       # 多余的内容
+    "{state} idatestartswith x",
+])
+def test_invalid_filters_raise(filter_query):
+    with pytest.raises(FilterQueryError):
+        compile_filter_query(filter_query, COLUMNS)
+
+
+def test_invalid_filter_is_not_silently_dropped():
+    with pytest.raises(FilterQueryError):
+        build_datatable_where_clause({"years": [2020]}, "{year} = abc")
+    sql, params, has_column_filter = build_datatable_where_clause({"years": [2020]}, "{year} is even")
+    assert has_column_filter and params == [[2020]]
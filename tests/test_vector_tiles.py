@@ -0,0 +1,202 @@
+# dashboard_project/tests/test_vector_tiles.py
+"""ZCTA vector tiles (utils/vector_tiles.py): tile URLs, the renderer and its disk cache."""
+import gzip
+
+import flask
+import numpy as np
+import pytest
+
+from utils import vector_tiles
+from utils.geometry import ZctaGeometryIndex
+
+
+def square(code, lon, lat, size=0.5):
+    ring = [[lon, lat], [lon + size, lat], [lon + size, lat + size], [lon, lat + size], [lon, lat]]
+    return {"type": "Feature", "properties": {"ZCTA5CE20": code}, "geometry": {"type": "Polygon", "coordinates": [ring]}}
+
+
+def make_index(signature):
+    return ZctaGeometryIndex({"type": "FeatureCollection", "features": [square("90001", -118.5, 34.0)]},
+                             signature=signature)
+
+
+def tile_requests(result):
+    return vector_tiles.TILE_REQUESTS._values.get((result,), 0.0)
+
+
+@pytest.fixture
+def geometry(monkeypatch, tmp_path):
+    """The index load_zcta_index() returns; replace current[0] to simulate rebuilt geometry."""
+    current = [make_index("sig1")]
+    monkeypatch.setattr(vector_tiles, "load_zcta_index", lambda: current[0])
+    monkeypatch.setattr(vector_tiles, "TILE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(vector_tiles, "_renderer", None)
+    return current
+
+
+@pytest.fixture
+def client(geometry):
+    server = flask.Flask(__name__)
+    vector_tiles.register_tile_routes(server)
+    return server.test_client()
+
+
+def test_tile_url_carries_the_geometry_signature(client, geometry):
+    template = vector_tiles.tile_url_template("sig1")
+    assert template == "/tiles/zcta/sig1/{z}/{x}/{y}.pbf"
+    response = client.get(template.format(z=0, x=0, y=0))
+    assert response.status_code == 200 and "immutable" in response.headers["Cache-Control"]
+    assert gzip.decompress(response.data) # 非空的 MVT
+
+    geometry[0] = make_index("sig2") # 几何重建后旧 URL 不再提供瓦片，新 URL 来自新的渲染器
+    assert client.get("/tiles/zcta/sig1/0/0/0.pbf").status_code == 404
+    assert client.get("/tiles/zcta/sig2/0/0/0.pbf").status_code == 200
+    assert vector_tiles.get_tile_renderer().index is geometry[0]
+
+
+def test_tile_lock_is_released_when_rendering_fails(geometry, monkeypatch):
+    renderer = vector_tiles.get_tile_renderer()
+
+    def broken_render(z, x, y):
+        raise RuntimeError("render failed")
+
+    monkeypatch.setattr(renderer, "render", broken_render)
+    with pytest.raises(RuntimeError):
+        renderer.tile(1, 0, 0)
+    assert renderer._locks == {}
+
+
+def test_tile_rendered_by_another_thread_counts_as_a_hit(geometry, monkeypatch):
+    renderer = vector_tiles.get_tile_renderer()
+    hits, misses = tile_requests("hit"), tile_requests("miss")
+    first = renderer.tile(2, 0, 1) # 生成并写入磁盘缓存
+    assert tile_requests("miss") == misses + 1
+
+    # 模拟第一次读缓存时文件还不存在，拿到锁时另一个线程已经写好
+    real_open = open
+    calls = [0]
+
+    def open_once_missing(path, *args, **kwargs):
+        calls[0] += 1
+        if calls[0] == 1:
+            raise FileNotFoundError(path)
+        return real_open(path, *args, **kwargs)
+
+    monkeypatch.setattr("builtins.open", open_once_missing)
+    assert renderer.tile(2, 0, 1) == first
+    assert tile_requests("hit") == hits + 1 and renderer._locks == {}
+
+
+# --- MVT 编码 (encode_layer) 与裁剪：用一个最小的 protobuf 解码器读回 ---
+def read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def read_fields(data):
+    """(field number, value) pairs; value is bytes for length-delimited fields, else an int."""
+    fields, pos = [], 0
+    while pos < len(data):
+        tag, pos = read_varint(data, pos)
+        if tag & 7 == 2:
+            length, pos = read_varint(data, pos)
+            fields.append((tag >> 3, data[pos:pos + length]))
+            pos += length
+        else:
+            value, pos = read_varint(data, pos)
+            fields.append((tag >> 3, value))
+    return fields
+
+
+def read_packed(data):
+    values, pos = [], 0
+    while pos < len(data):
+        value, pos = read_varint(data, pos)
+        values.append(value)
+    return values
+
+
+def unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def decode_rings(commands):
+    """Polygon geometry commands -> rings (lists of (x, y), not repeated at the end)."""
+    rings, x, y, i = [], 0, 0, 0
+    while i < len(commands):
+        command, count = commands[i] & 7, commands[i] >> 3
+        i += 1
+        if command == 7: # ClosePath
+            continue
+        for _ in range(count):
+            x, y = x + unzigzag(commands[i]), y + unzigzag(commands[i + 1])
+            i += 2
+            if command == 1:
+                rings.append([])
+            rings[-1].append((x, y))
+    return rings
+
+
+def decode_layer(data):
+    (number, layer), = read_fields(data)
+    assert number == 3 # Tile.layers
+    fields = read_fields(layer)
+    keys = [v.decode() for n, v in fields if n == 3]
+    values = [dict(read_fields(v))[1].decode() for n, v in fields if n == 4]
+    features = []
+    for _, feature in (f for f in fields if f[0] == 2):
+        parts = dict(read_fields(feature))
+        tags = read_packed(parts[2])
+        features.append({"id": parts[1], "type": parts[3], "rings": decode_rings(read_packed(parts[4])),
+                         "properties": {keys[k]: values[v] for k, v in zip(tags[::2], tags[1::2])}})
+    return {"name": dict(fields)[1].decode(), "version": dict(fields)[15], "extent": dict(fields)[5], "features": features}
+
+
+def signed_area(ring):
+    return sum(x0 * y1 - x1 * y0 for (x0, y0), (x1, y1) in zip(ring, ring[1:] + ring[:1])) / 2
+
+
+def test_encode_layer_round_trip_of_a_square_with_a_hole():
+    outer = [(100, 100), (300, 100), (300, 300), (100, 300)]
+    hole = [(150, 150), (150, 250), (250, 250), (250, 150)]
+    data = vector_tiles.encode_layer("zcta", [
+        (7, {"ZCTA5CE20": "90001"}, [np.array(outer), np.array(hole)]),
+        (8, {"ZCTA5CE20": "90002"}, [np.array(outer) + 1000]),
+    ])
+    layer = decode_layer(data)
+    assert (layer["name"], layer["version"], layer["extent"]) == ("zcta", 2, vector_tiles.TILE_EXTENT)
+    first, second = layer["features"]
+    assert (first["id"], first["type"], first["properties"]) == (7, 3, {"ZCTA5CE20": "90001"}) # 3 = POLYGON
+    assert first["rings"] == [outer, hole]
+    assert second["properties"] == {"ZCTA5CE20": "90002"}
+    assert second["rings"] == [[(x + 1000, y + 1000) for x, y in outer]]
+
+
+def test_rendered_square_is_projected_oriented_and_clipped(geometry):
+    renderer = vector_tiles.get_tile_renderer()
+    # 缩放级别 0：整个正方形都在瓦片内
+    (feature,) = decode_layer(gzip.decompress(renderer.tile(0, 0, 0)))["features"]
+    (ring,) = feature["rings"]
+    expected = vector_tiles._to_tile(np.array([[-118.5, 34.0], [-118.0, 34.5]]), 0, 0, 0)
+    xs, ys = [p[0] for p in ring], [p[1] for p in ring]
+    assert (min(xs), max(ys)) == tuple(expected[0]) and (max(xs), min(ys)) == tuple(expected[1])
+    assert signed_area(ring) > 0 # MVT: 外环在 y 向下的坐标系中为正面积
+    assert feature["properties"] == {"ZCTA5CE20": "90001"}
+
+    # 放大到正方形内部的一块瓦片：环被裁剪到瓦片加缓冲区的边界
+    z = 12
+    n = 2 ** z
+    x = int((-118.25 + 180) / 360 * n)
+    lat = np.radians(34.25)
+    y = int((1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * n)
+    (feature,) = decode_layer(gzip.decompress(renderer.tile(z, x, y)))["features"]
+    (ring,) = feature["rings"]
+    lo, hi = -vector_tiles.TILE_BUFFER, vector_tiles.TILE_EXTENT + vector_tiles.TILE_BUFFER
+    assert sorted(ring) == [(lo, lo), (lo, hi), (hi, lo), (hi, hi)]
+    assert signed_area(ring) > 0
@@ -0,0 +1,401 @@
+# dashboard_project/utils/acs_export.py
+"""
+Streaming export of filtered ACS data: GET /download/acs_data.<csv|parquet|arrow>
+
+The ACS page's download button links here with the current filters and columns in the
+query string (see build_export_url), so the file is written by a plain Flask response
+instead of being rendered into a Dash callback payload. Rows are read through a
+server-side cursor (fetch_iter) and sent chunk by chunk; a worker only ever holds one
+chunk in memory, however large the export.
+
+Formats:
+    csv      Plain CSV, optionally gzip-compressed (gzip=1).
+    parquet  Parquet (zstd), one row group per chunk.       pd.read_parquet(path)
+    arrow    Arrow IPC file (Feather v2, zstd), one record batch per chunk.   pd.read_feather(path)
+The binary formats are typed: state/county/city are dictionary-encoded, measures are
+float32, id/year are integers and zipcode stays a string (leading zeros are kept).
+
+Query parameters (repeat a parameter for several values):
+    year=2022&year=2021    state=California    county=Los Angeles County
+    column=median_income   filter=<DataTable filter_query>    gzip=1
+
+Finished files can also be built ahead of time (build_export_artifact, run by the ACS
+page as a background job) and are then kept in an ExportCache keyed by format, columns,
+filters and the dataset version; the endpoint serves a cached file directly from disk.
+"""
+import io
+import itertools
+import os
+import zlib
+from urllib.parse import urlencode
+
+import dash
+import psycopg2
+from flask import Blueprint, Response, abort, request, send_file, stream_with_context
+
+from utils.db_utils import fetch_data, fetch_iter, get_dataset_version
+from utils.export_cache import ExportCache, artifact_key
+from utils.metrics import Counter
+from utils.acs_queries import (ACS_TABLE, DEFAULT_SELECTED_COLUMNS, EXPORTABLE_COLUMNS, EXPORT_ORDER_BY,
+                               TEXT_COLUMNS, build_datatable_where_clause)
+
+try: # Optional: 只有 Parquet / Arrow 导出需要
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+EXPORT_PATH = "/download/acs_data.<export_format>"
+EXPORT_FILENAME = "acs_filtered_data"
+EXPORT_CHUNK_SIZE = 20000 # 每次从游标读取并写出的行数
+GZIP_LEVEL = 6
+# 低基数的文本列在 Parquet / Arrow 中按字典编码
+DICTIONARY_COLUMNS = ('state', 'county', 'city')
+INTEGER_COLUMNS = ('id', 'year')
+
+# --- Export artifact cache ---
+EXPORT_CACHE_DIR = os.getenv("EXPORT_CACHE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "exports"))
+EXPORT_CACHE_MAX_BYTES = int(os.getenv("EXPORT_CACHE_MAX_BYTES", str(2 * 1024 ** 3))) # 超过后删除最久未使用的文件
+export_cache = ExportCache(EXPORT_CACHE_DIR, EXPORT_CACHE_MAX_BYTES)
+
+EXPORTS_STARTED = Counter(
+    "dashboard_exports_total", "Data exports started, by format.", ("format",),
+)
+
+export_bp = Blueprint("acs_export", __name__)
+
+
+def build_export_url(applied_filters, filter_query=None, columns=None, export_format="csv", compress=False):
+    """
+    Builds the download link for the current page state.
+
+    Args:
+        applied_filters (dict): Contents of applied-filters-store ('years', 'states', 'counties').
+        filter_query (str, optional): The DataTable's filter_query.
+        columns (list, optional): Columns to export; defaults to DEFAULT_SELECTED_COLUMNS.
+        export_format (str, optional): 'csv', 'parquet' or 'arrow'.
+        compress (bool, optional): Request a gzip-compressed file (CSV only).
+
+    Returns:
+        str: A relative URL (respecting the app's requests_pathname_prefix).
+    """
+    applied_filters = applied_filters or {}
+    params = [
+        ("year", applied_filters.get("years") or []),
+        ("state", applied_filters.get("states") or []),
+        ("county", applied_filters.get("counties") or []),
+        ("column", columns or DEFAULT_SELECTED_COLUMNS),
+    ]
+    if filter_query:
+        params.append(("filter", filter_query))
+    if compress and export_format == "csv":
+        params.append(("gzip", "1"))
+    path = EXPORT_PATH.replace("<export_format>", export_format)
+    return f"{dash.get_relative_path(path)}?{urlencode(params, doseq=True)}"
+
+
+def parse_export_request(args):
+    """
+    Validates the query string of an export request.
+
+    Returns:
+        tuple: (columns, filters_dict, filter_query, compress)
+
+    Raises:
+        ValueError: For unknown columns, non-integer years or a filter that cannot be compiled.
+    """
+    columns = args.getlist("column") or list(DEFAULT_SELECTED_COLUMNS)
+    unknown = [col for col in columns if col not in EXPORTABLE_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown column(s): {', '.join(unknown)}")
+    try:
+        years = [int(y) for y in args.getlist("year")]
+    except ValueError:
+        raise ValueError("year must be an integer") from None
+    filters_dict = {"years": years, "states": args.getlist("state"), "counties": args.getlist("county")}
+    compress = args.get("gzip", "").lower() in ("1", "true", "yes")
+    filter_query = args.get("filter", "")
+    build_datatable_where_clause(filters_dict, filter_query) # FilterQueryError 是 ValueError：返回 400，不导出未筛选的数据
+    return list(dict.fromkeys(columns)), filters_dict, filter_query, compress
+
+
+def _export_chunks(columns, filters_dict, filter_query, chunk_size, label, on_chunk=None):
+    """
+    Server-side cursor over the filtered rows, as DataFrame chunks (see db_utils.fetch_iter).
+    on_chunk(rows) is called after each chunk has been written out.
+    """
+    where_clause, where_params, _ = build_datatable_where_clause(filters_dict, filter_query)
+    columns_sql = ", ".join(f'"{col}"' for col in columns)
+    query = f"SELECT {columns_sql} FROM {ACS_TABLE} WHERE {where_clause} {EXPORT_ORDER_BY}"
+    chunks = fetch_iter(query, where_params, chunk_size=chunk_size, label=label)
+    return chunks if on_chunk is None else _report_chunks(chunks, on_chunk)
+
+def _report_chunks(chunks, on_chunk):
+    try:
+        for chunk in chunks:
+            yield chunk
+            on_chunk(len(chunk))
+    finally:
+        chunks.close()
+
+
+def iter_csv(columns, filters_dict, filter_query=None, chunk_size=EXPORT_CHUNK_SIZE, on_chunk=None):
+    """
+    Yields the CSV export as UTF-8 byte strings, one block per cursor chunk (the first one
+    starts with the header line). Database errors propagate from the generator. The pooled connection is returned as soon as the generator finishes or is closed
+    (Werkzeug closes it when the client disconnects).
+    """
+    chunks = _export_chunks(columns, filters_dict, filter_query, chunk_size, "export_acs_csv", on_chunk)
+    try:
+        # 表头与第一块一起产出：查询一开始就失败时还没有任何内容可发送 (见 export_acs_data)
+        header = (",".join(columns) + "\n").encode("utf-8")
+        for chunk in chunks:
+            yield header + chunk.to_csv(index=False, header=False).encode("utf-8")
+            header = b""
+        if header: # 没有符合筛选的行
+            yield header
+    finally:
+        chunks.close()
+
+
+def gzip_stream(blocks, level=GZIP_LEVEL):
+    """Compresses an iterable of byte strings into a single gzip member, block by block."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31) # wbits=31: gzip 头和校验
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# --- Parquet / Arrow IPC ---
+def export_schema(columns):
+    """Arrow schema of a typed export with the given columns."""
+    def field_type(col):
+        if col in DICTIONARY_COLUMNS:
+            return pa.dictionary(pa.int32(), pa.string())
+        if col in TEXT_COLUMNS:
+            return pa.string()
+        if col in INTEGER_COLUMNS:
+            return pa.int32() if col == 'year' else pa.int64()
+        return pa.float32()
+    return pa.schema([pa.field(col, field_type(col)) for col in columns])
+
+
+class _DictionaryEncoder:
+    """
+    Dictionary-encodes one text column across chunks. The dictionary only ever grows, so each
+    chunk's dictionary extends the previous one: Parquet stores it per row group, and the
+    Arrow IPC file writer emits just the new values as a dictionary delta.
+    """
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def encode(self, series):
+        for value in series.dropna().unique():
+            if value not in self.codes:
+                self.codes[value] = len(self.values)
+                self.values.append(value)
+        indices = pa.array(series.map(self.codes), type=pa.int32(), from_pandas=True) # NULL 不在字典中 -> null
+        return pa.DictionaryArray.from_arrays(indices, pa.array(self.values, type=pa.string()))
+
+
+class _ByteSink(io.RawIOBase):
+    """Write-only file object whose contents are taken out with drain() as they are produced."""
+
+    def __init__(self):
+        super().__init__()
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def _iter_arrow_file(columns, filters_dict, filter_query, chunk_size, on_chunk, open_writer, write, label):
+    """
+    Shared driver of the Parquet and Arrow exports: converts each cursor chunk to a typed
+    record batch, hands it to the writer and yields whatever bytes the writer produced.
+    """
+    schema = export_schema(columns)
+    encoders = {col: _DictionaryEncoder() for col in columns if col in DICTIONARY_COLUMNS}
+    sink = _ByteSink()
+    writer = open_writer(sink, schema)
+    chunks = _export_chunks(columns, filters_dict, filter_query, chunk_size, label, on_chunk)
+    try:
+        for chunk in chunks:
+            arrays = [
+                encoders[field.name].encode(chunk[field.name]) if field.name in encoders
+                else pa.array(chunk[field.name], type=field.type, from_pandas=True)
+                for field in schema
+            ]
+            write(writer, pa.RecordBatch.from_arrays(arrays, schema=schema))
+            yield sink.drain()
+        writer.close() # 写入文件尾 (footer)
+        yield sink.drain()
+    finally:
+        chunks.close()
+
+
+def iter_parquet(columns, filters_dict, filter_query=None, chunk_size=EXPORT_CHUNK_SIZE, on_chunk=None):
+    """Yields a zstd-compressed Parquet file, one row group per cursor chunk."""
+    return _iter_arrow_file(
+        columns, filters_dict, filter_query, chunk_size, on_chunk,
+        open_writer=lambda sink, schema: pq.ParquetWriter(sink, schema, compression="zstd"),
+        write=lambda writer, batch: writer.write_batch(batch),
+        label="export_acs_parquet",
+    )
+
+
+def iter_arrow(columns, filters_dict, filter_query=None, chunk_size=EXPORT_CHUNK_SIZE, on_chunk=None):
+    """Yields an Arrow IPC file (Feather v2) with zstd-compressed buffers, one record batch per cursor chunk."""
+    options = pa.ipc.IpcWriteOptions(compression="zstd", emit_dictionary_deltas=True)
+    return _iter_arrow_file(
+        columns, filters_dict, filter_query, chunk_size, on_chunk,
+        open_writer=lambda sink, schema: pa.ipc.new_file(sink, schema, options=options),
+        write=lambda writer, batch: writer.write_batch(batch),
+        label="export_acs_arrow",
+    )
+
+
+# 格式 -> (生成器, MIME 类型, 文件扩展名)
+EXPORT_FORMATS = {
+    "csv": (iter_csv, "text/csv", "csv"),
+    "parquet": (iter_parquet, "application/vnd.apache.parquet", "parquet"),
+    "arrow": (iter_arrow, "application/vnd.apache.arrow.file", "arrow"),
+}
+
+
+def _file_type(export_format, compress):
+    """(MIME type, file extension) of an export."""
+    if compress and export_format == "csv":
+        return "application/gzip", "csv.gz"
+    return EXPORT_FORMATS[export_format][1:]
+
+def _export_body(columns, filters_dict, filter_query, export_format, compress, on_chunk=None):
+    """Returns the export's contents as an iterator of byte strings."""
+    body = EXPORT_FORMATS[export_format][0](columns, filters_dict, filter_query, on_chunk=on_chunk)
+    return gzip_stream(body) if compress and export_format == "csv" else body
+
+def export_artifact_key(columns, filters_dict, filter_query, export_format, compress):
+    """
+    Cache key of an export: format, columns, filters and the current version of acs_data_all
+    (bumped by the ETL after every load). None if the version cannot be read.
+    """
+    version = get_dataset_version("acs_data_all")
+    if version is None:
+        return None
+    return artifact_key(
+        format=_file_type(export_format, compress)[1], columns=list(columns),
+        years=sorted(int(y) for y in filters_dict.get("years") or []),
+        states=sorted(str(s) for s in filters_dict.get("states") or []),
+        counties=sorted(str(c) for c in filters_dict.get("counties") or []),
+        filter=filter_query or "", version=version,
+    )
+
+def build_export_artifact(columns, filters_dict, filter_query=None, export_format="csv", compress=False,
+                          progress=None):
+    """
+    Writes an export to the artifact cache, or finds it there.
+
+    Args:
+        columns (list): Columns to export (see EXPORTABLE_COLUMNS).
+        filters_dict (dict): 'years', 'states', 'counties' as in applied-filters-store.
+        filter_query (str, optional): The DataTable's filter_query.
+        export_format (str, optional): 'csv', 'parquet' or 'arrow'.
+        compress (bool, optional): gzip the CSV.
+        progress (callable, optional): Called as progress(rows_written, total_rows) while writing.
+
+    Returns:
+        dict: {'rows', 'bytes', 'cached'} on success, None on error.
+    """
+    key = export_artifact_key(columns, filters_dict, filter_query, export_format, compress)
+    if key is None:
+        return None
+    _, extension = _file_type(export_format, compress)
+    cached = export_cache.open(key, extension)
+    if cached is not None:
+        with cached:
+            return {"rows": None, "bytes": os.fstat(cached.fileno()).st_size, "cached": True}
+
+    where_clause, where_params, _ = build_datatable_where_clause(filters_dict, filter_query)
+    # 不使用查询缓存：缓存最多要过 DB_DATASET_VERSION_CHECK_INTERVAL 秒才失效，而键里的版本是实时读取的，
+    # ETL 加载后旧的 COUNT 会让行数校验失败
+    df_count = fetch_data(f"SELECT COUNT(*) FROM {ACS_TABLE} WHERE {where_clause}", where_params, cache=False)
+    if df_count.empty:
+        return None
+    total_rows = int(df_count.iloc[0, 0])
+    written = [0]
+
+    def on_chunk(rows):
+        written[0] += rows
+        if progress is not None:
+            progress(written[0], total_rows)
+
+    body = _export_body(columns, filters_dict, filter_query, export_format, compress, on_chunk)
+    try:
+        # 行数与 COUNT(*) 不一致 (如游标中途出错) 时不缓存，避免以后一直提供不完整的文件
+        _, size = export_cache.put(key, extension, body, expected_rows=total_rows, count_rows=lambda: written[0])
+    except (OSError, ValueError, psycopg2.Error) as e: # 游标出错时临时文件已删除，不会缓存不完整的导出
+        print(f"Error building export {key}.{extension}: {e}")
+        return None
+    EXPORTS_STARTED.inc(format=extension)
+    return {"rows": written[0], "bytes": size, "cached": False}
+
+
+@export_bp.route(EXPORT_PATH)
+def export_acs_data(export_format):
+    if export_format not in EXPORT_FORMATS:
+        abort(404)
+    if export_format != "csv" and pa is None:
+        abort(501, description="pyarrow is required for Parquet and Arrow exports")
+    try:
+        columns, filters_dict, filter_query, compress = parse_export_request(request.args)
+    except ValueError as e:
+        abort(400, description=str(e))
+
+    mimetype, extension = _file_type(export_format, compress)
+    download_name = f"{EXPORT_FILENAME}.{extension}"
+    key = export_artifact_key(columns, filters_dict, filter_query, export_format, compress)
+    cached = export_cache.open(key, extension) if key else None
+    if cached is not None: # 已导出过：直接从磁盘发送
+        return send_file(cached, mimetype=mimetype, as_attachment=True, download_name=download_name, max_age=0)
+
+    body = _export_body(columns, filters_dict, filter_query, export_format, compress)
+    try: # 第一块在发送响应头之前生成：查询失败时返回 503，而不是 200 加一个空文件
+        first_block = next(body, b"")
+    except psycopg2.Error as e:
+        print(f"Error starting export {download_name}: {e}")
+        abort(503, description="The export query failed")
+    EXPORTS_STARTED.inc(format=extension)
+    # 之后的数据库错误从生成器中抛出，服务器中断分块传输 (不发送结束块，也不写 Parquet/Arrow 文件尾)，
+    # 客户端看到的是失败的下载，而不是一个被截断但看似完整的文件
+    return Response(
+        stream_with_context(itertools.chain([first_block], body)), mimetype=mimetype,
+        headers={
+            "Content-Disposition": f'attachment; filename="{download_name}"',
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no", # 让 nginx 等反向代理边收边发，不缓冲整个文件
+        },
+    )
+
+
+def register_export_routes(server):
+    """Registers the export endpoints on the Flask server (app.server)."""
+    server.register_blueprint(export_bp)
@@ -0,0 +1,182 @@
+# dashboard_project/utils/acs_queries.py
+"""
+acs_data_all 的列定义和 WHERE 子句构建，供 ACS 页面 (pages/acs_data.py) 的回调和
+数据导出接口 (utils/acs_export.py) 共用，保证两边对同一组筛选条件生成相同的 SQL。
+"""
+from utils.db_utils import build_filter_clause
+from utils.table_filters import compile_filter_query, FilterQueryError
+
+ACS_TABLE = "public.acs_data_all"
+
+# --- 列定义 ---
+ALL_COLUMNS_FROM_SCHEMA = [
+    "id", "state", "county", "city","zipcode", "year", "pct_less_than_9th_grade", "pct_high_school",
+    "pct_bachelor", "pct_master", "pct_high_school_or_higher", "pct_english_speaker",
+    "pct_spanish_speaker", "pct_asian_speaker", "pct_lep", "pct_white", "pct_black",
+    "pct_asian", "pct_non_white", "pct_hispanic", "pct_non_hispanic_white",
+    "pct_non_hispanic_black", "pct_non_hispanic_asian", "pct_minority_population",
+    "pct_infant_toddler", "pct_school_age_children", "pct_young_adults",
+    "pct_working_age_adults", "pct_middle_aged_adults", "pct_senior", "pct_adults",
+    "pct_children", "pct_male", "pct_female", "pct_below_poverty", "pct_unemployed",
+    "pct_employed", "pct_unisured", "pct_isured", "pct_disability", "per_capita_income",
+    "median_income", "population", "pct_receive_public_assistance", "pct_house_with_children",
+    "pct_single_parent_households", "pct_female_headed_households", "pct_foreign_born",
+    "pct_multi_unit_structures", "pct_without_plumbing", "pct_overcrowded_housing",
+    "pct_renter_occupied", "pct_households_without_a_vehicle",
+    "pct_with_access_to_a_vehicle", "commute_time", "pct_work_at_home",
+    "pct_professinal", "pct_service", "lat", "lng", "geom"
+] # 从您的建表语句中获取
+
+FIXED_DISPLAY_COLUMNS = ['id', 'state', 'county', 'city', 'zipcode', 'year'] # 这些列总是显示且不可选
+EXCLUDED_COLUMNS = ['geom', "lat", "lng"] # 这些列不参与选择和显示
+
+# 计算可选列 (从所有列中排除固定列和特定排除列)
+POSSIBLE_SELECTABLE_COLUMNS = sorted([
+    col for col in ALL_COLUMNS_FROM_SCHEMA
+    if col not in FIXED_DISPLAY_COLUMNS and col not in EXCLUDED_COLUMNS
+])
+
+TEXT_COLUMNS = ['state', 'county', 'city', 'zipcode'] # 其余可显示的列都是数值列
+# DataTable 列筛选 (filter_query) 允许使用的列及其类型
+FILTERABLE_COLUMNS = {
+    col: 'text' if col in TEXT_COLUMNS else 'numeric'
+    for col in ALL_COLUMNS_FROM_SCHEMA if col not in EXCLUDED_COLUMNS
+}
+
+# 初始状态下，“All”被选中，所以默认选中的列是固定列+所有可选列
+DEFAULT_SELECTED_COLUMNS = FIXED_DISPLAY_COLUMNS + POSSIBLE_SELECTABLE_COLUMNS
+
+# 可以导出的列 (所有可显示的列)
+EXPORTABLE_COLUMNS = [col for col in ALL_COLUMNS_FROM_SCHEMA if col not in EXCLUDED_COLUMNS]
+# 导出和下载的默认排序
+EXPORT_ORDER_BY = 'ORDER BY "year" DESC, "state" ASC, "zipcode" ASC'
+
+# --- 辅助函数：构建WHERE子句 ---
+def build_where_clause(filters_dict):
+    """
+    将 applied-filters-store 中的筛选条件转换为参数化的 WHERE 子句。
+    返回 (where_sql, params)，where_sql 中使用 %s 占位符，值通过 params 绑定，
+    因此同一组筛选维度无论选中什么值都对应同一条 SQL 文本（可复用预编译语句）。
+    """
+    return build_filter_clause({
+        'year': [int(y) for y in filters_dict.get('years') or []], # 年份是整数
+        'state': [str(s) for s in filters_dict.get('states') or []],
+        'county': [str(c) for c in filters_dict.get('counties') or []], # 按 County 筛选
+    })
+
+def build_datatable_where_clause(filters_dict, filter_query):
+    """
+    年份/州/县筛选加上 DataTable 列筛选 (filter_query) 的 WHERE 子句。
+    返回 (where_sql, params, 是否包含列筛选)。
+
+    Raises:
+        FilterQueryError: 列筛选无法解析 (未知列、运算符或非数值)。不能忽略它只按其余条件查询，
+                          否则页面会把所有行当作符合用户的筛选显示出来。
+    """
+    where_clause, where_params = build_where_clause(filters_dict or {})
+    column_sql, column_params = compile_filter_query(filter_query, FILTERABLE_COLUMNS)
+    if column_sql is None:
+        return where_clause, where_params, False
+    return f"{where_clause} AND {column_sql}", where_params + column_params, True
+
+# --- DataTable 排序与 keyset 翻页 ---
+# 翻到相邻页时用上一页首/尾行的排序键定位 (WHERE (排序表达式) > (键) ... LIMIT n)，
+# 配合相同表达式上的 B-tree 索引，代价只与页大小有关；OFFSET 需要扫描并丢弃前面所有行，只在跳页时使用。
+DEFAULT_DATATABLE_ORDER = [('year', True), ('state', False), ('zipcode', False)] # (列, 是否降序)
+DATATABLE_TIEBREAKER = 'id' # 唯一且非空，保证排序全序
+DATATABLE_ORDER_INDEX = "acs_data_all_datatable_order_idx" # 默认排序对应的索引 (见 datatable_order_index_sql)
+
+def datatable_order_keys(sort_by, selected_columns):
+    """返回 [(列名, 是否降序), ...]：当前排序列，末尾补上唯一的 id 作为决胜列。"""
+    keys = [(s_col['column_id'], s_col['direction'] == 'desc')
+            for s_col in (sort_by or []) if s_col['column_id'] in selected_columns]
+    keys = keys or list(DEFAULT_DATATABLE_ORDER)
+    if DATATABLE_TIEBREAKER not in [col for col, _ in keys]:
+        keys.append((DATATABLE_TIEBREAKER, False))
+    return keys
+
+def _sort_terms(keys):
+    """
+    把排序键改写成同一方向的表达式，使 keyset 条件可以写成一个行值比较 (PostgreSQL 能把它
+    用作复合索引的范围扫描)。返回 ([(表达式, 把键值转换为比较参数的函数)], 是否降序)。
+
+    每个可能为 NULL 的列拆成 NULL 标记和 COALESCE 后的值两项，顺序与 NULLS LAST 相同；
+    与整体方向相反的数值列取负。文本列无法取负，文本列升降序混排时返回 (None, None)。
+    """
+    text_directions = {desc for col, desc in keys if col in TEXT_COLUMNS}
+    if len(text_directions) > 1:
+        return None, None
+    descending = text_directions.pop() if text_directions else keys[0][1]
+    terms = []
+    for col, desc in keys:
+        column = f'"{col}"'
+        negate = desc != descending
+        if col == DATATABLE_TIEBREAKER: # 非空，不需要 NULL 标记
+            terms.append((f"-{column}" if negate else column, (lambda v: -v) if negate else (lambda v: v)))
+            continue
+        # 升序时 false (非空) 在前，降序时 true (非空) 在前：两种情况 NULL 都排在最后
+        if descending:
+            terms.append((f"({column} IS NOT NULL)", lambda v: v is not None))
+        else:
+            terms.append((f"({column} IS NULL)", lambda v: v is None))
+        default = "''" if col in TEXT_COLUMNS else "0"
+        value_sql = f"COALESCE({column}, {default})"
+        fill = "" if col in TEXT_COLUMNS else 0
+        if negate:
+            terms.append((f"(-{value_sql})", lambda v, fill=fill: -(fill if v is None else v)))
+        else:
+            terms.append((value_sql, lambda v, fill=fill: fill if v is None else v))
+    return terms, descending
+
+def order_by_sql(keys, reverse=False):
+    """ORDER BY 子句；NULL 固定排在最后，reverse=True 时整体反向 (用于向前翻页和末页)。"""
+    terms, descending = _sort_terms(keys)
+    if terms is not None:
+        direction = "DESC" if descending != reverse else "ASC"
+        return "ORDER BY " + ", ".join(f"{sql} {direction}" for sql, _ in terms)
+    parts = [f'"{col}" {"DESC" if desc != reverse else "ASC"} NULLS {"FIRST" if reverse else "LAST"}'
+             for col, desc in keys]
+    return "ORDER BY " + ", ".join(parts)
+
+def seek_clause(keys, values, reverse=False):
+    """
+    排在 values 之后 (reverse=True 时为之前) 的行的条件，返回 (sql, params)，顺序与 order_by_sql 一致。
+    通常是一个行值比较 (t1, t2, ...) > (%s, %s, ...)；文本列升降序混排时退回逐列展开的
+    (c1 在后) OR (c1 相等 AND c2 在后) OR ...，这种写法无法使用索引范围扫描。
+    """
+    terms, descending = _sort_terms(keys)
+    if terms is not None:
+        op = "<" if descending != reverse else ">"
+        params, term_values = [], iter(values)
+        for col, _ in keys: # 每列对应一项 (决胜列) 或两项 (NULL 标记 + 值)
+            value = next(term_values)
+            params += [value] if col == DATATABLE_TIEBREAKER else [value, value]
+        row = ", ".join(sql for sql, _ in terms)
+        return f"({row}) {op} ({', '.join(['%s'] * len(terms))})", [convert(v) for (_, convert), v in zip(terms, params)]
+    disjuncts, params = [], []
+    equal_sql, equal_params = [], []
+    for (col, desc), value in zip(keys, values):
+        nulls_last = not reverse
+        if value is None:
+            after_sql, after_params = (None, []) if nulls_last else (f'"{col}" IS NOT NULL', [])
+        else:
+            op = "<" if desc != reverse else ">"
+            after_sql = f'"{col}" {op} %s' + (f' OR "{col}" IS NULL' if nulls_last else '')
+            after_params = [value]
+        if after_sql is not None:
+            disjuncts.append("(" + " AND ".join(equal_sql + [f"({after_sql})"]) + ")")
+            params += equal_params + after_params
+        equal_sql.append(f'"{col}" IS NULL' if value is None else f'"{col}" = %s')
+        equal_params += [] if value is None else [value]
+    return ("(" + " OR ".join(disjuncts) + ")" if disjuncts else "FALSE"), params
+
+def datatable_order_index_sql(keys=None, table=ACS_TABLE, name=DATATABLE_ORDER_INDEX):
+    """
+    CREATE INDEX 语句：按 keys (默认为 DataTable 的默认排序) 的排序表达式建立的 B-tree 索引，
+    keyset 翻页的行值比较和 ORDER BY 都能直接使用它。其他排序列需要时可用同一函数生成索引。
+    """
+    terms, _ = _sort_terms(keys or datatable_order_keys(None, ()))
+    if terms is None:
+        raise ValueError("text sort columns in mixed directions cannot share one index")
+    columns = ", ".join(sql if sql.startswith(('"', '(')) else f"({sql})" for sql, _ in terms)
+    return f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"
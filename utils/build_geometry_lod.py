@@ -0,0 +1,73 @@
+# dashboard_project/utils/build_geometry_lod.py
+"""
+Builds the levels of detail of the ZCTA map geometry (offline step).
+
+Each level is the ZCTA GeoJSON simplified with a larger Douglas-Peucker tolerance. The
+simplification runs on shared arcs (utils/topology.py), so borders between neighbouring
+ZCTAs stay identical at every level. Writes one GeoJSON file per level plus manifest.json
+to ZCTA_LOD_DIR; the app picks them up at startup (utils/geometry.load_zcta_index).
+
+Run from the project root, and again whenever the ZCTA GeoJSON changes:
+    python -m utils.build_geometry_lod
+    python -m utils.build_geometry_lod --tolerances 0.001 0.005 0.02
+"""
+import argparse
+import json
+import os
+import time
+
+from utils.geometry import LOD_MANIFEST, ZCTA_GEOJSON_PATH, ZCTA_LOD_DIR, content_sha1, count_vertices
+from utils.topology import build_topology, simplify_topology, topology_to_features
+
+# 化简容差 (度)：0.0005 度约为 z=10.5 时的一个像素，0.03 度约为 z=4.5 时的一个像素
+DEFAULT_TOLERANCES = (0.0005, 0.002, 0.008, 0.03)
+
+
+def build_levels(source_path, output_dir, tolerances=DEFAULT_TOLERANCES):
+    """
+    Writes the simplified levels of `source_path` and their manifest to `output_dir`.
+
+    Returns:
+        dict: The manifest.
+    """
+    with open(source_path, 'rb') as f:
+        data = f.read()
+    features = json.loads(data).get("features", [])
+    started = time.perf_counter()
+    topology = build_topology(features)
+    print(f"Topology: {len(features)} features, {len(topology.arcs)} arcs "
+          f"({time.perf_counter() - started:.1f}s).")
+
+    os.makedirs(output_dir, exist_ok=True)
+    source_vertices = sum(count_vertices(f.get("geometry")) for f in features)
+    manifest = {"source": os.path.basename(source_path), "source_sha1": content_sha1(data),
+                "source_vertices": source_vertices, "levels": []}
+    for i, tolerance in enumerate(sorted(tolerances), start=1):
+        level_features = topology_to_features(topology, simplify_topology(topology, tolerance), fallback=features)
+        file_name = f"zcta_lod_{i}.json"
+        tmp_path = os.path.join(output_dir, f"{file_name}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({"type": "FeatureCollection", "features": level_features}, f, separators=(",", ":"))
+        os.replace(tmp_path, os.path.join(output_dir, file_name))
+        vertices = sum(count_vertices(f.get("geometry")) for f in level_features)
+        manifest["levels"].append({"file": file_name, "tolerance": tolerance, "vertices": vertices})
+        print(f"Level {i}: tolerance {tolerance}, {vertices} vertices "
+              f"({vertices / max(source_vertices, 1):.1%} of the source).")
+    # manifest 最后写入：加载方只会看到完整的一组层级
+    with open(os.path.join(output_dir, LOD_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build levels of detail of the ZCTA map geometry.")
+    parser.add_argument("--source", default=ZCTA_GEOJSON_PATH, help="ZCTA GeoJSON (default: ZCTA_GEOJSON_PATH)")
+    parser.add_argument("--output", default=ZCTA_LOD_DIR, help="Output directory (default: ZCTA_LOD_DIR)")
+    parser.add_argument("--tolerances", type=float, nargs="+", default=list(DEFAULT_TOLERANCES),
+                        help="Simplification tolerances in degrees, one level each")
+    args = parser.parse_args()
+    build_levels(args.source, args.output, args.tolerances)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# dashboard_project/utils/convert_geometry.py
+"""
+Converts the ZCTA GeoJSON into the packed geometry file (see utils/packed_geometry.py):
+shared arcs, coordinates quantized to integers and delta-encoded, levels of detail stored
+as bit masks over the arc points, all in one compressed .npz that loads with a few array
+operations instead of a json.load of the whole country.
+
+Run from the project root, and again whenever the ZCTA GeoJSON changes:
+    python -m utils.convert_geometry
+    python -m utils.convert_geometry --quantum 0.00001 --tolerances 0.002 0.01
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from utils.build_geometry_lod import DEFAULT_TOLERANCES
+from utils.geometry import ZCTA_GEOJSON_PATH, ZCTA_PACKED_PATH, ZCTA_PROPERTY, content_sha1, feature_bbox
+from utils.packed_geometry import FORMAT_VERSION
+from utils.topology import build_topology, simplify_mask
+
+
+def _offsets(lengths) -> np.ndarray:
+    return np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])
+
+
+def write_packed_geometry(path, features, id_property=ZCTA_PROPERTY, tolerances=DEFAULT_TOLERANCES,
+                          quantum=1e-6, source_sha1=""):
+    """
+    Writes `features` (GeoJSON Polygon/MultiPolygon features) as a packed geometry file.
+
+    Args:
+        quantum (float): Coordinate resolution in degrees; 1e-6 keeps 6-decimal input lossless.
+        tolerances (iterable of float): Simplification tolerance of each level of detail, in degrees.
+
+    Returns:
+        dict: Sizes of the written topology (features, arcs, points).
+    """
+    topology = build_topology(features)
+    arcs = topology.arcs
+    points = np.concatenate(arcs) if arcs else np.empty((0, 2))
+    origin = points.min(axis=0) if len(points) else np.zeros(2)
+    quantized = np.rint((points - origin) / quantum).astype(np.int64)
+    if len(quantized) and quantized.max() > np.iinfo(np.int32).max:
+        raise ValueError(f"quantum {quantum} is too fine for the extent of the geometry")
+    deltas = np.diff(quantized, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).astype(np.int32)
+
+    refs, ring_lengths, polygon_lengths, feature_lengths = [], [], [], []
+    for geometry in topology.geometries:
+        feature_lengths.append(len(geometry))
+        for rings in geometry:
+            polygon_lengths.append(len(rings))
+            for ring in rings:
+                ring_lengths.append(len(ring))
+                refs += ring
+
+    levels = sorted(tolerances)
+    masks = np.zeros((len(levels), (len(points) + 7) // 8), dtype=np.uint8)
+    for i, tolerance in enumerate(levels):
+        masks[i] = np.packbits(np.concatenate([simplify_mask(arc, tolerance) for arc in arcs]) if arcs else [])
+
+    tmp_path = f"{path}.tmp.npz"
+    np.savez_compressed(
+        tmp_path,
+        format_version=np.int32(FORMAT_VERSION),
+        id_property=np.str_(id_property),
+        source_sha1=np.str_(source_sha1),
+        ids=np.array([str(f.get("properties", {}).get(id_property)) for f in features], dtype=str),
+        bboxes=np.array([feature_bbox(f) for f in features], dtype=np.float64).reshape(-1, 4),
+        quantum=np.float64(quantum),
+        origin=origin.astype(np.float64),
+        deltas=deltas,
+        arc_offsets=_offsets([len(arc) for arc in arcs]),
+        refs=np.array(refs, dtype=np.int32),
+        ring_offsets=_offsets(ring_lengths),
+        polygon_offsets=_offsets(polygon_lengths),
+        feature_offsets=_offsets(feature_lengths),
+        tolerances=np.array(levels, dtype=np.float64),
+        level_masks=masks,
+    )
+    os.replace(tmp_path, path)
+    return {"features": len(features), "arcs": len(arcs), "points": len(points)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the ZCTA GeoJSON into the packed geometry file.")
+    parser.add_argument("--source", default=ZCTA_GEOJSON_PATH, help="ZCTA GeoJSON (default: ZCTA_GEOJSON_PATH)")
+    parser.add_argument("--output", default=ZCTA_PACKED_PATH, help="Packed file (default: ZCTA_PACKED_PATH)")
+    parser.add_argument("--quantum", type=float, default=1e-6, help="Coordinate resolution in degrees")
+    parser.add_argument("--tolerances", type=float, nargs="*", default=list(DEFAULT_TOLERANCES),
+                        help="Simplification tolerances in degrees, one level of detail each")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    with open(args.source, 'rb') as f:
+        data = f.read()
+    features = json.loads(data).get("features", [])
+    sizes = write_packed_geometry(args.output, features, tolerances=args.tolerances,
+                                  quantum=args.quantum, source_sha1=content_sha1(data))
+    print(f"Wrote {args.output}: {sizes['features']} features, {sizes['arcs']} arcs, {sizes['points']} points, "
+          f"{os.path.getsize(args.output) / 1e6:.1f} MB (GeoJSON: {len(data) / 1e6:.1f} MB) "
+          f"in {time.perf_counter() - started:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()
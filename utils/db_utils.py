@@ -1,9 +1,36 @@
 # dashboard_project/utils/db_connector.py
+import contextvars
+import hashlib
+import io
+import itertools
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
 import pandas as pd
 import psycopg2 # For PostgreSQL connection
-import os
+import psycopg2.errors
+import psycopg2.extensions
 from dotenv import load_dotenv # Optional: for loading .env files
 
+try: # Optional: pyarrow 的 CSV 解析器比 pandas 快得多，并且可以直接返回 Arrow Table
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+    pa_csv = None
+
+from utils.metrics import Counter, Histogram, CallbackMetric
+from utils.snapshot_store import SnapshotStore, qualified_name, write_snapshot
+
 # Optional: Load environment variables from a .env file in your project root
 load_dotenv()
 
@@ -15,98 +42,1371 @@ DB_PASSWORD = os.getenv("DB_PASSWORD", "your_postgres_password") # Replace if no
 DB_HOST = os.getenv("DB_HOST", "localhost") # Or your DB host
 DB_PORT = os.getenv("DB_PORT", "5432") # Default PostgreSQL port
 
-_db_connection = None
+# --- Connection Pool Settings ---
+DB_POOL_MIN_CONN = int(os.getenv("DB_POOL_MIN_CONN", "1"))
+DB_POOL_MAX_CONN = int(os.getenv("DB_POOL_MAX_CONN", "10"))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.getenv("DB_POOL_CHECKOUT_TIMEOUT", "10")) # 等待空闲连接的最长秒数
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "5")) # 空闲超过该秒数的连接在借出前先 SELECT 1 检查
+DB_QUERY_WORKERS = int(os.getenv("DB_QUERY_WORKERS", os.getenv("DB_POOL_MAX_CONN", "10"))) # fetch_many 的并发线程数
+# fetch_data_async (相邻页预取等推测性查询) 使用独立的小线程池，排队的预取不会挡在交互查询 (fetch_many) 前面
+DB_PREFETCH_WORKERS = int(os.getenv("DB_PREFETCH_WORKERS", "2"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000")) # 每条语句的默认超时 (毫秒)，0 表示不限制
+
+# --- Read/Write Routing ---
+# libpq 连接串 (postgresql://... URI 或 key=value 形式)。未设置 DB_PRIMARY_DSN 时使用上面的 DB_* 变量
+DB_PRIMARY_DSN = os.getenv("DB_PRIMARY_DSN", "") # 主库：ETL 写入和 dataset_versions
+DB_REPLICA_DSN = os.getenv("DB_REPLICA_DSN", "") # 只读副本：为空时所有查询都走主库
+DB_REPLICA_MAX_LAG_SECONDS = float(os.getenv("DB_REPLICA_MAX_LAG_SECONDS", "30")) # 复制延迟超过该值时读查询回退到主库
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "10")) # 检查副本延迟的间隔秒数
+DB_REPLICA_MAX_RECEIPT_AGE = float(os.getenv("DB_REPLICA_MAX_RECEIPT_AGE", "60")) # 副本超过该秒数没收到主库的消息时不再认为已追平
+
+# --- Prepared Statement Settings ---
+DB_PREPARE_STATEMENTS = os.getenv("DB_PREPARE_STATEMENTS", "true").lower() in ("1", "true", "yes")
+DB_MAX_PREPARED_PER_CONN = int(os.getenv("DB_MAX_PREPARED_PER_CONN", "200")) # 每个连接最多保留的预编译语句数 (LRU)
+
+# --- Bulk Fetch Settings ---
+DB_BULK_FETCH_MIN_ROWS = int(os.getenv("DB_BULK_FETCH_MIN_ROWS", "20000")) # 估算行数超过该值时 fetch_data(bulk=None) 改走 COPY
+DB_ITER_CHUNK_SIZE = int(os.getenv("DB_ITER_CHUNK_SIZE", "10000")) # fetch_iter 每批行数
+
+# --- Query Cache Settings (fetch_data(..., cache=True)) ---
+DB_QUERY_CACHE_MAX_BYTES = int(os.getenv("DB_QUERY_CACHE_MAX_BYTES", str(64 * 1024 * 1024))) # 0 表示禁用缓存
+DB_QUERY_CACHE_TTL = float(os.getenv("DB_QUERY_CACHE_TTL", "300")) # 缓存条目存活秒数
+DB_DATASET_VERSION_CHECK_INTERVAL = float(os.getenv("DB_DATASET_VERSION_CHECK_INTERVAL", "30")) # 检查 ETL 是否写入新数据的间隔秒数
+DATASET_VERSION_TABLE = "public.dataset_versions" # ETL 每次写入后递增对应表的版本号
+
+# --- Snapshot Read Backend (DuckDB over Parquet) ---
+DB_READ_BACKEND = os.getenv("DB_READ_BACKEND", "postgres").lower() # "duckdb": 只读分析查询改由本地 Parquet 快照回答
+DB_SNAPSHOT_DIR = os.getenv("DB_SNAPSHOT_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "snapshots"))
+DB_SNAPSHOT_THREADS = int(os.getenv("DB_SNAPSHOT_THREADS", "0")) # DuckDB 线程数，0 表示使用全部 CPU
+
+# --- Instrumentation Settings ---
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "1000")) # 超过该耗时的查询写入慢查询日志
+slow_query_logger = logging.getLogger("dashboard.slow_queries")
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no pooled connection becomes free within the checkout timeout."""
+
+
+class DatabasePool:
+    """
+    Thread-safe PostgreSQL connection pool.
+
+    psycopg2's own pools fail immediately when exhausted and close every returned
+    connection above `minconn`, so under a threaded Gunicorn worker they either error
+    out or reconnect on most requests. This pool keeps up to `maxconn` connections open,
+    blocks for a free one up to a checkout timeout, pings connections that have been
+    idle before handing them out, and keeps checkout statistics. It remembers the PID
+    that created it so a forked worker never reuses sockets inherited from its parent.
+    """
+
+    def __init__(self, minconn, maxconn, checkout_timeout=DB_POOL_CHECKOUT_TIMEOUT,
+                 ping_after=DB_POOL_PING_AFTER, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.ping_after = ping_after
+        self.pid = os.getpid()
+        self._connect_kwargs = connect_kwargs
+        self._slots = threading.BoundedSemaphore(maxconn) # 每个借出的连接占用一个名额
+        self._lock = threading.Lock()
+        self._idle = [] # [(conn, 归还时间)]，后进先出，最近用过的连接最可能是活的
+        self._open = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def getconn(self, timeout=None):
+        """
+        Borrows a live connection, waiting up to `timeout` seconds for a free slot.
+
+        Raises:
+            PoolTimeoutError: If the pool stays exhausted for the whole timeout.
+            psycopg2.Error: If a new connection cannot be opened.
+        """
+        timeout = self.checkout_timeout if timeout is None else timeout
+        with self._lock:
+            self._waiting += 1
+        started = time.monotonic()
+        acquired = self._slots.acquire(timeout=timeout)
+        waited = time.monotonic() - started
+        with self._lock:
+            self._waiting -= 1
+            if not acquired:
+                self._timeouts += 1
+        if not acquired:
+            raise PoolTimeoutError(f"No database connection available after {timeout:.1f}s")
+
+        try:
+            conn = None
+            while conn is None:
+                with self._lock:
+                    conn, returned_at = self._idle.pop() if self._idle else (None, None)
+                if conn is None:
+                    conn = self._connect()
+                elif not self._is_alive(conn, returned_at):
+                    self._close(conn)
+                    conn = None
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Returns a borrowed connection; broken connections are closed instead of recycled."""
+        try:
+            if not close and not conn.closed:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    close = True # 与服务器的连接已断开
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        close = True
+            if close or conn.closed:
+                self._close(conn)
+            else:
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        """Returns a snapshot of pool usage counters."""
+        with self._lock:
+            return {
+                "pid": self.pid,
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "open": self._open,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "checkouts": self._checkouts,
+                "timeouts": self._timeouts,
+                "discarded": self._discarded,
+                "avg_checkout_ms": (self._total_wait / self._checkouts * 1000) if self._checkouts else 0.0,
+                "max_checkout_ms": self._max_wait * 1000,
+            }
+
+    def _connect(self):
+        conn = psycopg2.connect(**self._connect_kwargs)
+        with self._lock:
+            self._open += 1
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._lock:
+            self._open -= 1
+            self._discarded += 1
+
+    def _is_alive(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.ping_after:
+            return True # 刚用过的连接，跳过 ping
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+_db_pools = {} # role ('primary' / 'replica') -> 当前进程的 DatabasePool
+_db_pool_lock = threading.Lock()
+# 父进程遗留的连接池：fork 之后不能在子进程里 close（会断开父进程的会话），只保留引用防止被回收
+_inherited_pools = []
+# 借出的连接 -> 所属连接池，归还时放回同一个池
+_conn_pools = weakref.WeakKeyDictionary()
+
+# 副本健康状态，由 _read_role() 每 DB_REPLICA_CHECK_INTERVAL 秒刷新一次
+_replica_lag = None # 最近一次测得的复制延迟 (秒)，None 表示副本不可用
+_replica_healthy = False
+_replica_checked_at = float("-inf")
+_replica_lock = threading.Lock()
+
+# 副本已追平 WAL 时 pg_last_xact_replay_timestamp() 不再前进，空闲的主库会让它看起来“越来越落后”，所以先比较 LSN。
+# 但 WAL 接收进程断开后 receive LSN 也停止前进，回放很快追平，LSN 相等并不代表数据是新的：只有接收进程处于
+# streaming 且最近收到过主库消息 (空闲时也有 keepalive) 时才认为延迟为 0，否则按最后回放事务的时间计算；
+# 没有接收进程 (或看不到它的状态，需要 pg_read_all_stats 权限) 时返回 NULL，视为严重落后
+_REPLICA_LAG_SQL = """
+    WITH receiver AS (SELECT status, last_msg_receipt_time FROM pg_stat_wal_receiver)
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN NOT EXISTS (SELECT 1 FROM receiver WHERE status = 'streaming') THEN NULL
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+             AND EXISTS (SELECT 1 FROM receiver WHERE last_msg_receipt_time >= now() - make_interval(secs => %s)) THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END"""
+
+def _connect_kwargs(role: str) -> dict:
+    """psycopg2.connect() arguments for the primary or replica database."""
+    dsn = DB_REPLICA_DSN if role == "replica" else DB_PRIMARY_DSN
+    if dsn:
+        return {"dsn": dsn}
+    return {"dbname": DB_NAME, "user": DB_USER, "password": DB_PASSWORD, "host": DB_HOST, "port": DB_PORT}
+
+def get_db_pool(role="primary"):
+    """
+    Returns this process's connection pool for `role`, creating it on first use.
+    A pool inherited across fork() is left untouched and a fresh one is built,
+    so every Gunicorn worker owns its own sockets.
+
+    Args:
+        role (str): 'primary' (writes, ETL), 'replica' (the primary when DB_REPLICA_DSN
+                    is not set) or 'read' (the replica unless it is down or lagging).
+
+    Returns:
+        DatabasePool or None: None if the database cannot be reached.
+    """
+    if role == "read":
+        role = _read_role()
+    elif role == "replica" and not DB_REPLICA_DSN:
+        role = "primary"
+    pool = _db_pools.get(role)
+    if pool is not None and pool.pid == os.getpid():
+        return pool
 
-def get_db_connection():
+    with _db_pool_lock:
+        pool = _db_pools.get(role)
+        if pool is not None and pool.pid != os.getpid():
+            _inherited_pools.append(pool)
+            pool = None
+        if pool is None:
+            try:
+                pool = DatabasePool(
+                    DB_POOL_MIN_CONN, DB_POOL_MAX_CONN,
+                    options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}",
+                    **_connect_kwargs(role)
+                )
+            except psycopg2.Error as e:
+                print(f"Error connecting to PostgreSQL {role} database: {e}")
+                _db_pools.pop(role, None)
+                return None
+            _db_pools[role] = pool
+        return pool
+
+def _measure_replica_lag():
     """
-    Establishes and returns a psycopg2 database connection.
-    Uses environment variables for connection parameters.
-    If a connection already exists and is open, it will be reused (simple reuse).
-    For production, consider a proper connection pool.
+    Returns the replica's replication lag in seconds (inf while it is not streaming WAL from
+    the primary), or None if it cannot be reached.
     """
-    global _db_connection
+    pool = get_db_pool("replica")
+    if pool is None:
+        return None
     try:
-        # Check if connection exists and is still open
-        if _db_connection and not _db_connection.closed:
-            # You might want to check if the connection is usable, e.g., _db_connection.status == psycopg2.extensions.STATUS_READY
-            # For simplicity, we assume it's fine if not closed.
-            return _db_connection
-
-        # print(f"Attempting to connect to PostgreSQL: {DB_HOST}:{DB_PORT}/{DB_NAME} as {DB_USER}")
-        _db_connection = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        # print("Database connection established successfully.")
-        return _db_connection
+        conn = pool.getconn()
+    except (PoolTimeoutError, psycopg2.Error) as e:
+        print(f"Error checking out replica connection: {e}")
+        return None
+    try:
+        with conn.cursor() as cur:
+            cur.execute(_REPLICA_LAG_SQL, (DB_REPLICA_MAX_RECEIPT_AGE,))
+            lag = cur.fetchone()[0]
+            lag = float("inf") if lag is None else float(lag) # 未在接收 WAL：视为无限落后
+        conn.rollback()
+        pool.putconn(conn)
+        return lag
     except psycopg2.Error as e:
-        print(f"Error connecting to PostgreSQL database: {e}")
-        _db_connection = None # Reset connection on error
+        print(f"Error measuring replica lag: {e}")
+        pool.putconn(conn, close=True)
         return None
 
-def fetch_data(query: str, params=None) -> pd.DataFrame:
+def _set_replica_health(lag):
+    """Stores the latest lag measurement and logs when reads switch between replica and primary."""
+    global _replica_lag, _replica_healthy
+    healthy = lag is not None and lag <= DB_REPLICA_MAX_LAG_SECONDS
+    if healthy != _replica_healthy:
+        if healthy:
+            print(f"Read replica is available (lag {lag:.1f}s); routing reads to it.")
+        elif lag is None:
+            print("Read replica is unreachable; routing reads to the primary.")
+        elif lag == float("inf"):
+            print("Read replica is not streaming WAL from the primary; routing reads to the primary.")
+        else:
+            print(f"Read replica is {lag:.1f}s behind (max {DB_REPLICA_MAX_LAG_SECONDS:g}s); routing reads to the primary.")
+    _replica_lag, _replica_healthy = lag, healthy
+
+def _read_role() -> str:
+    """Picks the pool for a read: the replica while it is reachable and within DB_REPLICA_MAX_LAG_SECONDS."""
+    global _replica_checked_at
+    if not DB_REPLICA_DSN:
+        return "primary"
+    with _replica_lock:
+        now = time.monotonic()
+        due = now - _replica_checked_at >= DB_REPLICA_CHECK_INTERVAL
+        if due:
+            _replica_checked_at = now
+    if due:
+        _set_replica_health(_measure_replica_lag())
+    return "replica" if _replica_healthy else "primary"
+
+def get_replica_status():
+    """Returns whether a replica is configured, whether reads currently go to it, and its last measured lag."""
+    return {"configured": bool(DB_REPLICA_DSN), "serving_reads": _replica_healthy, "lag_seconds": _replica_lag}
+
+def get_db_connection(timeout=None, role="primary"):
+    """
+    Borrows a psycopg2 connection from the pool.
+    The caller must hand it back with release_db_connection(); prefer the
+    db_connection() context manager, which does that automatically.
+
+    Args:
+        timeout (float, optional): Seconds to wait for a free connection.
+        role (str, optional): 'primary' for writes, 'read' for queries that may be served
+                              by the replica. A read falls back to the primary when the
+                              replica cannot hand out a connection.
+
+    Returns:
+        A psycopg2 connection, or None if the database is unreachable or the
+        pool stayed exhausted for the whole checkout timeout.
+    """
+    target = _read_role() if role == "read" else role
+    pool = get_db_pool(target)
+    conn = None
+    if pool is not None:
+        try:
+            conn = pool.getconn(timeout=timeout)
+        except PoolTimeoutError as e:
+            print(f"Error checking out PostgreSQL connection: {e}")
+        except psycopg2.Error as e:
+            print(f"Error checking out PostgreSQL connection: {e}")
+            pool = None
+    if conn is None and role == "read" and target == "replica":
+        if pool is None:
+            _set_replica_health(None) # 副本连不上，下次检查前都走主库
+        return get_db_connection(timeout=timeout, role="primary")
+    if conn is not None:
+        _conn_pools[conn] = pool
+        if role == "read":
+            READS_ROUTED.inc(target=target)
+    return conn
+
+def release_db_connection(conn, close=False):
+    """
+    Returns a connection obtained from get_db_connection() to the pool it came from.
+
+    Raises:
+        ValueError: If `conn` did not come from get_db_connection() or was already released.
+    """
+    if conn is None:
+        return
+    pool = _conn_pools.pop(conn, None)
+    if conn in _cancelled_conns: # 见 cancel_superseded()
+        _cancelled_conns.discard(conn)
+        close = True
+    if pool is None: # 不是从连接池借出的连接，或已经归还过：放回任何池都会让两个请求共用同一个会话
+        raise ValueError("Connection was not checked out with get_db_connection() or was already released")
+    pool.putconn(conn, close=close)
+
+@contextmanager
+def db_connection(timeout=None, role="primary"):
+    """
+    Context manager around get_db_connection()/release_db_connection().
+    Yields None if no connection could be obtained. Connections that broke while
+    in use (e.g. after a server restart) are dropped instead of being recycled.
+    """
+    conn = get_db_connection(timeout=timeout, role=role)
+    try:
+        yield conn
+    finally:
+        if conn is not None:
+            release_db_connection(conn)
+
+def get_pool_stats(role="primary"):
+    """Returns the current pool counters (in use, waiting, checkout latency...), or {} if no pool."""
+    pool = get_db_pool(role)
+    return pool.stats() if pool is not None else {}
+
+def get_sqlalchemy_url(role="primary"):
+    """
+    Returns a SQLAlchemy URL for the primary (ETL loads) or replica database, built from
+    DB_PRIMARY_DSN / DB_REPLICA_DSN or the DB_* variables, so scripts don't hardcode credentials.
+    """
+    from sqlalchemy.engine import URL # 只有 ETL 和独立脚本需要 SQLAlchemy
+
+    kwargs = _connect_kwargs("replica" if role == "replica" and DB_REPLICA_DSN else "primary")
+    params = psycopg2.extensions.parse_dsn(kwargs.pop("dsn")) if "dsn" in kwargs else kwargs
+    params = {k: v for k, v in params.items() if v not in (None, "")}
+    return URL.create(
+        "postgresql+psycopg2",
+        username=params.pop("user", None),
+        password=params.pop("password", None),
+        host=params.pop("host", None),
+        port=int(params.pop("port")) if "port" in params else None,
+        database=params.pop("dbname", None),
+        query=params,
+    )
+
+class QueryCache:
+    """
+    Thread-safe in-memory cache of query results (DataFrames).
+
+    Entries are evicted least-recently-used once the total DataFrame size exceeds
+    `max_bytes`, and expire `ttl` seconds after they were stored. clear() bumps a
+    generation counter so a result fetched before an invalidation is never stored after it.
+    """
+
+    def __init__(self, max_bytes=DB_QUERY_CACHE_MAX_BYTES, ttl=DB_QUERY_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (df, nbytes, expires_at)
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def get(self, key):
+        """Returns a copy of the cached DataFrame for `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            df = entry[0]
+        return df.copy() # 回调里常会就地修改 DataFrame，缓存中保存的副本不能被改动
+
+    def put(self, key, df, generation):
+        """Stores a copy of `df` unless the cache was cleared since `generation` was read."""
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        df = df.copy()
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (df, nbytes, time.monotonic() + self.ttl)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.generation += 1
+            self._invalidations += 1
+
+    def stats(self):
+        """Returns hit/miss counters and current memory use."""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": self._hits / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+            }
+
+    def _remove(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self._bytes -= nbytes
+
+
+_query_cache = QueryCache()
+_dataset_version = None
+_dataset_version_checked_at = float("-inf")
+_dataset_version_lock = threading.Lock()
+
+def _freeze(value):
+    """A hashable copy of query parameters: mappings as sorted (name, value) items, lists as tuples."""
+    if isinstance(value, Mapping): # %(name)s 占位符：值也必须进入缓存键，而不仅是参数名
+        return ("mapping", tuple(sorted(((str(k), _freeze(v)) for k, v in value.items()), key=lambda item: item[0])))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def _cache_key(query: str, params=None):
+    """Normalizes whitespace/trailing semicolons in the SQL and freezes params into a hashable key."""
+    sql = " ".join(query.split()).rstrip(";").strip()
+    return sql, _freeze(params) if params else ()
+
+def _read_dataset_version():
+    """Returns the current dataset version token, () if the version table does not exist, None on error."""
+    # 与查询走同一个库：副本上版本号和数据一起复制，版本变化时数据也已经可见
+    with db_connection(role="read") as conn:
+        if conn is None:
+            return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT table_name, version FROM {DATASET_VERSION_TABLE} ORDER BY table_name")
+                token = tuple(cur.fetchall())
+            conn.rollback()
+            return token
+        except psycopg2.errors.UndefinedTable:
+            conn.rollback()
+            return ()
+        except psycopg2.Error as e:
+            print(f"Error reading dataset version: {e}")
+            return None
+
+def _refresh_dataset_version(interval=None):
+    """
+    Clears the query cache when the ETL has bumped a dataset version (checked at most every
+    `interval` seconds, default DB_DATASET_VERSION_CHECK_INTERVAL).
+    """
+    global _dataset_version, _dataset_version_checked_at
+    interval = DB_DATASET_VERSION_CHECK_INTERVAL if interval is None else interval
+    with _dataset_version_lock:
+        now = time.monotonic()
+        if now - _dataset_version_checked_at < interval:
+            return
+        _dataset_version_checked_at = now
+    token = _read_dataset_version()
+    if token is None:
+        return
+    with _dataset_version_lock:
+        if _dataset_version is not None and token != _dataset_version:
+            _query_cache.clear()
+        _dataset_version = token
+
+def invalidate_query_cache():
+    """Drops every cached query result in this process."""
+    _query_cache.clear()
+
+def get_query_cache_stats():
+    """Returns the query cache's hit/miss counters and memory use."""
+    return _query_cache.stats()
+
+def bump_dataset_version(table_name: str):
+    """
+    Records that `table_name` received new data. Called by the ETL after each load;
+    dashboard workers notice the new version within DB_DATASET_VERSION_CHECK_INTERVAL
+    seconds and drop their cached query results.
+
+    Returns:
+        int or None: The new version number, or None on error.
+    """
+    with db_connection() as conn:
+        if conn is None:
+            print("Database connection not established. Cannot bump dataset version.")
+            return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {DATASET_VERSION_TABLE} (
+                        table_name TEXT PRIMARY KEY,
+                        version BIGINT NOT NULL,
+                        loaded_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    )""")
+                cur.execute(f"""
+                    INSERT INTO {DATASET_VERSION_TABLE} (table_name, version) VALUES (%s, 1)
+                    ON CONFLICT (table_name) DO UPDATE
+                    SET version = {DATASET_VERSION_TABLE}.version + 1, loaded_at = now()
+                    RETURNING version""", (table_name,))
+                version = cur.fetchone()[0]
+            conn.commit()
+        except psycopg2.Error as e:
+            print(f"Error bumping dataset version for {table_name}: {e}")
+            return None
+    invalidate_query_cache()
+    return version
+
+def get_dataset_version(table_name: str, role="read", max_age=None):
+    """
+    Returns the current version number of `table_name` (0 if it was never bumped), or
+    None on error. Use it to key anything derived from the table's data, e.g. export files.
+
+    Args:
+        table_name (str): Table name as passed to bump_dataset_version.
+        role (str, optional): Connection role of the live read (see fetch_data).
+        max_age (float, optional): Answer from the version token kept in this process (the one
+                                   that invalidates the query cache), re-read at most every
+                                   max_age seconds, instead of querying on every call. For hot
+                                   paths such as page changes and map renders.
+    """
+    if max_age is not None:
+        _refresh_dataset_version(max_age)
+        with _dataset_version_lock:
+            token = _dataset_version
+        return None if token is None else dict(token).get(table_name, 0)
+    with db_connection(role=role) as conn:
+        if conn is None:
+            return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT version FROM {DATASET_VERSION_TABLE} WHERE table_name = %s", (table_name,))
+                row = cur.fetchone()
+            conn.rollback()
+            return row[0] if row else 0
+        except psycopg2.errors.UndefinedTable:
+            conn.rollback()
+            return 0
+        except psycopg2.Error as e:
+            print(f"Error reading dataset version of {table_name}: {e}")
+            return None
+
+
+# --- Query Building ---
+def quote_ident(name: str) -> str:
+    """Quotes a SQL identifier (column/table name) for PostgreSQL."""
+    return '"' + str(name).replace('"', '""') + '"'
+
+def build_filter_clause(filters: dict) -> tuple:
+    """
+    Builds a parameterized WHERE fragment from a {column: values} mapping.
+    Columns with empty/None values are skipped; each remaining column becomes one
+    `"column" = ANY(%s)` predicate bound to the list of values, so the statement text
+    only depends on which filters are active, not on the selected values.
+
+    Example:
+        build_filter_clause({"year": [2020, 2021], "state": ["CA"], "county": []})
+        -> ('"year" = ANY(%s) AND "state" = ANY(%s)', [[2020, 2021], ['CA']])
+
+    Returns:
+        tuple: (sql, params). sql is "1=1" when no filter is active.
+    """
+    conditions = []
+    params = []
+    for column, values in filters.items():
+        if values:
+            conditions.append(f"{quote_ident(column)} = ANY(%s)")
+            params.append(list(values))
+    if not conditions:
+        return "1=1", []
+    return " AND ".join(conditions), params
+
+
+# --- Prepared Statements ---
+_PREPARABLE_RE = re.compile(r"^\s*(SELECT|WITH|VALUES|INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+_PLACEHOLDER_RE = re.compile(r"%(s|%)")
+# conn -> OrderedDict(statement name -> None)，连接关闭/回收后自动清理
+_prepared_by_conn = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+def _to_server_placeholders(query: str) -> str:
+    """Rewrites psycopg2 placeholders (%s, %%) into PostgreSQL's $1, $2 ... for PREPARE."""
+    counter = itertools.count(1)
+    return _PLACEHOLDER_RE.sub(lambda m: f"${next(counter)}" if m.group(1) == "s" else "%", query)
+
+def _execute_prepared(cur, query: str, params=None):
+    """
+    Executes `query` through a server-side prepared statement cached on the cursor's connection.
+    The first call on a connection issues PREPARE; later calls with the same SQL text only
+    send EXECUTE with the bound values, so PostgreSQL skips parsing and (after a few runs)
+    planning. At most DB_MAX_PREPARED_PER_CONN statements are kept per connection.
+    """
+    conn = cur.connection
+    sql = query.strip().rstrip(";")
+    name = "dash_" + hashlib.md5(sql.encode("utf-8")).hexdigest()[:16]
+    params = list(params) if params is not None else []
+
+    with _prepared_lock:
+        prepared = _prepared_by_conn.setdefault(conn, OrderedDict())
+    if name in prepared:
+        prepared.move_to_end(name)
+    else:
+        cur.execute(f"PREPARE {name} AS {_to_server_placeholders(sql) if params else sql}")
+        prepared[name] = None
+        if len(prepared) > DB_MAX_PREPARED_PER_CONN:
+            evicted, _ = prepared.popitem(last=False)
+            cur.execute(f"DEALLOCATE {evicted}")
+
+    if params:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
+
+# --- Instrumentation ---
+QUERY_DURATION = Histogram("dashboard_db_query_duration_seconds", "Wall time of database queries.", ("callback", "path"))
+QUERY_ROWS = Counter("dashboard_db_query_rows_total", "Rows returned by database queries.", ("callback",))
+QUERY_BYTES = Counter("dashboard_db_query_bytes_total", "Approximate in-memory bytes of query results.", ("callback",))
+QUERY_ERRORS = Counter("dashboard_db_query_errors_total", "Database queries that failed.", ("callback",))
+SLOW_QUERIES = Counter("dashboard_db_slow_queries_total", "Queries slower than DB_SLOW_QUERY_MS.", ("callback",))
+QUERY_CANCELLED = Counter("dashboard_db_query_cancelled_total", "Queries cancelled by a newer invocation or statement_timeout.", ("callback", "reason"))
+READS_ROUTED = Counter("dashboard_db_reads_routed_total", "Read connections checked out, by the database that served them.", ("target",))
+CallbackMetric("dashboard_db_replica_lag_seconds", "Last measured replication lag of the read replica.",
+               lambda: _replica_lag)
+
+def _local_pool_stat(name):
+    """Reads one counter from each of this process's pools without creating a pool just to report on it."""
+    return {role: pool.stats()[name] for role, pool in list(_db_pools.items()) if pool.pid == os.getpid()}
+
+for _stat, _type, _doc in [
+    ("open", "gauge", "Open pooled connections."),
+    ("in_use", "gauge", "Pooled connections currently checked out."),
+    ("idle", "gauge", "Idle pooled connections."),
+    ("waiting", "gauge", "Threads waiting for a pooled connection."),
+    ("max_checkout_ms", "gauge", "Longest wait for a pooled connection, in milliseconds."),
+    ("checkouts", "counter", "Connections checked out of the pool."),
+    ("timeouts", "counter", "Checkouts that gave up after DB_POOL_CHECKOUT_TIMEOUT."),
+]:
+    CallbackMetric(f"dashboard_db_pool_{_stat}" + ("_total" if _type == "counter" else ""), _doc,
+                   lambda _stat=_stat: _local_pool_stat(_stat), type_name=_type, labelname="role")
+for _stat, _type, _doc in [
+    ("entries", "gauge", "Results held in the query cache."),
+    ("bytes", "gauge", "Approximate bytes held in the query cache."),
+    ("hits", "counter", "Query cache hits."),
+    ("misses", "counter", "Query cache misses."),
+    ("evictions", "counter", "Query cache LRU evictions."),
+]:
+    CallbackMetric(f"dashboard_query_cache_{_stat}" + ("_total" if _type == "counter" else ""), _doc,
+                   lambda _stat=_stat: _query_cache.stats()[_stat], type_name=_type)
+
+def _caller_name() -> str:
+    """Returns the name of the first function outside this module on the stack (normally the Dash callback)."""
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_globals.get("__name__") in (__name__, "contextlib"):
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else "unknown"
+
+def _record_query(label, path, started, query, params=None, result=None, error=False):
+    """Records latency/rows/bytes for one query and writes it to the slow-query log if needed."""
+    elapsed = time.perf_counter() - started
+    rows, nbytes = 0, 0
+    if result is not None:
+        if pa is not None and isinstance(result, pa.Table):
+            rows, nbytes = result.num_rows, result.nbytes
+        elif isinstance(result, pd.DataFrame):
+            rows, nbytes = len(result), int(result.memory_usage(index=False).sum()) # 浅统计，足够估算
+        else:
+            rows, nbytes = result
+    QUERY_DURATION.observe(elapsed, callback=label, path=path)
+    QUERY_ROWS.inc(rows, callback=label)
+    QUERY_BYTES.inc(nbytes, callback=label)
+    if error:
+        QUERY_ERRORS.inc(callback=label)
+    if elapsed * 1000 >= DB_SLOW_QUERY_MS:
+        SLOW_QUERIES.inc(callback=label)
+        slow_query_logger.warning(
+            "slow query: %.0f ms callback=%s path=%s rows=%d bytes=%d sql=%s params=%.200r",
+            elapsed * 1000, label, path, rows, nbytes, " ".join(query.split())[:500], params)
+
+
+# --- Superseded Query Cancellation ---
+class QueryInvocation:
+    """One run of a callback registered with cancel_superseded(); see that function."""
+
+    def __init__(self, key, token):
+        self.key = key
+        self.token = token
+
+    @property
+    def superseded(self) -> bool:
+        """True once a newer invocation with the same key has started."""
+        with _inflight_lock:
+            return _latest_invocation.get(self.key, self.token) > self.token
+
+
+_current_invocation = contextvars.ContextVar("dash_query_invocation", default=None)
+_invocation_ids = itertools.count(1)
+# key -> 最新调用的 token。只要该 key 还有调用在运行就保留，否则较早的调用会退回到用自己的 token 比较而“变回”最新
+_latest_invocation = {}
+_active_invocations = {} # key -> 仍在运行的调用数，降为 0 时才删除上面的 token
+_inflight_queries = {} # key -> {conn: token}，正在执行查询的连接
+# 发出过取消请求的连接：PQcancel 是异步送达的，归还时关闭而不是回收，迟到的取消请求不会落到下一个请求的查询上
+_cancelled_conns = weakref.WeakSet()
+_inflight_lock = threading.Lock()
+
+@contextmanager
+def cancel_superseded(key):
+    """
+    Marks the enclosed code as the newest invocation for `key` (e.g. (session_id, callback name)).
+
+    Queries that an older invocation with the same key still has running in PostgreSQL are
+    cancelled right away (psycopg2's connection.cancel(), i.e. PQcancel), and queries an older
+    invocation starts afterwards return immediately. fetch_data() picks the invocation up from
+    a context variable, including inside fetch_many()'s worker threads.
+
+    Yields:
+        QueryInvocation: check `.superseded` afterwards to discard a stale result.
+    """
+    with _inflight_lock:
+        token = next(_invocation_ids) # 在锁内取号，登记顺序与 token 大小一致
+        _latest_invocation[key] = token
+        _active_invocations[key] = _active_invocations.get(key, 0) + 1
+        conns = _inflight_queries.get(key, {})
+        # 在锁内取消：连接仍登记在旧调用名下，说明它还没有被归还连接池 (fetch_data 先注销再归还)
+        for conn in [conn for conn, t in conns.items() if t < token]:
+            del conns[conn]
+            _cancelled_conns.add(conn)
+            try:
+                conn.cancel()
+            except psycopg2.Error as e:
+                print(f"Error cancelling superseded query: {e}")
+        if key in _inflight_queries and not conns:
+            del _inflight_queries[key]
+    invocation = QueryInvocation(key, token)
+    context_token = _current_invocation.set(invocation)
+    try:
+        yield invocation
+    finally:
+        _current_invocation.reset(context_token)
+        with _inflight_lock:
+            remaining = _active_invocations[key] - 1
+            if remaining:
+                _active_invocations[key] = remaining
+            else:
+                del _active_invocations[key]
+                del _latest_invocation[key]
+
+def _register_inflight(invocation, conn) -> bool:
+    """Registers `conn` as running a query for `invocation`; False if the invocation is already stale."""
+    with _inflight_lock:
+        if _latest_invocation.get(invocation.key, invocation.token) > invocation.token:
+            return False
+        _inflight_queries.setdefault(invocation.key, {})[conn] = invocation.token
+        return True
+
+def _unregister_inflight(invocation, conn):
+    with _inflight_lock:
+        conns = _inflight_queries.get(invocation.key)
+        if conns is not None:
+            conns.pop(conn, None)
+            if not conns:
+                del _inflight_queries[invocation.key]
+
+
+# --- Bulk Fetch (COPY ... TO STDOUT) ---
+# PostgreSQL 类型 OID -> Arrow 类型；未列出的类型交给 CSV 解析器自动推断
+_COPY_ARROW_TYPES = {
+    16: "bool",
+    20: "int64", 21: "int64", 23: "int64",
+    700: "float64", 701: "float64", 1700: "float64",
+    18: "string", 19: "string", 25: "string", 1042: "string", 1043: "string",
+}
+
+def _copy_query(cur, query: str, params=None, as_arrow=False):
+    """
+    Runs `query` as `COPY (query) TO STDOUT` in CSV format on the given cursor and decodes
+    the whole stream in one go (pyarrow's multi-threaded CSV reader when available),
+    instead of building one Python tuple per row like cursor.fetchall().
+    Column types come from the query's result description so text columns such as
+    zipcode keep their leading zeros.
+    """
+    conn = cur.connection
+    sql = query.strip().rstrip(";")
+    if params:
+        encoding = psycopg2.extensions.encodings.get(conn.encoding, "utf-8")
+        sql = cur.mogrify(sql, params).decode(encoding) # COPY 不支持绑定参数，先在客户端安全地内联
+
+    cur.execute(f"SELECT * FROM ({sql}) AS bulk_q LIMIT 0") # 只取结果列的类型
+    type_names = {desc.name: _COPY_ARROW_TYPES.get(desc.type_code) for desc in cur.description}
+
+    buffer = io.BytesIO()
+    cur.copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER true)", buffer)
+    buffer.seek(0)
+
+    if pa_csv is not None:
+        table = pa_csv.read_csv(
+            buffer,
+            convert_options=pa_csv.ConvertOptions(
+                column_types={name: pa.type_for_alias(t) for name, t in type_names.items() if t},
+                true_values=["t"], false_values=["f"],
+                strings_can_be_null=True,        # COPY CSV 中未加引号的空字段表示 NULL
+                quoted_strings_can_be_null=False # 加引号的 "" 是空字符串
+            ),
+        )
+        return table if as_arrow else table.to_pandas()
+
+    df = pd.read_csv(buffer, dtype={name: str for name, t in type_names.items() if t == "string"})
+    return pa.Table.from_pandas(df, preserve_index=False) if as_arrow and pa is not None else df
+
+def _estimate_rows(cur, query: str, params=None) -> float:
+    """Returns the planner's row estimate for `query` (EXPLAIN only, nothing is executed)."""
+    cur.execute("EXPLAIN (FORMAT JSON) " + query.strip().rstrip(";"), params)
+    plan = cur.fetchone()[0]
+    return plan[0]["Plan"]["Plan Rows"]
+
+def estimate_rows(query: str, params=None, role="read"):
+    """
+    Returns the planner's row estimate for `query` without running it (from table statistics,
+    so it is only as fresh as the last ANALYZE). Use it where an exact COUNT(*) would scan a
+    large table just to size a pager.
+
+    Returns:
+        float or None: The estimated row count, or None on error.
+    """
+    with db_connection(role=role) as conn:
+        if conn is None:
+            print("Database connection not established. Cannot estimate rows.")
+            return None
+        try:
+            with conn.cursor() as cur:
+                estimate = _estimate_rows(cur, query, params)
+            conn.rollback()
+            return estimate
+        except psycopg2.Error as e:
+            print(f"Error estimating rows: {e}")
+            conn.rollback()
+            return None
+
+def fetch_data_bulk(query: str, params=None, as_arrow=False, label=None, role="read"):
+    """
+    Fetches a large result set through `COPY (query) TO STDOUT`.
+
+    Args:
+        query (str): A SELECT statement. Use %s placeholders for values.
+        params (tuple/list, optional): Parameters to bind to the %s placeholders.
+        as_arrow (bool, optional): Return a pyarrow.Table instead of a DataFrame (requires pyarrow).
+        label (str, optional): Name reported in query metrics; defaults to the calling function.
+        role (str, optional): 'read' (replica when healthy) or 'primary' for read-your-writes.
+
+    Returns:
+        pd.DataFrame or pyarrow.Table: The query results; an empty DataFrame on error.
+    """
+    label = label or _caller_name()
+    started = time.perf_counter()
+    if role == "read":
+        result = _fetch_from_snapshot(query, params, label, started, as_arrow=as_arrow)
+        if result is not None:
+            return result
+    with db_connection(role=role) as conn:
+        if conn is None:
+            print("Database connection not established. Cannot fetch data.")
+            _record_query(label, "copy", started, query, params, error=True)
+            return pd.DataFrame()
+        try:
+            with conn.cursor() as cur:
+                result = _copy_query(cur, query, params, as_arrow=as_arrow)
+            conn.rollback()
+        except (Exception, psycopg2.Error) as e:
+            print(f"Error bulk-fetching data with COPY: {e}")
+            _record_query(label, "copy", started, query, params, error=True)
+            return pd.DataFrame()
+    _record_query(label, "copy", started, query, params, result)
+    return result
+
+# --- Snapshot Read Backend ---
+_snapshot_store = None
+_snapshot_store_lock = threading.Lock()
+
+def _get_snapshot_store():
+    """Returns the DuckDB snapshot store when DB_READ_BACKEND=duckdb, else None."""
+    global _snapshot_store
+    if DB_READ_BACKEND != "duckdb":
+        return None
+    with _snapshot_store_lock:
+        if _snapshot_store is None:
+            try:
+                _snapshot_store = SnapshotStore(DB_SNAPSHOT_DIR, threads=DB_SNAPSHOT_THREADS or None)
+            except ImportError as e:
+                print(f"Snapshot read backend unavailable, using PostgreSQL: {e}")
+                _snapshot_store = False
+        return _snapshot_store or None
+
+def _fetch_from_snapshot(query, params, label, started, as_arrow=False):
+    """
+    Answers a read from the local snapshot if every table it touches has one.
+    Returns None when the query must go to PostgreSQL (no snapshot, or DuckDB rejected it).
+    """
+    store = _get_snapshot_store()
+    if store is None or not store.handles(query):
+        return None
+    try:
+        # psycopg2 只在有参数时把 %% 当作转义，与 PREPARE 路径保持一致
+        result = store.query(_to_server_placeholders(query) if params else query, params, as_arrow=as_arrow)
+    except Exception as e:
+        print(f"Error querying snapshot, falling back to PostgreSQL: {e}")
+        return None
+    _record_query(label, "duckdb", started, query, params, result)
+    return result
+
+def export_snapshot(table_name: str, snapshot_dir=None, chunk_size=50000):
+    """
+    Exports a table from the primary into the Parquet snapshot read by DB_READ_BACKEND=duckdb.
+    Called by the ETL after each load. Rows are streamed through a server-side cursor and
+    written one row group per chunk; the new file replaces the old one only once complete.
+
+    Args:
+        table_name (str): e.g. 'acs_data_all' (schema defaults to public).
+        snapshot_dir (str, optional): Defaults to DB_SNAPSHOT_DIR.
+        chunk_size (int, optional): Rows per chunk / Parquet row group.
+
+    Returns:
+        str or None: The snapshot path, or None on error.
+    """
+    if pa is None:
+        print("pyarrow is not installed. Cannot export snapshot.")
+        return None
+    qualified = qualified_name(table_name)
+    relation = ".".join(quote_ident(part) for part in qualified.split(".", 1))
+    with db_connection() as conn:
+        if conn is None:
+            print("Database connection not established. Cannot export snapshot.")
+            return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL statement_timeout = 0") # ETL 维护不受看板查询的超时限制
+                cur.execute(f"SELECT * FROM {relation} LIMIT 0")
+                description = cur.description
+                cur.execute(f"SELECT COUNT(*) FROM {relation}")
+                expected_rows = cur.fetchone()[0]
+            conn.rollback()
+        except psycopg2.Error as e:
+            print(f"Error reading {qualified} for snapshot export: {e}")
+            return None
+
+    # 不认识的类型 (geometry、date 等) 以文本形式导出
+    fields, select_list = [], []
+    for desc in description:
+        type_name = _COPY_ARROW_TYPES.get(desc.type_code)
+        fields.append(pa.field(desc.name, pa.type_for_alias(type_name or "string")))
+        select_list.append(quote_ident(desc.name) if type_name else f"{quote_ident(desc.name)}::text AS {quote_ident(desc.name)}")
+    query = f"SELECT {', '.join(select_list)} FROM {relation}"
+    chunks = fetch_iter(query, chunk_size=chunk_size, role="primary", statement_timeout=0)
+    try:
+        path, rows = write_snapshot(snapshot_dir or DB_SNAPSHOT_DIR, qualified, pa.schema(fields), chunks,
+                                    expected_rows=expected_rows)
+    except (Exception, psycopg2.Error) as e:
+        print(f"Error writing snapshot for {qualified}: {e}")
+        return None
+    finally:
+        chunks.close()
+    print(f"Exported {rows} rows of {qualified} to {path}")
+    bump_dataset_version(f"snapshot:{qualified}") # 让各 worker 丢弃基于旧快照的缓存结果
+    return path
+
+def refresh_row_counts(table_name: str, dimensions, counts_table=None):
+    """
+    Rebuilds a precomputed `COUNT(*) ... GROUP BY dimensions` table, e.g. per (year, state, county),
+    so pagers can total any filter on those columns with a SUM over a few thousand rows
+    instead of counting the base table. Called by the ETL after each load.
+
+    Args:
+        table_name (str): Base table, e.g. 'acs_data_all' (schema defaults to public).
+        dimensions (list): Columns to group by; they keep their names in the counts table,
+                           next to a `row_count` column.
+        counts_table (str, optional): Defaults to '<table_name>_row_counts' in the same schema.
+
+    Returns:
+        int or None: Number of groups written, or None on error.
+    """
+    qualified = qualified_name(table_name)
+    counts_qualified = qualified_name(counts_table) if counts_table else f"{qualified}_row_counts"
+    relation, counts_relation = (".".join(quote_ident(part) for part in name.split(".", 1))
+                                 for name in (qualified, counts_qualified))
+    dims_sql = ", ".join(quote_ident(d) for d in dimensions)
+    with db_connection() as conn:
+        if conn is None:
+            print("Database connection not established. Cannot refresh row counts.")
+            return None
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL statement_timeout = 0") # 全表 GROUP BY 可能超过连接池默认的超时
+                cur.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {counts_relation} AS
+                    SELECT {dims_sql}, COUNT(*) AS row_count FROM {relation} GROUP BY {dims_sql} WITH NO DATA""")
+                # 同一事务内清空再写入，读者要么看到旧计数，要么看到新计数
+                cur.execute(f"DELETE FROM {counts_relation}")
+                cur.execute(f"""
+                    INSERT INTO {counts_relation} ({dims_sql}, row_count)
+                    SELECT {dims_sql}, COUNT(*) FROM {relation} GROUP BY {dims_sql}""")
+                groups = cur.rowcount
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            print(f"Error refreshing row counts for {qualified}: {e}")
+            return None
+    bump_dataset_version(counts_qualified) # 各 worker 缓存的计数随之失效
+    return groups
+
+# --- Streaming Fetch (server-side cursor) ---
+_iter_cursor_ids = itertools.count(1)
+
+def fetch_iter(query: str, params=None, chunk_size=DB_ITER_CHUNK_SIZE, label=None, role="read",
+               statement_timeout=None):
+    """
+    Streams the results of `query` as DataFrame chunks of at most `chunk_size` rows.
+
+    Backed by a named (server-side) cursor, so only one chunk is held in the worker at a
+    time; use it for exports and table-wide scans instead of fetch_data(). The pooled
+    connection stays checked out until the generator is exhausted or closed.
+
+    Args:
+        query (str): The SQL query to execute. Use %s placeholders for values.
+        params (tuple/list, optional): Parameters to bind to the %s placeholders.
+        chunk_size (int, optional): Rows per yielded DataFrame.
+        label (str, optional): Name reported in query metrics; defaults to the calling function.
+        role (str, optional): 'read' (replica when healthy) or 'primary' for read-your-writes.
+        statement_timeout (int, optional): Milliseconds before PostgreSQL aborts the query (0 = no
+                                  limit, e.g. for ETL scans); defaults to DB_STATEMENT_TIMEOUT_MS.
+
+    Yields:
+        pd.DataFrame: Consecutive chunks of the result.
+
+    Raises:
+        psycopg2.Error: If no connection can be obtained, or the query fails before or
+                        between chunks; a stream cut short never looks like the end of the data.
+    """
+    # 生成器体在第一次 next() 时才执行，调用者名称需要在这里先取到
+    return _iter_chunks(query, params, chunk_size, label or _caller_name(), role, statement_timeout)
+
+def _iter_chunks(query, params, chunk_size, label, role, statement_timeout=None):
+    started = time.perf_counter()
+    total_rows, total_bytes, failed = 0, 0, False
+    with db_connection(role=role) as conn:
+        if conn is None:
+            _record_query(label, "iter", started, query, params, error=True)
+            raise psycopg2.OperationalError("Database connection not established. Cannot stream data.")
+        cur = conn.cursor(name=f"dash_iter_{os.getpid()}_{next(_iter_cursor_ids)}")
+        cur.itersize = chunk_size
+        try:
+            if statement_timeout is not None:
+                with conn.cursor() as setup: # 命名游标只能执行一条语句，超时在同一事务里单独设置
+                    setup.execute("SET LOCAL statement_timeout = %s", (int(statement_timeout),))
+            cur.execute(query.strip().rstrip(";"), params)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                columns = [desc.name for desc in cur.description]
+                chunk = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+                total_rows += len(chunk)
+                total_bytes += int(chunk.memory_usage(index=False).sum())
+                yield chunk
+        except (Exception, psycopg2.Error):
+            failed = True # 记录指标后原样抛出：调用者必须能区分“数据读完了”和“读到一半出错”
+            raise
+        finally:
+            try:
+                cur.close()
+                conn.rollback() # 结束承载游标的事务
+            except psycopg2.Error:
+                pass
+            _record_query(label, "iter", started, query, params, (total_rows, total_bytes), error=failed)
+
+def fetch_data(query: str, params=None, prepare=True, bulk=False, cache=False, label=None,
+               statement_timeout=None, role="read") -> pd.DataFrame:
     """
     Fetches data from the PostgreSQL database using the given query.
 
     Args:
-        query (str): The SQL query to execute.
-        params (tuple, optional): Parameters to pass to the SQL query. Defaults to None.
+        query (str): The SQL query to execute. Use %s placeholders for values.
+        params (tuple/list, optional): Parameters to bind to the %s placeholders. Defaults to None.
+        prepare (bool, optional): Reuse a server-side prepared statement for this SQL text
+                                  on the borrowed connection. Defaults to True.
+        bulk (bool or None, optional): True reads the result through COPY (see fetch_data_bulk);
+                                  None picks COPY automatically when the planner expects at least
+                                  DB_BULK_FETCH_MIN_ROWS rows. Defaults to False.
+        cache (bool, optional): Serve/store the result from the in-process query cache. Use it for
+                                  queries over data that only changes through the ETL. Defaults to False.
+        label (str, optional): Name reported in query metrics and the slow-query log;
+                                  defaults to the calling function (normally the Dash callback).
+        statement_timeout (int, optional): Milliseconds before PostgreSQL aborts this query;
+                                  defaults to DB_STATEMENT_TIMEOUT_MS (set per connection).
+        role (str, optional): 'read' runs on the read replica while it is reachable and within
+                                  DB_REPLICA_MAX_LAG_SECONDS, else on the primary; 'primary' forces
+                                  the primary (read-your-writes). Defaults to 'read'. With
+                                  DB_READ_BACKEND=duckdb, reads of snapshot tables are answered
+                                  from the local Parquet snapshot instead (see export_snapshot).
 
     Returns:
         pd.DataFrame: A Pandas DataFrame containing the query results.
                       Returns an empty DataFrame if an error occurs or no data.
     """
-    conn = get_db_connection()
-    if conn:
+    label = label or _caller_name()
+    started = time.perf_counter()
+    cache_key = None
+    if cache and _query_cache.max_bytes > 0:
+        _refresh_dataset_version()
+        cache_key = _cache_key(query, params)
+        cache_generation = _query_cache.generation
+        cached = _query_cache.get(cache_key)
+        if cached is not None:
+            _record_query(label, "cache", started, query, params, cached)
+            return cached
+
+    path = "cursor"
+    invocation = _current_invocation.get()
+    if role == "read":
+        if invocation is not None and invocation.superseded:
+            QUERY_CANCELLED.inc(callback=label, reason="superseded")
+            return pd.DataFrame()
+        df = _fetch_from_snapshot(query, params, label, started)
+        if df is not None:
+            if cache_key is not None:
+                _query_cache.put(cache_key, df, cache_generation)
+            return df
+    with db_connection(role=role) as conn:
+        if conn is None:
+            print("Database connection not established. Cannot fetch data.")
+            _record_query(label, path, started, query, params, error=True)
+            return pd.DataFrame()
+        if invocation is not None and not _register_inflight(invocation, conn):
+            QUERY_CANCELLED.inc(callback=label, reason="superseded")
+            return pd.DataFrame() # 已有更新的调用，不再执行
         try:
             # print(f"Executing query: {query}")
             # if params:
             #     print(f"With parameters: {params}")
-            df = pd.read_sql_query(query, conn, params=params)
-            return df
+            with conn.cursor() as cur:
+                if statement_timeout is not None:
+                    cur.execute("SET LOCAL statement_timeout = %s", (int(statement_timeout),))
+                if bulk is None:
+                    bulk = _estimate_rows(cur, query, params) >= DB_BULK_FETCH_MIN_ROWS
+                if bulk:
+                    path = "copy"
+                    df = _copy_query(cur, query, params)
+                else:
+                    if prepare and DB_PREPARE_STATEMENTS and _PREPARABLE_RE.match(query):
+                        _execute_prepared(cur, query, params)
+                    else:
+                        cur.execute(query, params)
+                    columns = [desc.name for desc in cur.description] if cur.description else []
+                    rows = cur.fetchall() if cur.description else []
+                    df = pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+            conn.rollback() # 只读查询，结束事务以便连接干净地归还连接池
+        except psycopg2.errors.QueryCanceled as e:
+            superseded = invocation is not None and invocation.superseded
+            reason = "superseded" if superseded else "timeout"
+            if not superseded:
+                print(f"Query cancelled by statement_timeout: {e}")
+            QUERY_CANCELLED.inc(callback=label, reason=reason)
+            _record_query(label, path, started, query, params, error=not superseded)
+            return pd.DataFrame()
         except (Exception, psycopg2.Error) as e:
             print(f"Error fetching data with psycopg2: {e}")
-            # Optional: you might want to rollback if it was part of a transaction
-            # conn.rollback()
+            _record_query(label, path, started, query, params, error=True)
             return pd.DataFrame() # Return empty DataFrame on error
-        # For simple use, we might not close the connection here if we plan to reuse it via get_db_connection.
-        # If using a connection per query:
-        # finally:
-        #     if conn and not conn.closed:
-        #         conn.close()
-    else:
-        print("Database connection not established. Cannot fetch data.")
-        return pd.DataFrame()
+        finally:
+            if invocation is not None: # 必须在归还连接 (离开 db_connection) 之前注销
+                _unregister_inflight(invocation, conn)
+
+    _record_query(label, path, started, query, params, df)
+    if cache_key is not None:
+        _query_cache.put(cache_key, df, cache_generation)
+    return df
+
+# --- Concurrent Fetch ---
+_query_executors = {} # 名称 -> (ThreadPoolExecutor, 创建它的进程 pid)
+_query_executor_lock = threading.Lock()
+
+def _get_query_executor(kind="query"):
+    """
+    Returns this process's thread pool for `kind` (rebuilt after fork, like the connection pool):
+    'query' for fetch_many, 'prefetch' (DB_PREFETCH_WORKERS threads) for fetch_data_async.
+    """
+    with _query_executor_lock:
+        executor, pid = _query_executors.get(kind, (None, None))
+        if executor is None or pid != os.getpid():
+            workers = DB_PREFETCH_WORKERS if kind == "prefetch" else DB_QUERY_WORKERS
+            executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=f"dash-{kind}")
+            _query_executors[kind] = (executor, os.getpid())
+        return executor
+
+def _as_fetch_kwargs(query):
+    """Normalizes a fetch_many() entry (SQL string, (sql, params) tuple or kwargs dict) to fetch_data kwargs."""
+    if isinstance(query, str):
+        return {"query": query}
+    if isinstance(query, dict):
+        return dict(query)
+    sql, params = query
+    return {"query": sql, "params": params}
+
+def fetch_many(queries, **common_kwargs) -> list:
+    """
+    Runs several independent queries concurrently and returns their DataFrames in order.
+
+    Each query runs through fetch_data() on its own pooled connection, so a callback that
+    needs N queries waits for the slowest one instead of their sum.
+
+    Args:
+        queries (list): Each entry is a SQL string, a (sql, params) tuple, or a dict of
+                        fetch_data() keyword arguments (e.g. {"query": ..., "params": ..., "cache": True}).
+        **common_kwargs: fetch_data() keyword arguments applied to every entry unless it sets its own.
+
+    Returns:
+        list[pd.DataFrame]: One result per query (empty DataFrame for a failed query).
+    """
+    caller = _caller_name() # 线程池里取不到回调名，提前记下
+    jobs = [{"label": caller, **common_kwargs, **_as_fetch_kwargs(q)} for q in queries]
+    if len(jobs) <= 1:
+        return [fetch_data(**job) for job in jobs]
+    executor = _get_query_executor()
+    # 复制 contextvars，使线程池中的查询仍归属于当前的 cancel_superseded() 调用
+    futures = [executor.submit(contextvars.copy_context().run, fetch_data, **job) for job in jobs]
+    return [future.result() for future in futures]
+
+def fetch_data_async(query: str, params=None, **kwargs):
+    """
+    Starts fetch_data() in the background and returns immediately, e.g. to warm results the
+    user is likely to ask for next. These speculative queries run on their own small thread
+    pool (DB_PREFETCH_WORKERS), so a burst of them never delays fetch_many() queries.
+
+    The query does not belong to the calling callback's cancel_superseded() invocation,
+    so it keeps running after the callback returns.
+
+    Returns:
+        concurrent.futures.Future: Resolves to the fetch_data() result.
+    """
+    kwargs.setdefault("label", _caller_name())
+    return _get_query_executor("prefetch").submit(fetch_data, query, params, **kwargs)
 
 def close_db_resources():
     """
     Closes any open database resources. Call this when the application shuts down.
     """
-    global _db_connection
-    if _db_connection and not _db_connection.closed:
-        try:
-            _db_connection.close()
-            print("PostgreSQL connection closed.")
-        except Exception as e:
-            print(f"Error closing PostgreSQL connection: {e}")
-    _db_connection = None
+    with _query_executor_lock:
+        for executor, pid in _query_executors.values():
+            if pid == os.getpid():
+                executor.shutdown(wait=True)
+        _query_executors.clear()
+    with _db_pool_lock:
+        for role, pool in list(_db_pools.items()):
+            if pool.pid == os.getpid():
+                try:
+                    pool.closeall()
+                    print(f"PostgreSQL {role} connection pool closed.")
+                except Exception as e:
+                    print(f"Error closing PostgreSQL {role} connection pool: {e}")
+        _db_pools.clear()
 
 # Optional: Register the cleanup function to be called on application exit
 # import atexit
 # atexit.register(close_db_resources)
 
-# Example usage (for testing this file directly):
+# Example usage (for testing this file directly, from the project root: python -m utils.db_utils):
 if __name__ == '__main__':
     print("Testing database connection...")
     # Ensure your environment variables are set or update placeholders above
     # Example: os.environ['DB_USER'] = 'myuser'
     #          os.environ['DB_PASSWORD'] = 'mypass'
 
-    test_conn = get_db_connection()
-    if test_conn:
+    if get_db_pool():
         print("Connection successful!")
         sample_query = "SELECT table_name FROM information_schema.tables WHERE table_schema = 'public' LIMIT 5;"
         df_tables = fetch_data(sample_query)
@@ -115,6 +1415,8 @@ if __name__ == '__main__':
             print(df_tables)
         else:
             print("Could not fetch tables or no tables found.")
+        print(f"Pool stats: {get_pool_stats()}")
+        print(f"Replica status: {get_replica_status()}")
         close_db_resources()
     else:
-        print("Connection failed. Check credentials and DB server.")
\ No newline at end of file
+        print("Connection failed. Check credentials and DB server.")
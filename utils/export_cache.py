@@ -0,0 +1,154 @@
+# dashboard_project/utils/export_cache.py
+"""
+Disk cache of finished export files (see utils/acs_export.py).
+
+Each artifact is stored as `<directory>/<key>.<extension>`, where the key is a hash of
+everything that determines its contents (format, columns, filters, dataset version), so
+a repeated request for the same export is served from disk without touching the database.
+The directory is shared by all workers and background jobs; total size is kept under
+`max_bytes` by deleting the least recently used files.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from utils.metrics import Counter
+
+EXPORT_CACHE_REQUESTS = Counter(
+    "dashboard_export_cache_total", "Export artifact cache lookups and evictions.", ("result",),
+)
+_TMP_SUFFIX = ".tmp"
+STALE_TMP_SECONDS = 3600 # 超过此时间的临时文件视为中断的导出，清理时删除
+
+
+def artifact_key(**parts) -> str:
+    """Stable hash of the (JSON-serializable) parts that identify an artifact."""
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ExportCache:
+    """Size-bounded LRU cache of export files. Safe to share between processes."""
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def path(self, key: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{key}.{extension}")
+
+    def open(self, key: str, extension: str):
+        """
+        Returns the cached artifact opened for reading, or None on a miss.
+        The file stays readable even if another process evicts it meanwhile.
+        """
+        path = self.path(key, extension)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            EXPORT_CACHE_REQUESTS.inc(result="miss")
+            return None
+        try:
+            os.utime(path) # 更新修改时间，作为 LRU 的最近使用时间
+        except OSError:
+            pass
+        EXPORT_CACHE_REQUESTS.inc(result="hit")
+        return f
+
+    def put(self, key: str, extension: str, blocks, expected_rows=None, count_rows=None):
+        """
+        Writes an artifact from an iterable of byte strings. The file is built under a
+        temporary name and moved into place only when complete.
+
+        Args:
+            key (str): See artifact_key().
+            extension (str): File extension, e.g. 'csv.gz' or 'parquet'.
+            blocks (iterable of bytes): The file contents.
+            expected_rows (int, optional): Discard the file instead of caching it if
+                                           count_rows() then reports a different number.
+            count_rows (callable, optional): Returns the number of rows written.
+
+        Returns:
+            tuple: (path, size in bytes)
+
+        Raises:
+            ValueError: If the row count check fails (e.g. the source stream was cut short).
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key, extension)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}{_TMP_SUFFIX}"
+        try:
+            with open(tmp_path, "wb") as f:
+                for block in blocks:
+                    f.write(block)
+            if expected_rows is not None and count_rows is not None and count_rows() != expected_rows:
+                raise ValueError(f"export {key}.{extension} has {count_rows()} rows, expected {expected_rows}")
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict(keep=path)
+        return path, size
+
+    def _entries(self):
+        """(mtime, size, path) of every file in the directory."""
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Deletes least recently used artifacts until the cache fits in max_bytes, plus
+        temporary files left behind by interrupted exports.
+
+        Returns:
+            int: Number of files removed.
+        """
+        removed = 0
+        with self._lock:
+            now = time.time()
+            artifacts = []
+            for mtime, size, path in self._entries():
+                if path.endswith(_TMP_SUFFIX):
+                    if now - mtime > STALE_TMP_SECONDS:
+                        removed += self._remove(path)
+                    continue
+                artifacts.append((mtime, size, path))
+            total = sum(size for _, size, _ in artifacts)
+            for _, size, path in sorted(artifacts): # 最久未使用的在前
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                if self._remove(path):
+                    total -= size
+                    removed += 1
+                    EXPORT_CACHE_REQUESTS.inc(result="evicted")
+        return removed
+
+    @staticmethod
+    def _remove(path) -> int:
+        try:
+            os.remove(path)
+            return 1
+        except FileNotFoundError:
+            return 0
+
+    def stats(self) -> dict:
+        """Number of cached artifacts and their total size."""
+        artifacts = [size for _, size, path in self._entries() if not path.endswith(_TMP_SUFFIX)]
+        return {"files": len(artifacts), "bytes": sum(artifacts), "max_bytes": self.max_bytes}
@@ -0,0 +1,379 @@
+# dashboard_project/utils/geometry.py
+"""
+In-memory index over the US ZCTA GeoJSON used by the ACS map.
+
+Built once when the geometry is loaded, so that a map render only touches the
+features of its selection instead of scanning every ZCTA in the country:
+    - ZCTA code -> position of its feature in the FeatureCollection
+    - state / (state, county) -> positions of the ZCTAs in that area
+    - position -> bounding box of the feature (an (n, 4) float array), so the extent of any
+      selection is a vectorized min/max over its rows
+The ZCTA file itself has no state or county properties; the area lists come from the
+zipcode/state/county columns of acs_data_all (see ZctaGeometryIndex.set_regions).
+
+The geometry comes from the packed file of utils/packed_geometry.py (ZCTA_PACKED_PATH,
+written by `python -m utils.convert_geometry`) when it exists, else from the GeoJSON.
+
+With ZCTA_STORE_DIR set (the default), the loaded geometry is moved into a memory-mapped
+store (utils/geometry_store.py) shared by all worker processes, and features are built
+from its arrays on access.
+
+Level of detail: `python -m utils.build_geometry_lod` writes coarser, topology-preserving
+simplifications of the same file to ZCTA_LOD_DIR. When they match the loaded file, the
+index keeps them as extra levels and choose_level() picks, per render, the coarsest level
+that is still finer than a screen pixel at the map zoom, stepping coarser while the
+selection would exceed a vertex budget.
+"""
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from utils.geometry_store import find_geometry_store, open_geometry_store
+from utils.packed_geometry import PackedGeometry
+
+ZCTA_PROPERTY = "ZCTA5CE20" # GeoJSON 中 ZCTA 编码所在的属性
+# 相对于项目根目录 (从项目根目录启动应用)
+ZCTA_GEOJSON_PATH = os.getenv("ZCTA_GEOJSON_PATH", os.path.join("data", "zcta_us_simplify.json"))
+ZCTA_LOD_DIR = os.getenv("ZCTA_LOD_DIR", os.path.join("data", "zcta_lod")) # build_geometry_lod 的输出目录
+LOD_MANIFEST = "manifest.json"
+# 紧凑的二进制几何文件 (共享弧段 + 整数量化坐标)；存在时优先于 GeoJSON 加载
+ZCTA_PACKED_PATH = os.getenv("ZCTA_PACKED_PATH", os.path.join("data", "zcta_us.topo.npz"))
+# 内存映射的几何存储 (各 worker 共享同一份物理内存)；设为空字符串则每个进程各自保留几何数据
+ZCTA_STORE_DIR = os.getenv("ZCTA_STORE_DIR", os.path.join("data", "geometry_store"))
+
+_loaded_indexes = {}
+_load_lock = threading.Lock()
+
+
+def exterior_rings(geometry):
+    """Exterior rings (lists of [lon, lat]) of a Polygon or MultiPolygon; other types have none."""
+    if not geometry:
+        return []
+    if geometry["type"] == "Polygon":
+        return geometry["coordinates"][:1]
+    if geometry["type"] == "MultiPolygon":
+        return [polygon[0] for polygon in geometry["coordinates"] if polygon and polygon[0]]
+    return []
+
+def count_vertices(geometry) -> int:
+    """Number of coordinates in a Polygon or MultiPolygon (all rings)."""
+    if not geometry:
+        return 0
+    if geometry["type"] == "Polygon":
+        return sum(len(ring) for ring in geometry["coordinates"])
+    if geometry["type"] == "MultiPolygon":
+        return sum(len(ring) for polygon in geometry["coordinates"] for ring in polygon)
+    return 0
+
+def degrees_per_pixel(zoom) -> float:
+    """Longitude degrees covered by one screen pixel at a mapbox zoom level (512 px tiles)."""
+    return 360.0 / (512 * 2 ** zoom)
+
+def feature_bbox(feature):
+    """(min_lon, min_lat, max_lon, max_lat) of a feature's exterior rings; NaNs if it has none."""
+    rings = [np.asarray(ring, dtype=np.float64)[:, :2] for ring in exterior_rings(feature.get("geometry")) if ring]
+    if not rings:
+        return (np.nan,) * 4
+    coords = np.concatenate(rings)
+    return (*coords.min(axis=0), *coords.max(axis=0))
+
+
+class ZctaGeometryIndex:
+    """Positional index of ZCTA features, with precomputed per-state and per-county lists."""
+
+    def __init__(self, geojson, id_property=ZCTA_PROPERTY, signature=""):
+        features = geojson.get("features", []) if geojson else []
+        self._setup(features,
+                    np.array([str(f.get("properties", {}).get(id_property)) for f in features], dtype=object),
+                    np.array([feature_bbox(f) for f in features], dtype=np.float64).reshape(-1, 4),
+                    np.array([count_vertices(f.get("geometry")) for f in features], dtype=np.int64),
+                    id_property, signature)
+
+    @classmethod
+    def from_packed(cls, packed, signature=""):
+        """Index over a PackedGeometry (utils/packed_geometry.py); features are decoded on access."""
+        index = cls.__new__(cls)
+        index._setup(packed.features(0), packed.ids, packed.bboxes, packed.vertex_counts(0),
+                     packed.id_property, signature)
+        for level, tolerance in enumerate(packed.tolerances, start=1):
+            index.levels.append((float(tolerance), packed.features(level), packed.vertex_counts(level)))
+        return index
+
+    def _setup(self, features, ids, bboxes, vertex_counts, id_property, signature):
+        self.id_property = id_property
+        self.signature = signature # 几何数据的版本标识，用于磁盘缓存 (如矢量瓦片) 的键
+        self.features = features # list 或按位置取值的序列 (PackedFeatures)
+        self.ids = ids
+        self.position = {zcta: i for i, zcta in enumerate(self.ids)}
+        # 每个 feature 的外接矩形 [min_lon, min_lat, max_lon, max_lat]，与 features 按位置对齐
+        self.bboxes = bboxes
+        # 细节层级：(化简容差, 与 features 对齐的要素序列, 每个要素的顶点数)，按容差从小到大；0 级为原始数据
+        self.levels = [(0.0, features, vertex_counts)]
+        self._lock = threading.Lock()
+        self._by_state = None
+        self._by_county = None
+        self._all_positions = None
+        self.regions_version = None # 建立州/县列表时 acs_data_all 的数据集版本
+
+    def __len__(self):
+        return len(self.features)
+
+    @property
+    def has_regions(self) -> bool:
+        return self._by_state is not None
+
+    def set_regions(self, df_regions, version=None):
+        """
+        Builds (or rebuilds) the per-state and per-(state, county) position lists.
+
+        Args:
+            df_regions (pd.DataFrame): Columns zipcode, state, county (one row per combination).
+                                       ZCTAs without a feature are ignored.
+            version (optional): Dataset version the rows were read at, kept as regions_version
+                                so the caller can rebuild the lists after the next ETL load.
+        """
+        positions = df_regions["zipcode"].astype(str).map(self.position)
+        df = df_regions.assign(position=positions).dropna(subset=["position"])
+        df = df.astype({"position": np.int64})
+        by_state = {state: np.unique(group.to_numpy()) for state, group in df.groupby("state")["position"]}
+        by_county = {key: np.unique(group.to_numpy()) for key, group in df.groupby(["state", "county"])["position"]}
+        all_positions = np.unique(df["position"].to_numpy())
+        with self._lock:
+            self._by_state, self._by_county, self._all_positions = by_state, by_county, all_positions
+            self.regions_version = version
+
+    def positions_for_zctas(self, zctas) -> np.ndarray:
+        """Positions of the given ZCTA codes that have a feature, in input order."""
+        position = self.position
+        found = [position[z] for z in zctas if z in position]
+        return np.fromiter(found, dtype=np.int64, count=len(found))
+
+    def positions_for_region(self, states=None, counties=None):
+        """
+        Positions of the ZCTAs in the selected states (and counties within them), sorted.
+        Returns None when no state is selected (the whole country) or the area lists are not built.
+        Counties only narrow the selection together with states, as in the map filters.
+        """
+        if not states or self._by_state is None:
+            return None
+        empty = np.empty(0, dtype=np.int64)
+        if counties:
+            parts = [self._by_county.get((s, c), empty) for s in states for c in counties]
+        else:
+            parts = [self._by_state.get(s, empty) for s in states]
+        return np.unique(np.concatenate(parts)) if parts else empty
+
+    def area_positions(self, states=None, counties=None):
+        """
+        Positions of every ZCTA in the selected area, whether or not it has a value for the
+        current variable (no state: all ZCTAs in the area lists). The geometry of an area is then
+        the same for every variable and year. None if the area lists are not built.
+        """
+        if self._by_state is None:
+            return None
+        if not states:
+            return self._all_positions
+        return self.positions_for_region(states, counties)
+
+    def select(self, zctas, states=None, counties=None) -> np.ndarray:
+        """
+        Positions of the features to draw for a map selection: the ZCTAs in `zctas` (those with
+        data), restricted to the selected area. The cost is proportional to the selection.
+        """
+        region = self.positions_for_region(states, counties)
+        if region is None:
+            return self.positions_for_zctas(zctas)
+        wanted = set(zctas)
+        return region[np.fromiter((z in wanted for z in self.ids[region]), dtype=bool, count=len(region))]
+
+    def extent(self, positions):
+        """
+        Bounding box (min_lon, min_lat, max_lon, max_lat) of the features at `positions`,
+        or None if none of them has coordinates.
+        """
+        boxes = self.bboxes[positions]
+        boxes = boxes[~np.isnan(boxes).any(axis=1)]
+        if not len(boxes):
+            return None
+        return (*boxes[:, :2].min(axis=0), *boxes[:, 2:].max(axis=0))
+
+    @classmethod
+    def from_store(cls, store, signature=""):
+        """Index over a GeometryStore (utils/geometry_store.py), without the source file."""
+        index = cls.__new__(cls)
+        index._setup(store.features(0), store.ids.astype(object), store.bboxes, store.vertex_counts(0),
+                     store.id_property, signature)
+        index.use_store(store)
+        return index
+
+    def use_store(self, store):
+        """
+        Serves every level from a GeometryStore (utils/geometry_store.py) built from this index,
+        releasing the per-process copies of the geometry.
+        """
+        if len(store.ids) != len(self.ids):
+            raise ValueError("geometry store does not match the index")
+        self.levels = [(float(tolerance), store.features(level), store.vertex_counts(level))
+                       for level, tolerance in enumerate(store.tolerances)]
+        self.features = self.levels[0][1]
+        self.bboxes = store.bboxes
+
+    def add_level(self, tolerance, features):
+        """
+        Adds a simplified copy of the geometry as a level of detail.
+
+        Args:
+            tolerance (float): Simplification tolerance in degrees (> the previous levels').
+            features (list): GeoJSON features in the same order as self.features.
+
+        Raises:
+            ValueError: If the features do not line up with the index.
+        """
+        ids = [str(f.get("properties", {}).get(self.id_property)) for f in features]
+        if len(ids) != len(self.ids) or any(a != b for a, b in zip(ids, self.ids)):
+            raise ValueError(f"level {tolerance} does not match the ZCTA features")
+        if tolerance <= self.levels[-1][0]:
+            raise ValueError("levels must be added from finest to coarsest")
+        counts = np.array([count_vertices(f.get("geometry")) for f in features], dtype=np.int64)
+        self.levels.append((float(tolerance), features, counts))
+
+    def vertex_count(self, positions, level=0) -> int:
+        return int(self.levels[level][2][positions].sum())
+
+    def choose_level(self, positions, zoom, vertex_budget=None, pixel_tolerance=1.0) -> int:
+        """
+        Level of detail for drawing the features at `positions` at a map zoom.
+
+        The coarsest level whose tolerance is within `pixel_tolerance` screen pixels (the
+        difference is invisible); then coarser levels while the selection has more than
+        `vertex_budget` vertices (None = no budget). The coarsest level is the floor.
+        """
+        max_error = degrees_per_pixel(zoom) * pixel_tolerance
+        level = 0
+        while level + 1 < len(self.levels) and self.levels[level + 1][0] <= max_error:
+            level += 1
+        if vertex_budget is not None:
+            while level + 1 < len(self.levels) and self.vertex_count(positions, level) > vertex_budget:
+                level += 1
+        return level
+
+    def features_at(self, positions, level=0) -> list:
+        features = self.levels[level][1]
+        return [features[i] for i in positions]
+
+
+def _file_signature(path) -> str:
+    st = os.stat(path)
+    return hashlib.sha1(f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()[:12]
+
+def content_sha1(data: bytes) -> str:
+    """Content hash of the source GeoJSON, recorded in the LOD manifest."""
+    return hashlib.sha1(data).hexdigest()
+
+def _load_levels(index, lod_dir, source_sha1) -> str:
+    """
+    Adds the levels listed in lod_dir/manifest.json to `index` if they were built from the
+    same source file. Returns a signature of the levels ("" if none were loaded).
+    """
+    manifest_path = os.path.join(lod_dir, LOD_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return ""
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest.get("source_sha1") != source_sha1:
+            print(f"WARNING: ZCTA levels of detail in '{lod_dir}' were built from a different GeoJSON; ignoring them "
+                  f"(rebuild with: python -m utils.build_geometry_lod).")
+            return ""
+        for level in manifest["levels"]:
+            with open(os.path.join(lod_dir, level["file"]), 'r') as f:
+                index.add_level(level["tolerance"], json.load(f).get("features", []))
+    except (OSError, KeyError, ValueError) as e: # json.JSONDecodeError 是 ValueError 的子类
+        print(f"WARNING: Could not load ZCTA levels of detail from '{lod_dir}': {e}")
+        index.levels = index.levels[:1]
+        return ""
+    print(f"ZCTA levels of detail loaded: tolerances {[lvl[0] for lvl in index.levels[1:]]}.")
+    return _file_signature(manifest_path)
+
+def _load_packed(path):
+    packed = PackedGeometry(path)
+    index = ZctaGeometryIndex.from_packed(packed, signature=_file_signature(path))
+    print("US ZCTA geometry loaded successfully (packed).")
+    return index
+
+def _load_geojson(path, lod_dir):
+    with open(path, 'rb') as f:
+        data = f.read()
+    geojson = json.loads(data)
+    index = ZctaGeometryIndex(geojson, signature=_file_signature(path))
+    print("US ZCTA GeoJSON loaded successfully.")
+    if lod_dir:
+        levels_signature = _load_levels(index, lod_dir, content_sha1(data))
+        if levels_signature: # 矢量瓦片的磁盘缓存随层级一起失效
+            index.signature = f"{index.signature}-{levels_signature}"
+    return index
+
+def _load_from_store(path, lod_dir):
+    """
+    Index over an existing shared store for this geometry file, or None. The store key is
+    the signature the full load would produce: with GeoJSON levels of detail, that of the
+    file plus the manifest, else (levels from another source are ignored) the file's alone.
+    """
+    signatures = [_file_signature(path)]
+    manifest_path = os.path.join(lod_dir, LOD_MANIFEST) if lod_dir and not path.endswith(".npz") else None
+    if manifest_path and os.path.exists(manifest_path):
+        signatures.insert(0, f"{signatures[0]}-{_file_signature(manifest_path)}")
+    for signature in signatures:
+        try:
+            store = find_geometry_store(ZCTA_STORE_DIR, signature)
+        except (OSError, ValueError) as e:
+            print(f"WARNING: Could not open the shared ZCTA geometry store in '{ZCTA_STORE_DIR}': {e}")
+            return None
+        if store is not None:
+            print("US ZCTA geometry loaded successfully (shared store).")
+            return ZctaGeometryIndex.from_store(store, signature)
+    return None
+
+def load_zcta_index(path=None, lod_dir=ZCTA_LOD_DIR):
+    """
+    Loads and indexes the ZCTA geometry, once per process; later calls (e.g. from the map page
+    and the tile endpoint) share the same index.
+
+    Args:
+        path (str): A packed geometry file (.npz) or a GeoJSON file. Default: ZCTA_PACKED_PATH
+                    if it exists, else ZCTA_GEOJSON_PATH.
+        lod_dir (str): Levels of detail for a GeoJSON file (None to skip them); a packed file
+                       carries its own.
+
+    Returns:
+        ZctaGeometryIndex or None: None if the file is missing or invalid.
+    """
+    if path is None:
+        path = ZCTA_PACKED_PATH if os.path.exists(ZCTA_PACKED_PATH) else ZCTA_GEOJSON_PATH
+    with _load_lock:
+        if path in _loaded_indexes:
+            return _loaded_indexes[path]
+        index = None
+        try:
+            if path.endswith(".npz") and os.path.exists(ZCTA_GEOJSON_PATH) \
+                    and os.path.getmtime(ZCTA_GEOJSON_PATH) > os.path.getmtime(path):
+                print(f"WARNING: '{ZCTA_GEOJSON_PATH}' is newer than '{path}'; rebuild it with: python -m utils.convert_geometry")
+            index = _load_from_store(path, lod_dir) if ZCTA_STORE_DIR else None
+            if index is None:
+                index = _load_packed(path) if path.endswith(".npz") else _load_geojson(path, lod_dir)
+                if ZCTA_STORE_DIR:
+                    try:
+                        index.use_store(open_geometry_store(ZCTA_STORE_DIR, index))
+                    except (OSError, ValueError) as e:
+                        print(f"WARNING: Could not use the shared ZCTA geometry store in '{ZCTA_STORE_DIR}': {e}")
+        except FileNotFoundError:
+            print(f"ERROR: US ZCTA geometry file not found at '{os.path.abspath(path)}'.")
+        except json.JSONDecodeError:
+            print(f"ERROR: Could not decode US ZCTA GeoJSON file from '{path}'.")
+        except (OSError, KeyError, ValueError) as e:
+            print(f"ERROR: Could not read packed ZCTA geometry from '{path}': {e}")
+        _loaded_indexes[path] = index
+        return index
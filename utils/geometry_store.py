@@ -0,0 +1,188 @@
+# dashboard_project/utils/geometry_store.py
+"""
+Memory-mapped ZCTA geometry shared by all worker processes.
+
+A ZctaGeometryIndex held as GeoJSON dicts and lists is private to each worker: reference
+count updates touch every object, so copy-on-write pages get copied and memory grows with
+the number of workers. The store keeps every level of detail as flat NumPy arrays in the
+geoarrow layout instead, in uncompressed .npy files opened with mmap:
+    coords_<l>           float64 (n_points, 2)  all ring coordinates of level l, feature by feature
+    ring_offsets_<l>     ring r = coords[ring_offsets[r]:ring_offsets[r + 1]] (closed, as in GeoJSON)
+    polygon_offsets_<l>  rings of polygon p
+    feature_offsets_<l>  polygons of feature f
+plus ids.npy and bboxes.npy. Workers map the same files, so the operating system keeps a
+single physical copy in its page cache. A map render builds GeoJSON only for the features
+it draws, from slices of these arrays.
+
+The store is written once per geometry signature and store format, under
+<ZCTA_STORE_DIR>/<signature>.v<STORE_FORMAT_VERSION>/, by the first process that needs it
+(the others wait on a lock file and then map it). Later processes find it by the signature
+alone and map it without reading the source file. A store left by an older release of the
+format lives under another directory name and is simply not found: the current format is
+built next to it instead of failing to open.
+"""
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+try: # fcntl 只在 Unix 上可用；没有它时多个进程可能同时构建，但写入仍是原子的
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from utils.packed_geometry import PackedFeatures
+
+STORE_FORMAT_VERSION = 1
+_META_FILE = "meta.json"
+
+
+def _feature_polygons(features, position):
+    """Polygons of one feature as lists of (n, 2) ring arrays, from GeoJSON or packed features."""
+    if isinstance(features, PackedFeatures): # 直接取数组，不经过 GeoJSON 列表
+        return features.packed.polygons(position, features.level)
+    geometry = features[position].get("geometry")
+    if not geometry:
+        return []
+    polygons = [geometry["coordinates"]] if geometry["type"] == "Polygon" else \
+        geometry["coordinates"] if geometry["type"] == "MultiPolygon" else []
+    return [[np.asarray(ring, dtype=np.float64)[:, :2].reshape(-1, 2) for ring in rings if ring] for rings in polygons]
+
+
+def _write_level(directory, level, features):
+    coords, ring_lengths, polygon_lengths, feature_lengths = [], [], [], []
+    for position in range(len(features)):
+        polygons = _feature_polygons(features, position)
+        feature_lengths.append(len(polygons))
+        for rings in polygons:
+            polygon_lengths.append(len(rings))
+            for ring in rings:
+                ring_lengths.append(len(ring))
+                coords.append(ring)
+    arrays = {
+        "coords": np.concatenate(coords) if coords else np.empty((0, 2)),
+        "ring_offsets": np.concatenate([[0], np.cumsum(ring_lengths, dtype=np.int64)]),
+        "polygon_offsets": np.concatenate([[0], np.cumsum(polygon_lengths, dtype=np.int64)]),
+        "feature_offsets": np.concatenate([[0], np.cumsum(feature_lengths, dtype=np.int64)]),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(directory, f"{name}_{level}.npy"), np.ascontiguousarray(array))
+
+
+def write_geometry_store(directory, index):
+    """
+    Writes every level of a ZctaGeometryIndex as a store in `directory` (built under a
+    temporary name and renamed into place, so readers never see a partial store).
+    """
+    tmp_dir = f"{directory}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        np.save(os.path.join(tmp_dir, "ids.npy"), np.array([str(i) for i in index.ids], dtype=str))
+        np.save(os.path.join(tmp_dir, "bboxes.npy"), np.ascontiguousarray(index.bboxes, dtype=np.float64))
+        for level, (_, features, _) in enumerate(index.levels):
+            _write_level(tmp_dir, level, features)
+        with open(os.path.join(tmp_dir, _META_FILE), 'w') as f:
+            json.dump({"version": STORE_FORMAT_VERSION, "id_property": index.id_property,
+                       "tolerances": [tolerance for tolerance, _, _ in index.levels]}, f)
+        try:
+            os.rename(tmp_dir, directory)
+        except OSError:
+            if not os.path.exists(os.path.join(directory, _META_FILE)): # 另一个进程已写入同一份数据时忽略
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class StoreFeatures:
+    """Read-only sequence of the GeoJSON features of one store level, built from array slices."""
+
+    def __init__(self, store, level):
+        self.id_property = store.id_property
+        self.ids = store.ids
+        self.coords, self.ring_offsets, self.polygon_offsets, self.feature_offsets = store.arrays[level]
+
+    def __len__(self):
+        return len(self.feature_offsets) - 1
+
+    def __getitem__(self, position):
+        first_polygon, last_polygon = self.feature_offsets[position:position + 2].tolist()
+        ring_ranges = self.polygon_offsets[first_polygon:last_polygon + 1].tolist()
+        offsets = self.ring_offsets[ring_ranges[0]:ring_ranges[-1] + 1].tolist()
+        # 整个要素的坐标只转换一次，再按环切片
+        points = self.coords[offsets[0]:offsets[-1]].tolist()
+        start = offsets[0]
+        polygons = [[points[offsets[r] - start:offsets[r + 1] - start] for r in range(a - ring_ranges[0], b - ring_ranges[0])]
+                    for a, b in zip(ring_ranges, ring_ranges[1:])]
+        if not polygons:
+            geometry = None
+        elif len(polygons) == 1:
+            geometry = {"type": "Polygon", "coordinates": polygons[0]}
+        else:
+            geometry = {"type": "MultiPolygon", "coordinates": polygons}
+        return {"type": "Feature", "properties": {self.id_property: str(self.ids[position])}, "geometry": geometry}
+
+
+class GeometryStore:
+    """Memory-mapped reader of a store directory."""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, _META_FILE), 'r') as f:
+            meta = json.load(f)
+        if meta.get("version") != STORE_FORMAT_VERSION:
+            raise ValueError(f"unsupported geometry store version {meta.get('version')}")
+        self.directory = directory
+        self.id_property = meta["id_property"]
+        self.tolerances = meta["tolerances"]
+
+        def load(name):
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+
+        self.ids = load("ids")
+        self.bboxes = load("bboxes")
+        self.arrays = [tuple(load(f"{name}_{level}") for name in ("coords", "ring_offsets", "polygon_offsets", "feature_offsets"))
+                       for level in range(len(self.tolerances))]
+
+    def features(self, level=0) -> StoreFeatures:
+        return StoreFeatures(self, level)
+
+    def vertex_counts(self, level=0) -> np.ndarray:
+        """Coordinates per feature at `level`."""
+        _, ring_offsets, polygon_offsets, feature_offsets = self.arrays[level]
+        feature_rings = np.asarray(polygon_offsets)[feature_offsets]
+        return np.diff(np.asarray(ring_offsets)[feature_rings])
+
+
+_open_lock = threading.Lock()
+
+def store_directory(root, signature):
+    """Directory of the store for `signature` under `root`, in the current store format."""
+    return os.path.join(root, f"{signature or 'default'}.v{STORE_FORMAT_VERSION}")
+
+def find_geometry_store(root, signature):
+    """The existing store for `signature` under `root`, or None."""
+    directory = store_directory(root, signature)
+    if not os.path.exists(os.path.join(directory, _META_FILE)):
+        return None
+    return GeometryStore(directory)
+
+def open_geometry_store(root, index):
+    """
+    The store of `index` (keyed by index.signature and the store format) under `root`,
+    written first if missing.
+
+    Returns:
+        GeometryStore
+    """
+    directory = store_directory(root, index.signature)
+    with _open_lock:
+        if not os.path.exists(os.path.join(directory, _META_FILE)):
+            os.makedirs(root, exist_ok=True)
+            with open(f"{directory}.lock", 'w') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX) # 其他 worker 等待第一个构建完成
+                if not os.path.exists(os.path.join(directory, _META_FILE)):
+                    write_geometry_store(directory, index)
+        return GeometryStore(directory)
@@ -0,0 +1,136 @@
+# dashboard_project/utils/metrics.py
+"""
+Minimal in-process metrics with Prometheus text exposition (format 0.0.4).
+
+Counters and histograms are kept per process: under Gunicorn every worker reports
+its own numbers (each sample carries a `pid` label), so scrape the workers
+individually or aggregate with sum() by the other labels.
+"""
+import os
+import threading
+from bisect import bisect_left
+
+# 查询耗时直方图的桶边界 (秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labels: dict) -> str:
+    labels = {"pid": os.getpid(), **labels}
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+def _format_value(value) -> str:
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    """A monotonically increasing value per label set."""
+
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _register(self)
+
+    def inc(self, amount=1.0, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(dict(zip(self.labelnames, key)))} {_format_value(value)}"
+                for key, value in items]
+
+
+class Histogram:
+    """Observations bucketed by upper bound, with running sum and count per label set."""
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._values = {} # label key -> [每个桶的计数..., +Inf 计数, sum]
+        _register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def collect(self):
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._values.items()]
+        lines = []
+        for key, series in items:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': le})} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """
+    A gauge/counter whose value is read from a function at scrape time, e.g. pool statistics.
+    `func` returns a number, or a {label value: number} dict when `labelname` is set.
+    """
+
+    def __init__(self, name, documentation, func, type_name="gauge", labelname=None):
+        self.name = name
+        self.documentation = documentation
+        self.type_name = type_name
+        self.func = func
+        self.labelname = labelname
+        _register(self)
+
+    def collect(self):
+        try:
+            value = self.func()
+        except Exception as e:
+            print(f"Error collecting metric {self.name}: {e}")
+            return []
+        if value is None:
+            return []
+        if self.labelname is None:
+            return [f"{self.name}{_format_labels({})} {_format_value(value)}"]
+        return [f"{self.name}{_format_labels({self.labelname: k})} {_format_value(v)}" for k, v in value.items()]
+
+
+def _register(metric):
+    with _registry_lock:
+        _registry.append(metric)
+
+def render_metrics() -> str:
+    """Renders every registered metric in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type_name}")
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,112 @@
+# dashboard_project/utils/packed_geometry.py
+"""
+Packed ZCTA geometry: a compact binary alternative to the ZCTA GeoJSON.
+
+The file (.npz, written by `python -m utils.convert_geometry`) holds the shared-arc
+topology of utils/topology.py as flat NumPy arrays:
+    deltas          int32 (n_points, 2)  quantized coordinates, each relative to the previous
+                                         point (the first to `origin`); decoded with one cumsum
+    arc_offsets     arc i = points[arc_offsets[i]:arc_offsets[i + 1]]
+    refs            arc references of all rings (negative = ~index, reversed)
+    ring_offsets / polygon_offsets / feature_offsets
+                    refs of ring r, rings of polygon p, polygons of feature f (TopoJSON nesting)
+    ids, bboxes     ZCTA code and exterior bounding box per feature
+    tolerances, level_masks
+                    levels of detail: level l keeps the points where bit l - 1 of the packed
+                    mask is set, so every level shares the topology and costs n_points bits
+Only the ZCTA id property is kept; the map does not use the others. Features are decoded
+to GeoJSON on access (features(level)[i]), so a process never holds the whole country as
+Python dicts and lists.
+"""
+import math
+
+import numpy as np
+
+from utils.topology import clean_polygons, rings_to_geometry
+
+FORMAT_VERSION = 1
+
+
+class PackedFeatures:
+    """Read-only sequence of GeoJSON features of one level, decoded on access."""
+
+    def __init__(self, packed, level):
+        self.packed = packed
+        self.level = level
+
+    def __len__(self):
+        return len(self.packed.ids)
+
+    def __getitem__(self, position):
+        return {"type": "Feature", "properties": {self.packed.id_property: str(self.packed.ids[position])},
+                "geometry": self.packed.geometry(position, self.level)}
+
+
+class PackedGeometry:
+    """Reader of a packed geometry file."""
+
+    def __init__(self, path):
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["format_version"]) != FORMAT_VERSION:
+                raise ValueError(f"unsupported packed geometry version {int(data['format_version'])}")
+            self.id_property = str(data["id_property"])
+            self.source_sha1 = str(data["source_sha1"])
+            self.ids = data["ids"].astype(object)
+            self.bboxes = data["bboxes"]
+            self.tolerances = data["tolerances"].tolist()
+            quantum, origin = float(data["quantum"]), data["origin"]
+            self.refs = data["refs"]
+            self.ring_offsets = data["ring_offsets"]
+            self.polygon_offsets = data["polygon_offsets"]
+            self.feature_offsets = data["feature_offsets"]
+            arc_offsets = data["arc_offsets"]
+            coords = np.cumsum(data["deltas"], axis=0, dtype=np.int64) * quantum + origin
+            level_masks = data["level_masks"]
+        self.precision = max(0, math.ceil(-math.log10(quantum)))
+        # 每个层级的 (坐标, 弧段偏移)；0 级为完整数据
+        self._levels = [(coords, arc_offsets)]
+        for i in range(len(self.tolerances)):
+            mask = np.unpackbits(level_masks[i], count=len(coords)).astype(bool)
+            kept = np.concatenate([[0], np.cumsum(mask)])
+            self._levels.append((coords[mask], kept[arc_offsets]))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _ring(self, ring, level):
+        coords, offsets = self._levels[level]
+        pieces = []
+        for ref in self.refs[self.ring_offsets[ring]:self.ring_offsets[ring + 1]].tolist():
+            arc = coords[offsets[ref]:offsets[ref + 1]] if ref >= 0 else coords[offsets[~ref]:offsets[~ref + 1]][::-1]
+            pieces.append(arc[1:] if pieces else arc) # 相邻弧段共享端点
+        return np.concatenate(pieces) if pieces else np.empty((0, 2))
+
+    def polygons(self, position, level=0):
+        """
+        Polygons of the feature at `position` as lists of (n, 2) ring arrays, without collapsed
+        rings; a feature that collapses entirely at `level` keeps its full geometry.
+        """
+        polygons = clean_polygons([[self._ring(r, level) for r in range(self.polygon_offsets[p], self.polygon_offsets[p + 1])]
+                                   for p in range(self.feature_offsets[position], self.feature_offsets[position + 1])],
+                                  self.precision)
+        if not polygons and level:
+            return self.polygons(position, 0)
+        return polygons
+
+    def geometry(self, position, level=0):
+        """GeoJSON geometry of the feature at `position` (None if it has no polygons)."""
+        return rings_to_geometry(self.polygons(position, level))
+
+    def features(self, level=0) -> PackedFeatures:
+        return PackedFeatures(self, level)
+
+    def vertex_counts(self, level=0) -> np.ndarray:
+        """Coordinates per feature at `level` (ignoring rings that collapse), as GeoJSON would hold them."""
+        _, offsets = self._levels[level]
+        arc_points = np.diff(offsets)
+        per_ref = arc_points[np.where(self.refs >= 0, self.refs, ~self.refs)] - 1
+        ring_cumsum = np.concatenate([[0], np.cumsum(per_ref)])
+        per_ring = ring_cumsum[self.ring_offsets[1:]] - ring_cumsum[self.ring_offsets[:-1]] + 1 # 闭合点
+        feature_rings = self.polygon_offsets[self.feature_offsets]
+        cumsum = np.concatenate([[0], np.cumsum(per_ring)])
+        return cumsum[feature_rings[1:]] - cumsum[feature_rings[:-1]]
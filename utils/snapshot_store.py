@@ -0,0 +1,156 @@
+# dashboard_project/utils/snapshot_store.py
+"""
+Columnar snapshots of read-only tables: Parquet files queried in-process with DuckDB.
+
+The ETL exports each table to `<directory>/<schema>.<table>.parquet` after loading it
+(see db_utils.export_snapshot). With DB_READ_BACKEND=duckdb, fetch_data() answers queries
+that only read snapshot tables from these files instead of PostgreSQL. The SQL written for
+PostgreSQL runs unchanged: each snapshot is exposed as a view under its PostgreSQL schema
+name, and DuckDB understands the $1, $2 ... placeholders and `= ANY(list)` filters we use.
+"""
+import os
+import re
+import threading
+
+try: # Optional: 只有 DB_READ_BACKEND=duckdb 时需要
+    import duckdb
+except ImportError:
+    duckdb = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+SNAPSHOT_SUFFIX = ".parquet"
+# FROM / JOIN 之后的表名 (可带 schema 和双引号)；子查询 "FROM (" 不匹配
+_RELATION_RE = re.compile(r'\b(?:FROM|JOIN)\s+((?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))?)', re.IGNORECASE)
+
+
+def qualified_name(table_name: str) -> str:
+    """'acs_data_all' -> 'public.acs_data_all'; quotes are stripped and names lower-cased like PostgreSQL does."""
+    parts = [p[1:-1] if p.startswith('"') else p.lower() for p in re.findall(r'"[^"]+"|[^.]+', table_name)]
+    return ".".join(parts if len(parts) == 2 else ["public"] + parts)
+
+def snapshot_path(directory: str, table_name: str) -> str:
+    return os.path.join(directory, qualified_name(table_name) + SNAPSHOT_SUFFIX)
+
+def write_snapshot(directory: str, table_name: str, schema, chunks, expected_rows=None):
+    """
+    Writes DataFrame chunks to the table's Parquet snapshot, one row group per chunk.
+    The file is built under a temporary name and moved into place only when complete,
+    so readers never see a half-written snapshot.
+
+    Args:
+        directory (str): Snapshot directory (created if missing).
+        table_name (str): Source table, e.g. 'acs_data_all' or 'public.acs_data_all'.
+        schema (pyarrow.Schema): Column types of the snapshot.
+        chunks (iterable of pd.DataFrame): The table's rows.
+        expected_rows (int, optional): Abort without replacing the snapshot if a different
+                                       number of rows was written (e.g. the source stream failed).
+
+    Returns:
+        tuple: (path, rows written)
+    """
+    if pq is None:
+        raise ImportError("pyarrow is required to write Parquet snapshots")
+    os.makedirs(directory, exist_ok=True)
+    path = snapshot_path(directory, table_name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    rows = 0
+    try:
+        with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+            for chunk in chunks:
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+                rows += len(chunk)
+        if expected_rows is not None and rows != expected_rows:
+            raise ValueError(f"snapshot of {table_name} has {rows} rows, expected {expected_rows}")
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path, rows
+
+
+class SnapshotStore:
+    """
+    Serves SELECTs over the snapshot directory from an in-memory DuckDB database.
+
+    Views are (re)created whenever the directory changes, so a snapshot exported by the
+    ETL is picked up without restarting the workers. Each thread queries through its own
+    DuckDB cursor, and the database is rebuilt after fork().
+    """
+
+    def __init__(self, directory: str, threads=None):
+        if duckdb is None:
+            raise ImportError("duckdb is required for the snapshot read backend")
+        self.directory = directory
+        self.threads = threads
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._local = threading.local()
+        self._tables = frozenset()
+        self._dir_mtime = None
+
+    def _refresh(self):
+        """Creates/drops views to match the *.parquet files currently in the directory."""
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self._pid == os.getpid() and mtime == self._dir_mtime:
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._conn = duckdb.connect(":memory:")
+                if self.threads:
+                    self._conn.execute(f"SET threads = {int(self.threads)}")
+                self._pid = os.getpid()
+                self._local = threading.local()
+                self._tables = frozenset()
+            elif mtime == self._dir_mtime:
+                return
+            files = sorted(os.listdir(self.directory)) if mtime is not None else []
+            tables = {name[:-len(SNAPSHOT_SUFFIX)] for name in files if name.endswith(SNAPSHOT_SUFFIX)}
+            for table in tables:
+                schema, name = table.split(".", 1)
+                path = os.path.join(self.directory, table + SNAPSHOT_SUFFIX).replace("'", "''")
+                self._conn.execute(f'CREATE SCHEMA IF NOT EXISTS "{schema}"')
+                self._conn.execute(f"""CREATE OR REPLACE VIEW "{schema}"."{name}" AS SELECT * FROM read_parquet('{path}')""")
+            for table in self._tables - tables:
+                schema, name = table.split(".", 1)
+                self._conn.execute(f'DROP VIEW IF EXISTS "{schema}"."{name}"')
+            self._tables = frozenset(tables)
+            self._dir_mtime = mtime
+
+    def tables(self) -> frozenset:
+        """Qualified names ('public.acs_data_all') of the tables that have a snapshot."""
+        self._refresh()
+        return self._tables
+
+    def handles(self, query: str) -> bool:
+        """True if every table the query reads from has a snapshot."""
+        relations = _RELATION_RE.findall(query)
+        tables = self.tables()
+        return bool(relations) and all(qualified_name(r) in tables for r in relations)
+
+    def _cursor(self):
+        cur = getattr(self._local, "cursor", None)
+        if cur is None:
+            cur = self._local.cursor = self._conn.cursor()
+        return cur
+
+    def query(self, query: str, params=None, as_arrow=False):
+        """
+        Runs a SELECT with $n placeholders against the snapshots.
+
+        Returns:
+            pd.DataFrame or pyarrow.Table: The query results.
+        """
+        self._refresh()
+        params = [list(p) if isinstance(p, tuple) else p for p in params] if params else None
+        result = self._cursor().execute(query, params)
+        return result.fetch_arrow_table() if as_arrow else result.df()
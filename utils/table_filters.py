@@ -0,0 +1,205 @@
+# dashboard_project/utils/table_filters.py
+"""
+Compiles Dash DataTable `filter_query` strings (filter_action='custom') into parameterized SQL.
+
+Supported syntax: the DataTable filter grammar.
+    Relational:  {col} = 5, eq, != / ne, < / lt, <= / le, > / gt, >= / ge, contains, datestartswith.
+                 Every relational operator except datestartswith takes an i (case-insensitive)
+                 or s (case-sensitive, the default) prefix: ieq, s=, icontains ...
+    Unary:       {col} is blank / nil / bool / even / odd / num / object / str / prime,
+                 and the same with `is not`.
+    Logical:     `&&` / `and`, `||` / `or`, `!` (not) and parentheses.
+Values are numbers, bare words, or strings quoted with " ' or `. As in the DataTable's own
+filtering, a negated test (`!`, `is not`) also matches rows where the column is NULL.
+Column names are checked against a whitelist and every value is bound as a %s parameter,
+so nothing from the browser is ever spliced into the SQL text.
+"""
+import re
+
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<column>\{[^}]+\})
+      | (?P<string>"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|`(?:\\.|[^`\\])*`)
+      | (?P<paren>[()])
+      | (?P<logical>&&|\|\|)
+      | (?P<symbol>>=|<=|!=|=|<|>)
+      | (?P<negation>!)
+      | (?P<word>[^\s(){}"'`!]+)
+    )""", re.VERBOSE)
+
+# 关系运算符 -> SQL；i 前缀不区分大小写，s 前缀与默认 (区分大小写) 相同
+_RELATIONAL = {
+    "=": "=", "eq": "=", "!=": "<>", "ne": "<>",
+    "<": "<", "lt": "<", "<=": "<=", "le": "<=", ">": ">", "gt": ">", ">=": ">=", "ge": ">=",
+}
+_RELATIONAL_RE = re.compile(r"([is]?)(eq|ne|lt|le|gt|ge|contains|=|!=|<=|>=|<|>)")
+
+# is <unary> 对每种列类型的 SQL ("{c}" 为列名)；结果从不为 NULL，取反 (is not) 时 NULL 行也会匹配
+_NUMERIC_VALUE = "CAST({c} AS NUMERIC)"
+_UNARY = {
+    "blank": {"text": "({c} IS NULL OR {c} = '')", "numeric": "{c} IS NULL"},
+    "nil": {"text": "{c} IS NULL", "numeric": "{c} IS NULL"},
+    "num": {"text": "FALSE", "numeric": "{c} IS NOT NULL"},
+    "str": {"text": "{c} IS NOT NULL", "numeric": "FALSE"},
+    "bool": {"text": "FALSE", "numeric": "FALSE"},   # 表中没有布尔列
+    "object": {"text": "FALSE", "numeric": "FALSE"}, # 也没有对象/数组列
+    "even": {"text": "FALSE", "numeric": f"COALESCE(MOD({_NUMERIC_VALUE}, 2) = 0, FALSE)"},
+    "odd": {"text": "FALSE", "numeric": f"COALESCE(MOD({_NUMERIC_VALUE}, 2) = 1, FALSE)"},
+    # 大于 1 的整数且没有 2..sqrt(n) 之间的因子；SQRT 的参数先截到 0 以上，因为 AND 不保证短路
+    "prime": {"text": "FALSE", "numeric": (
+        "COALESCE({c} > 1 AND {c} = FLOOR({c}) AND NOT EXISTS ("
+        "SELECT 1 FROM generate_series(2, CAST(FLOOR(SQRT(GREATEST({c}, 0))) AS INTEGER)) AS divisors(n) "
+        f"WHERE MOD({_NUMERIC_VALUE}, divisors.n) = 0), FALSE)")},
+}
+
+
+class FilterQueryError(ValueError):
+    """Raised for filter expressions that cannot be compiled (unknown column or operator, bad value)."""
+
+
+def _tokenize(filter_query: str):
+    tokens, pos = [], 0
+    text = filter_query.strip()
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if match is None or match.end() == pos:
+            raise FilterQueryError(f"Cannot parse filter near {text[pos:pos + 20]!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "word" and value.lower() in ("and", "or"):
+            kind, value = "logical", "&&" if value.lower() == "and" else "||"
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+
+def _unquote(token: str) -> str:
+    return re.sub(r"\\(.)", r"\1", token[1:-1])
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+class _Compiler:
+    """Recursive-descent parser: or_expr := and_expr ('||' and_expr)*; and_expr := factor ('&&' factor)*."""
+
+    def __init__(self, tokens, columns):
+        self.tokens = tokens
+        self.pos = 0
+        self.columns = columns
+        self.params = []
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def or_expr(self):
+        parts = [self.and_expr()]
+        while self.peek() == ("logical", "||"):
+            self.take()
+            parts.append(self.and_expr())
+        return parts[0] if len(parts) == 1 else "(" + " OR ".join(parts) + ")"
+
+    def and_expr(self):
+        parts = [self.factor()]
+        while self.peek() == ("logical", "&&"):
+            self.take()
+            parts.append(self.factor())
+        return parts[0] if len(parts) == 1 else "(" + " AND ".join(parts) + ")"
+
+    def factor(self):
+        kind, value = self.take()
+        if kind == "negation":
+            return f"NOT COALESCE({self.factor()}, FALSE)" # 与前端一致：!(比较) 也匹配 NULL
+        if (kind, value) == ("paren", "("):
+            sql = self.or_expr()
+            if self.take() != ("paren", ")"):
+                raise FilterQueryError("Unbalanced parentheses in filter")
+            return sql
+        if kind != "column":
+            raise FilterQueryError(f"Expected a {{column}}, got {value!r}")
+        return self.comparison(value[1:-1].strip())
+
+    def unary(self, ident, column_type):
+        _, unary = self.take()
+        unary = (unary or "").lower()
+        negate = unary == "not"
+        if negate:
+            _, unary = self.take()
+            unary = (unary or "").lower()
+        if unary not in _UNARY:
+            raise FilterQueryError(f"Unsupported operator 'is {'not ' if negate else ''}{unary}'")
+        sql = _UNARY[unary][column_type].format(c=ident)
+        return f"NOT ({sql})" if negate else sql
+
+    def comparison(self, column):
+        column_type = self.columns.get(column)
+        if column_type is None:
+            raise FilterQueryError(f"Cannot filter on column {column!r}")
+        ident = f'"{column}"'
+        kind, op = self.take()
+        op = (op or "").lower()
+        if kind == "word" and op == "is":
+            return self.unary(ident, column_type)
+
+        match = _RELATIONAL_RE.fullmatch(op) if kind in ("word", "symbol") else None
+        if op == "datestartswith":
+            case_insensitive = False
+        elif match is not None:
+            case_insensitive, op = match.group(1) == "i", match.group(2)
+        else:
+            raise FilterQueryError(f"Unsupported operator {op!r}")
+        value_kind, raw = self.take()
+        if value_kind == "string":
+            value = _unquote(raw)
+        elif value_kind == "word":
+            value = raw
+        else:
+            raise FilterQueryError(f"Expected a value after {{{column}}} {op}")
+
+        if op in ("contains", "datestartswith"):
+            # 数值列按文本匹配，与 DataTable 前端过滤的行为一致
+            target = ident if column_type == "text" else f"CAST({ident} AS TEXT)"
+            pattern = _escape_like(value)
+            self.params.append(f"%{pattern}%" if op == "contains" else f"{pattern}%")
+            return f"{target} {'ILIKE' if case_insensitive else 'LIKE'} %s ESCAPE '\\'"
+        if column_type == "numeric":
+            try:
+                self.params.append(float(value) if not re.fullmatch(r"[+-]?\d+", value) else int(value))
+            except ValueError:
+                raise FilterQueryError(f"{value!r} is not a number (column {column!r})") from None
+        elif case_insensitive:
+            self.params.append(value.lower())
+            return f"LOWER({ident}) {_RELATIONAL[op]} %s"
+        else:
+            self.params.append(value)
+        return f"{ident} {_RELATIONAL[op]} %s"
+
+
+def compile_filter_query(filter_query, columns):
+    """
+    Translates a DataTable filter_query into a SQL predicate.
+
+    Args:
+        filter_query (str): The DataTable's `filter_query` prop ('' or None means no filter).
+        columns (dict): Filterable column name -> 'text' or 'numeric'. Any other column is rejected.
+
+    Returns:
+        tuple: (sql, params) with %s placeholders, or (None, []) for an empty filter.
+
+    Raises:
+        FilterQueryError: If the expression uses an unknown column, an unsupported operator,
+                          or a non-numeric value for a numeric column.
+    """
+    if not filter_query or not filter_query.strip():
+        return None, []
+    compiler = _Compiler(_tokenize(filter_query), columns)
+    sql = compiler.or_expr()
+    if compiler.pos != len(compiler.tokens):
+        raise FilterQueryError(f"Unexpected {compiler.peek()[1]!r} in filter")
+    return sql, compiler.params
@@ -0,0 +1,215 @@
+# dashboard_project/utils/topology.py
+"""
+Shared-arc topology for polygon features (the model behind TopoJSON).
+
+build_topology() cuts every ring at its junctions — points where neighbouring features
+stop sharing a boundary — and stores each boundary piece once as an arc; rings become
+lists of arc references (~i means arc i reversed). Simplifying the arcs instead of the
+rings keeps shared borders identical in both features, so simplified ZCTAs never open
+gaps or overlap (topology-preserving simplification).
+"""
+import numpy as np
+
+
+class Topology:
+    """
+    Attributes:
+        arcs (list of np.ndarray): (n, 2) float arrays; a ring without junctions is one closed arc.
+        geometries (list): Per feature, a list of polygons, each a list of rings, each a list of
+                           arc references (int; negative values are ~index, i.e. reversed).
+        properties (list of dict): Per feature properties.
+    """
+
+    def __init__(self, arcs, geometries, properties):
+        self.arcs = arcs
+        self.geometries = geometries
+        self.properties = properties
+
+
+def _polygons(geometry):
+    if not geometry:
+        return []
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    return []
+
+def _open_ring(ring):
+    """Ring as a list of (x, y) tuples without the repeated closing point."""
+    points = [(float(p[0]), float(p[1])) for p in ring]
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    return points
+
+
+def build_topology(features) -> Topology:
+    """
+    Builds the shared-arc topology of GeoJSON Polygon/MultiPolygon features.
+    Features of other geometry types keep an empty geometry.
+    """
+    rings_per_feature = [[[_open_ring(ring) for ring in polygon if len(ring) >= 4] for polygon in _polygons(f.get("geometry"))]
+                         for f in features]
+
+    # 1. 交汇点：同一个点在不同环中的相邻点不同 (边界在这里分岔)
+    neighbours, junctions = {}, set()
+    for polygons in rings_per_feature:
+        for rings in polygons:
+            for ring in rings:
+                n = len(ring)
+                for i, point in enumerate(ring):
+                    pair = frozenset((ring[i - 1], ring[(i + 1) % n]))
+                    seen = neighbours.setdefault(point, pair)
+                    if seen != pair:
+                        junctions.add(point)
+    del neighbours
+
+    # 2. 在交汇点处切分每个环，得到弧段；相同 (或反向相同) 的弧段只保存一次
+    arcs, arc_ids = [], {}
+
+    def add_arc(points, closed):
+        if closed: # 没有交汇点的环：旋转到最小的点开始，使不同要素中的同一个环得到相同的键
+            start = min(range(len(points)), key=points.__getitem__)
+            points = points[start:] + points[:start]
+            points = points + points[:1]
+        key = tuple(points)
+        if key in arc_ids:
+            return arc_ids[key]
+        reverse = key[::-1]
+        if reverse in arc_ids:
+            return ~arc_ids[reverse]
+        if closed:
+            # 反向的闭合环也旋转到同一起点后再比较
+            rev_open = list(reverse[:-1])
+            start = min(range(len(rev_open)), key=rev_open.__getitem__)
+            rev_key = tuple(rev_open[start:] + rev_open[:start] + rev_open[start:start + 1])
+            if rev_key in arc_ids:
+                return ~arc_ids[rev_key]
+        arc_ids[key] = len(arcs)
+        arcs.append(np.array(points, dtype=np.float64))
+        return arc_ids[key]
+
+    geometries = []
+    for polygons in rings_per_feature:
+        geometry = []
+        for rings in polygons:
+            ring_refs = []
+            for ring in rings:
+                cuts = [i for i, point in enumerate(ring) if point in junctions]
+                if not cuts:
+                    ring_refs.append([add_arc(ring, closed=True)])
+                    continue
+                rotated = ring[cuts[0]:] + ring[:cuts[0]]
+                offsets = [c - cuts[0] for c in cuts] + [len(ring)]
+                rotated.append(rotated[0])
+                ring_refs.append([add_arc(rotated[a:b + 1], closed=False) for a, b in zip(offsets, offsets[1:])])
+            geometry.append(ring_refs)
+        geometries.append(geometry)
+    return Topology(arcs, geometries, [dict(f.get("properties") or {}) for f in features])
+
+
+# --- 化简 ---
+def _douglas_peucker_mask(points, tolerance):
+    """Douglas-Peucker on an open polyline; returns the mask of points to keep (both ends always)."""
+    n = len(points)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[end] - points[start]
+        rel = points[start + 1:end] - points[start]
+        length = np.hypot(*segment)
+        if length == 0:
+            dist = np.hypot(rel[:, 0], rel[:, 1])
+        else:
+            dist = np.abs(segment[0] * rel[:, 1] - segment[1] * rel[:, 0]) / length
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance:
+            split = start + 1 + i
+            keep[split] = True
+            stack += [(start, split), (split, end)]
+    return keep
+
+def simplify_mask(points, tolerance):
+    """Mask of the points of one arc kept by the simplification; the end points (the junctions shared with neighbours) always are."""
+    if tolerance <= 0 or len(points) <= 2:
+        return np.ones(len(points), dtype=bool)
+    if (points[0] == points[-1]).all() and len(points) > 3:
+        # 闭合弧：以离起点最远的点为界拆成两段，分别化简
+        far = int(np.argmax(np.hypot(*(points - points[0]).T)))
+        return np.concatenate([_douglas_peucker_mask(points[:far + 1], tolerance)[:-1],
+                               _douglas_peucker_mask(points[far:], tolerance)])
+    return _douglas_peucker_mask(points, tolerance)
+
+def simplify_arc(points, tolerance):
+    """Simplifies one arc, keeping its end points."""
+    return points[simplify_mask(points, tolerance)]
+
+def simplify_topology(topology, tolerance):
+    """Arcs of `topology` simplified with the given tolerance (in coordinate units, i.e. degrees)."""
+    return [simplify_arc(arc, tolerance) for arc in topology.arcs]
+
+
+# --- 还原为 GeoJSON ---
+def _ring_coords(refs, arcs):
+    coords = []
+    for ref in refs:
+        arc = arcs[ref] if ref >= 0 else arcs[~ref][::-1]
+        coords.extend(arc[1:] if coords else arc) # 相邻弧段共享端点
+    return coords
+
+def _ring_area(ring):
+    """Signed area of a closed ring (first point repeated at the end)."""
+    x, y = ring[:, 0], ring[:, 1]
+    return 0.5 * float(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]))
+
+def clean_polygons(polygons, precision=6):
+    """
+    Rounds polygons given as lists of (n, 2) ring arrays (exterior first) and drops the rings
+    that collapse (fewer than 4 points or zero area), and every polygon whose exterior collapses.
+    """
+    kept = []
+    for rings in polygons:
+        cleaned = []
+        for ring_index, ring in enumerate(rings):
+            ring = np.round(ring, precision)
+            if len(ring) < 4 or _ring_area(ring) == 0:
+                if ring_index == 0:
+                    break
+                continue
+            cleaned.append(ring)
+        if cleaned:
+            kept.append(cleaned)
+    return kept
+
+def rings_to_geometry(polygons):
+    """GeoJSON geometry from already cleaned ring arrays; None if there are no polygons."""
+    coords = [[ring.tolist() for ring in rings] for rings in polygons]
+    if not coords:
+        return None
+    if len(coords) == 1:
+        return {"type": "Polygon", "coordinates": coords[0]}
+    return {"type": "MultiPolygon", "coordinates": coords}
+
+def polygons_to_geometry(polygons, precision=6):
+    """GeoJSON geometry from ring arrays (see clean_polygons); None if nothing is left."""
+    return rings_to_geometry(clean_polygons(polygons, precision))
+
+def topology_to_features(topology, arcs=None, precision=6, fallback=None):
+    """
+    Rebuilds GeoJSON features from the topology (optionally with simplified arcs); see
+    polygons_to_geometry for collapsed rings. A feature left with nothing keeps fallback[i]'s
+    geometry if given (e.g. the original feature), else None.
+    """
+    arcs = topology.arcs if arcs is None else arcs
+    features = []
+    for i, geometry in enumerate(topology.geometries):
+        geom = polygons_to_geometry([[np.asarray(_ring_coords(refs, arcs)).reshape(-1, 2) for refs in rings]
+                                     for rings in geometry], precision)
+        if geom is None and fallback is not None:
+            geom = fallback[i].get("geometry")
+        features.append({"type": "Feature", "properties": topology.properties[i], "geometry": geom})
+    return features
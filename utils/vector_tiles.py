@@ -0,0 +1,280 @@
+# dashboard_project/utils/vector_tiles.py
+"""
+Mapbox Vector Tiles (MVT 2.1) for the ZCTA layer: GET /tiles/zcta/<signature>/<z>/<x>/<y>.pbf
+
+Tiles are cut from the same ZCTA geometry as the map page (utils/geometry.load_zcta_index),
+using the coarsest level of detail that is still sub-pixel at the tile's zoom, encoded
+without extra dependencies, gzip-compressed and cached on disk per z/x/y under a directory
+named after the geometry (and levels) signature. The signature is also part of the tile URL
+(tile_url_template), so browsers and proxies may cache a tile for good: new geometry gets
+new URLs and never serves stale tiles. Each feature carries its ZCTA code (property ZCTA5CE20), which the map page
+uses to color the tiles client-side from a ZCTA -> value array (assets/acs_map.js); the
+geometry itself never travels through a Dash callback.
+"""
+import gzip
+import math
+import os
+import threading
+
+import numpy as np
+from flask import Blueprint, Response, abort
+
+from utils.geometry import load_zcta_index
+from utils.metrics import Counter
+
+TILE_EXTENT = 4096 # 瓦片内坐标范围
+TILE_BUFFER = 64 # 瓦片边缘外保留的缓冲区，避免相邻瓦片接缝处出现缝隙
+ZCTA_LAYER = "zcta"
+MAX_TILE_ZOOM = int(os.getenv("TILE_MAX_ZOOM", "12")) # 更高的缩放级别由客户端放大该级别的瓦片
+TILE_CACHE_DIR = os.getenv("TILE_CACHE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "tiles"))
+TILE_PATH = "/tiles/zcta/<signature>/<int:z>/<int:x>/<int:y>.pbf"
+TILE_URL_TEMPLATE = "/tiles/zcta/{signature}/{z}/{x}/{y}.pbf" # mapbox-gl 的瓦片 URL 模板 (见 tile_url_template)
+
+TILE_REQUESTS = Counter("dashboard_tile_requests_total", "Vector tile requests by cache result.", ("result",))
+
+tiles_bp = Blueprint("vector_tiles", __name__)
+
+
+# --- Protocol Buffers 编码 (vector_tile.proto 只用到 varint 和 length-delimited 两种类型) ---
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+def _field(number: int, payload: bytes) -> bytes:
+    """Length-delimited field (wire type 2)."""
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+def _varint_field(number: int, value: int) -> bytes:
+    return _varint(number << 3) + _varint(value)
+
+def _packed(number: int, values) -> bytes:
+    return _field(number, b"".join(_varint(v) for v in values))
+
+def _zigzag(n: int) -> int:
+    return (n << 1) ^ (n >> 31)
+
+
+def _encode_geometry(rings) -> list:
+    """Polygon geometry commands for rings given as (n, 2) int arrays, already oriented."""
+    commands, cx, cy = [], 0, 0
+    for ring in rings:
+        xs, ys = ring[:, 0].tolist(), ring[:, 1].tolist()
+        commands += [1 | (1 << 3), _zigzag(xs[0] - cx), _zigzag(ys[0] - cy)] # MoveTo
+        commands.append(2 | ((len(xs) - 1) << 3)) # LineTo
+        for i in range(1, len(xs)):
+            commands += [_zigzag(xs[i] - xs[i - 1]), _zigzag(ys[i] - ys[i - 1])]
+        commands.append(7 | (1 << 3)) # ClosePath
+        cx, cy = xs[-1], ys[-1]
+    return commands
+
+def encode_layer(name: str, features, extent=TILE_EXTENT) -> bytes:
+    """
+    Encodes one MVT layer.
+
+    Args:
+        name (str): Layer name.
+        features (iterable): (id, properties dict of strings, rings) tuples; see _encode_geometry.
+    """
+    keys, values, encoded = {}, {}, []
+    for feature_id, properties, rings in features:
+        tags = []
+        for key, value in properties.items():
+            tags += [keys.setdefault(key, len(keys)), values.setdefault(str(value), len(values))]
+        encoded.append(_field(2, _varint_field(1, feature_id) + _packed(2, tags)
+                              + _varint_field(3, 3) + _packed(4, _encode_geometry(rings)))) # type 3 = POLYGON
+    return _field(3, b"".join([
+        _varint_field(15, 2), # version
+        _field(1, name.encode("utf-8")),
+        *encoded,
+        *(_field(3, key.encode("utf-8")) for key in keys),
+        *(_field(4, _field(1, value.encode("utf-8"))) for value in values), # Value.string_value
+        _varint_field(5, extent),
+    ]))
+
+
+# --- 投影与裁剪 ---
+def tile_bounds(z: int, x: int, y: int):
+    """(min_lon, min_lat, max_lon, max_lat) of a Web Mercator tile."""
+    n = 2 ** z
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+    return x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y)
+
+def _to_tile(coords, z, x, y):
+    """lon/lat (n, 2) -> integer tile coordinates (y pointing down)."""
+    n = 2 ** z
+    lon, lat = coords[:, 0], np.clip(coords[:, 1], -85.0511, 85.0511)
+    px = ((lon + 180) / 360 * n - x) * TILE_EXTENT
+    lat_rad = np.radians(lat)
+    py = ((1 - np.log(np.tan(lat_rad) + 1 / np.cos(lat_rad)) / math.pi) / 2 * n - y) * TILE_EXTENT
+    return np.rint(np.column_stack([px, py])).astype(np.int64)
+
+def _clip_ring(points, lo, hi):
+    """Sutherland-Hodgman clip of a closed ring (list of (x, y), no repeated end point) to a square."""
+    for axis, bound, keep_above in ((0, lo, True), (0, hi, False), (1, lo, True), (1, hi, False)):
+        if not points:
+            break
+        inside = (lambda p: p[axis] >= bound) if keep_above else (lambda p: p[axis] <= bound)
+        clipped, prev = [], points[-1]
+        for cur in points:
+            if inside(cur) != inside(prev):
+                t = (bound - prev[axis]) / (cur[axis] - prev[axis])
+                cross = [prev[0] + t * (cur[0] - prev[0]), prev[1] + t * (cur[1] - prev[1])]
+                cross[axis] = bound
+                clipped.append((round(cross[0]), round(cross[1])))
+            if inside(cur):
+                clipped.append(cur)
+            prev = cur
+        points = clipped
+    return points
+
+def _prepare_ring(ring, z, x, y, exterior):
+    """Projects, clips and de-duplicates one ring; returns an (n, 2) array or None if it vanishes."""
+    coords = np.asarray(ring, dtype=np.float64)[:, :2]
+    pts = _to_tile(coords, z, x, y)
+    if len(pts) > 1 and (pts[0] == pts[-1]).all(): # GeoJSON 的环首尾重复，MVT 用 ClosePath
+        pts = pts[:-1]
+    lo, hi = -TILE_BUFFER, TILE_EXTENT + TILE_BUFFER
+    if len(pts) and (pts.min() < lo or pts.max() > hi): # 只有跨越瓦片边界的环需要逐点裁剪
+        if pts[:, 0].max() < lo or pts[:, 0].min() > hi or pts[:, 1].max() < lo or pts[:, 1].min() > hi:
+            return None
+        pts = np.array(_clip_ring([tuple(p) for p in pts.tolist()], lo, hi), dtype=np.int64).reshape(-1, 2)
+    if len(pts) < 3:
+        return None
+    # 量化后相邻重复的点在低缩放级别下很多，去掉它们就是最简单的化简
+    keep = np.ones(len(pts), dtype=bool)
+    keep[1:] = (np.diff(pts, axis=0) != 0).any(axis=1)
+    pts = pts[keep]
+    if len(pts) < 3:
+        return None
+    # MVT 要求外环在瓦片坐标系 (y 向下) 中面积为正，内环为负
+    area = np.sum(pts[:, 0] * np.roll(pts[:, 1], -1) - np.roll(pts[:, 0], -1) * pts[:, 1])
+    if area == 0:
+        return None
+    if (area > 0) != exterior:
+        pts = pts[::-1]
+    return pts
+
+def _polygons(geometry):
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    return []
+
+
+class ZctaTileRenderer:
+    """Cuts, encodes and caches MVT tiles from a ZctaGeometryIndex."""
+
+    def __init__(self, index, cache_dir=TILE_CACHE_DIR):
+        self.index = index
+        self.signature = index.signature or "default"
+        self.cache_dir = os.path.join(cache_dir, self.signature)
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def _cache_path(self, z, x, y):
+        return os.path.join(self.cache_dir, str(z), str(x), f"{y}.pbf.gz")
+
+    def render(self, z: int, x: int, y: int) -> bytes:
+        """The uncompressed tile."""
+        min_lon, min_lat, max_lon, max_lat = tile_bounds(z, x, y)
+        pad_lon = (max_lon - min_lon) * TILE_BUFFER / TILE_EXTENT
+        pad_lat = (max_lat - min_lat) * TILE_BUFFER / TILE_EXTENT
+        boxes = self.index.bboxes
+        hits = np.flatnonzero((boxes[:, 0] <= max_lon + pad_lon) & (boxes[:, 2] >= min_lon - pad_lon)
+                              & (boxes[:, 1] <= max_lat + pad_lat) & (boxes[:, 3] >= min_lat - pad_lat))
+        # 不超过该缩放级别一个像素误差的最粗细节层级 (mapbox-gl 的矢量瓦片为 512 像素)
+        level_features = self.index.levels[self.index.choose_level(hits, z)][1]
+        features = []
+        for position in hits.tolist():
+            feature = level_features[position]
+            rings = []
+            for polygon in _polygons(feature.get("geometry") or {"type": None}):
+                outer = _prepare_ring(polygon[0], z, x, y, exterior=True) if polygon and polygon[0] else None
+                if outer is None:
+                    continue
+                rings.append(outer)
+                rings += [r for r in (_prepare_ring(hole, z, x, y, exterior=False) for hole in polygon[1:] if hole)
+                          if r is not None]
+            if rings:
+                features.append((position, {self.index.id_property: self.index.ids[position]}, rings))
+        return encode_layer(ZCTA_LAYER, features)
+
+    def tile(self, z: int, x: int, y: int) -> bytes:
+        """The gzip-compressed tile, from the disk cache or rendered (once per tile across threads)."""
+        path = self._cache_path(z, x, y)
+        try:
+            with open(path, "rb") as f:
+                TILE_REQUESTS.inc(result="hit")
+                return f.read()
+        except FileNotFoundError:
+            pass
+        with self._locks_guard:
+            lock = self._locks.setdefault((z, x, y), threading.Lock())
+        try:
+            with lock:
+                if os.path.exists(path): # 另一个线程刚生成
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    TILE_REQUESTS.inc(result="hit")
+                    return data
+                data = gzip.compress(self.render(z, x, y), compresslevel=6)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+        finally: # 渲染或写入失败时也要删除，否则 _locks 只增不减
+            with self._locks_guard:
+                self._locks.pop((z, x, y), None)
+        TILE_REQUESTS.inc(result="miss")
+        return data
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+def tile_url_template(signature):
+    """The tile URL template of the geometry with this signature (ZctaGeometryIndex.signature)."""
+    return TILE_URL_TEMPLATE.replace("{signature}", signature or "default")
+
+def get_tile_renderer():
+    """
+    The process-wide renderer over the current ZCTA geometry, or None if the geometry failed
+    to load. It is replaced when load_zcta_index() returns another index (e.g. a packed file
+    appeared), so tiles always come from the geometry the map page uses.
+    """
+    global _renderer
+    index = load_zcta_index()
+    if index is None:
+        return None
+    with _renderer_lock:
+        if _renderer is None or _renderer.index is not index:
+            _renderer = ZctaTileRenderer(index, TILE_CACHE_DIR)
+        return _renderer
+
+
+@tiles_bp.route(TILE_PATH)
+def zcta_tile(signature, z, x, y):
+    if not 0 <= z <= MAX_TILE_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        abort(404)
+    renderer = get_tile_renderer()
+    if renderer is None:
+        abort(503, description="ZCTA geometry is not available")
+    if signature != renderer.signature: # 页面加载于几何更新之前；重新渲染地图后使用新的 URL
+        abort(404)
+    # URL 中带有几何签名，同一 URL 的内容不会改变
+    return Response(renderer.tile(z, x, y), mimetype="application/vnd.mapbox-vector-tile", headers={
+        "Content-Encoding": "gzip",
+        "Cache-Control": "public, max-age=86400, immutable",
+    })
+
+
+def register_tile_routes(server):
+    """Registers the vector tile endpoint on the Flask server (app.server)."""
+    server.register_blueprint(tiles_bp)